@@ -17,38 +17,67 @@ function getCsrfToken() {
   return metaTag ? metaTag.content : ''
 }
 
-async function makeRpcCall(method, params = {}) {
-  const payload = {
-    jsonrpc: '2.0',
-    method: method,
-    params: params,
-    id: Date.now()
-  }
+// Calls made in the same tick to the same URL are sent together as a
+// JSON-RPC batch
+const pendingCalls = new Map()
 
-  const response = await fetch('/rpc/', {
-    method: 'POST',
-    headers: {
-      'Content-Type': 'application/json',
-      'X-CSRFToken': getCsrfToken()
-    },
-    body: JSON.stringify(payload)
+function makeRpcCall(method, params = {}, url = '/rpc/') {
+  return new Promise((resolve, reject) => {
+    if (!pendingCalls.has(url)) {
+      pendingCalls.set(url, [])
+      queueMicrotask(() => flushRpcCalls(url))
+    }
+    pendingCalls.get(url).push({ method, params, resolve, reject })
   })
+}
 
-  if (!response.ok) {
-    throw new Error(`HTTP ${response.status}: ${response.statusText}`)
-  }
+async function flushRpcCalls(url) {
+  const calls = pendingCalls.get(url)
+  pendingCalls.delete(url)
 
-  const data = await response.json()
-  
-  if (data.error) {
-    throw new Error(data.error.message || JSON.stringify(data.error))
-  }
+  const payload = calls.map((call, index) => ({
+    jsonrpc: '2.0',
+    method: call.method,
+    params: call.params,
+    id: index
+  }))
+
+  try {
+    const response = await fetch(url, {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+        'X-CSRFToken': getCsrfToken()
+      },
+      body: JSON.stringify(payload)
+    })
 
-  return data.result
+    if (!response.ok) {
+      throw new Error(`HTTP ${response.status}: ${response.statusText}`)
+    }
+
+    const data = await response.json()
+    const results = new Map((Array.isArray(data) ? data : [data]).map(r => [r.id, r]))
+
+    calls.forEach((call, index) => {
+      const result = results.get(index)
+      if (!result) {
+        call.reject(new Error(`No response for ${call.method}`))
+      } else if (result.error) {
+        call.reject(new Error(result.error.message || JSON.stringify(result.error)))
+      } else {
+        call.resolve(result.result)
+      }
+    })
+  } catch (error) {
+    calls.forEach(call => call.reject(error))
+  }
 }
 
-// Export function to create the calendar app
-export function createCalendarApp(coloniaId) {
+// Export function to create the calendar app, eventsUrl streams the
+// changes other volunteers make and readUrl serves the read-only calls
+export function createCalendarApp(coloniaId, eventsUrl = null,
+                                  readUrl = '/rpc/') {
   console.log('Creating calendar app for colonia:', coloniaId)
   
   const app = createApp({
@@ -57,61 +86,124 @@ export function createCalendarApp(coloniaId) {
         coloniaId,
         selectedDate: new Date(),
         feedingDates: [],
+        feedingVersion: null,
         availableUsers: [],
         currentUserId: null,
         loading: false,
         isAdmin: false,
-        calendarKey: 0
+        calendarKey: 0,
+        events: null
       }
     },
     async mounted() {
       await this.loadFeedingDates()
+      this.listenForChanges()
+    },
+    unmounted() {
+      if (this.events) {
+        this.events.close()
+      }
     },
     methods: {
+      listenForChanges() {
+        if (!eventsUrl || typeof EventSource === 'undefined') {
+          return
+        }
+        this.events = new EventSource(eventsUrl)
+        this.events.addEventListener('cambios', (event) => {
+          this.applyChanges(JSON.parse(event.data))
+        })
+      },
+
+      // Patch the calendar with the feedings changed elsewhere
+      applyChanges(changes) {
+        if (changes.reset) {
+          this.feedingVersion = null
+          this.loadFeedingDates()
+          return
+        }
+        const feedings = changes.changed.feedings || []
+        const touched = new Set([
+          ...(changes.deleted.feedings || []),
+          ...feedings.map(f => f.date)
+        ])
+        if (touched.size === 0) {
+          return
+        }
+        const users = new Map(this.availableUsers.map(u => [u.id, u]))
+        if (feedings.some(f => !users.has(f.user_id))) {
+          // Somebody we have no name for, reload the lot
+          this.loadFeedingDates()
+          return
+        }
+        this.feedingDates = this.feedingDates.filter(attr =>
+          !touched.has(this.formatDate(attr.dates))
+        )
+        feedings.forEach(f => {
+          const user = users.get(f.user_id)
+          this.feedingDates.push(this.feedingAttribute(
+            new Date(f.date), f.user_id, user.username, user.full_name
+          ))
+        })
+        this.calendarKey++
+      },
+
+      feedingAttribute(date, userId, username, fullName) {
+        // Determine color based on user
+        const color = userId === this.currentUserId ? 'red' : 'blue'
+        return {
+          dates: date,
+          dot: {
+            color: color,
+            class: 'feeding-date',
+          },
+          popover: {
+            label: fullName || username,
+            visibility: 'hover',
+            hideIndicator: true,
+            isInteractive: false
+          },
+          userId: userId,
+          username: username,
+          fullName: fullName
+        }
+      },
+
       async loadFeedingDates() {
         try {
           this.loading = true
           
-          // Load feeding dates
-          const datesResult = await makeRpcCall('get_feeding_dates', {
-            colonia_id: this.coloniaId
-          })
-          
-          // Load available users and admin status
-          const usersResult = await makeRpcCall('get_colony_feeding_users', {
-            colonia_id: this.coloniaId
-          })
+          // Feeding dates, available users and admin status in one batch
+          const [datesResult, usersResult] = await Promise.all([
+            makeRpcCall('get_feeding_dates', {
+              colonia_id: this.coloniaId,
+              version: this.feedingVersion,
+              compact: true
+            }, readUrl),
+            makeRpcCall('get_colony_feeding_users', {
+              colonia_id: this.coloniaId
+            }, readUrl)
+          ])
           
           // Store admin status and current user
           this.isAdmin = usersResult.is_admin || false
           this.currentUserId = usersResult.current_user_id
           this.availableUsers = usersResult.users || []
           
+          // Nothing changed since the last load
+          if (datesResult.not_modified) {
+            return
+          }
+          this.feedingVersion = datesResult.version
+          
           // Process feeding dates with client-side color logic
-          this.feedingDates = datesResult.dates.map(dateInfo => {
-            // Determine color based on user
-            let color = null
-            if (dateInfo.user_id) {
-              color = dateInfo.user_id === this.currentUserId ? 'red' : 'blue'
-            }
-            
-            return {
-              dates: new Date(dateInfo.date),
-              dot: {
-                color: color,
-                class: 'feeding-date',
-              },
-              popover: {
-                label: dateInfo.full_name || dateInfo.username,
-                visibility: 'hover',
-                hideIndicator: true,
-                isInteractive: false
-              },
-              userId: dateInfo.user_id,
-              username: dateInfo.username,
-              fullName: dateInfo.full_name
-            }
-          })
+          this.feedingDates = Object.entries(datesResult.dates).flatMap(([date, userIds]) =>
+            userIds.map(userId => {
+              const user = datesResult.users[userId]
+              return this.feedingAttribute(new Date(date), userId,
+                                           user.username, user.full_name)
+            })
+          )
           
         } catch (error) {
           console.error('Error loading feeding dates:', error)
@@ -176,25 +268,9 @@ export function createCalendarApp(coloniaId) {
           )
           
           if (result.assigned) {
-            // Determine color based on user
-            console.log("Assigning to: ", result.username);
-            const color = result.user_id === this.currentUserId ? 'red' : 'blue'
-            
-            const newAttribute = {
-              dates: day.date,
-              dot: {
-                color: color,
-                class: 'feeding-date',
-              },
-              popover: {
-                label: result.username,
-                visibility: 'hover',
-              },
-              userId: result.user_id,
-              username: result.username,
-              fullName: result.full_name
-            }
-
+            const newAttribute = this.feedingAttribute(
+              day.date, result.user_id, result.username, result.full_name
+            )
             
             if (existingIndex >= 0) {
               this.feedingDates[existingIndex] = newAttribute
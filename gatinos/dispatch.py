@@ -0,0 +1,271 @@
+"""
+Dispatching of background tasks.
+
+Tasks are the Celery ``shared_task`` functions of the apps, but where they
+run is decided by the backend configured for each queue in
+``settings.TASK_QUEUES``: a Celery worker, a local pool of processes for CPU
+bound work, a local pool of threads for I/O or inline for the tests.
+
+    from gatinos.dispatch import enqueue
+    enqueue(tasks.process_image, foto.id, queue="imagenes")
+"""
+import atexit
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import close_old_connections
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    pass
+
+
+def task_name(task):
+    """Import path of the task, Celery tasks already know theirs"""
+    name = getattr(task, "name", None)
+    if name is None:
+        name = f"{task.__module__}.{task.__qualname__}"
+    return name
+
+
+def run_task(name, args, kwargs):
+    close_old_connections()
+    try:
+        task = import_string(name)
+        return task(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+def init_worker_process():
+    import django
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'gatinos.settings')
+    django.setup()
+
+
+class BaseBackend:
+    def __init__(self, alias, options):
+        self.alias = alias
+        self.max_pending = options.get("MAX_PENDING", 100)
+
+    def submit(self, task, *args, **kwargs):
+        raise NotImplementedError()
+
+    def backlog(self):
+        raise NotImplementedError()
+
+    def shutdown(self, wait=True):
+        pass
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} alias={self.alias}>"
+
+
+class EagerBackend(BaseBackend):
+    """Runs the task inline, meant for the tests"""
+
+    def submit(self, task, *args, **kwargs):
+        return run_task(task_name(task), args, kwargs)
+
+    def backlog(self):
+        return 0
+
+
+class PoolBackend(BaseBackend):
+    executor_class = None
+
+    def __init__(self, alias, options):
+        super().__init__(alias, options)
+        self.workers = options.get("WORKERS", 2)
+        self._executor = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def get_executor_kwargs(self):
+        return {"max_workers": self.workers}
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                kwargs = self.get_executor_kwargs()
+                self._executor = self.executor_class(**kwargs)
+            return self._executor
+
+    def submit(self, task, *args, **kwargs):
+        executor = self.executor
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise QueueFull(f"Queue '{self.alias}' has "
+                                f"{self._pending} pending tasks")
+            self._pending += 1
+        try:
+            future = executor.submit(run_task, task_name(task), args, kwargs)
+        except Exception:
+            self._done(None)
+            raise
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._pending -= 1
+        # exception() de una tarea cancelada lanza CancelledError
+        if (future is not None and not future.cancelled()
+                and future.exception() is not None):
+            logger.error("Task failed in queue '%s'", self.alias,
+                         exc_info=future.exception())
+
+    def backlog(self):
+        return self._pending
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=not wait)
+
+
+class ThreadPoolBackend(PoolBackend):
+    executor_class = ThreadPoolExecutor
+
+    def get_executor_kwargs(self):
+        kwargs = super().get_executor_kwargs()
+        kwargs["thread_name_prefix"] = f"tasks-{self.alias}"
+        return kwargs
+
+
+class ProcessPoolBackend(PoolBackend):
+    executor_class = ProcessPoolExecutor
+
+    def get_executor_kwargs(self):
+        kwargs = super().get_executor_kwargs()
+        # Con spawn los procesos no heredan las conexiones a la base de datos
+        kwargs["mp_context"] = multiprocessing.get_context("spawn")
+        kwargs["initializer"] = init_worker_process
+        return kwargs
+
+
+class CeleryBackend(BaseBackend):
+    """Sends the task to the Celery broker.
+
+    When the broker is unreachable the task goes to the ``FALLBACK`` queue,
+    and so do the following ones during ``RETRY_AFTER`` seconds. The backlog
+    is the length of the broker queue, refreshed at most every
+    ``BACKLOG_TTL`` seconds.
+    """
+
+    def __init__(self, alias, options):
+        super().__init__(alias, options)
+        self.fallback = options.get("FALLBACK")
+        self.queue_name = options.get("QUEUE", "celery")
+        self.backlog_ttl = options.get("BACKLOG_TTL", 5)
+        self.retry_after = options.get("RETRY_AFTER", 30)
+        self._backlog = (0, 0.0)
+        self._down_until = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def available(self):
+        return time.monotonic() >= self._down_until
+
+    def mark_down(self, exc):
+        logger.warning("Celery unavailable for queue '%s': %s",
+                       self.alias, exc)
+        self._down_until = time.monotonic() + self.retry_after
+
+    def submit(self, task, *args, **kwargs):
+        if self.available or self.fallback is None:
+            try:
+                if self._queue_length() >= self.max_pending:
+                    raise QueueFull(f"Queue '{self.alias}' has "
+                                    f"{self.max_pending} pending tasks")
+                result = task.apply_async(args, kwargs,
+                                          queue=self.queue_name,
+                                          retry=False)
+            except QueueFull:
+                raise
+            except Exception as exc:
+                if self.fallback is None:
+                    raise
+                self.mark_down(exc)
+            else:
+                with self._lock:
+                    pending, checked = self._backlog
+                    self._backlog = (pending + 1, checked)
+                return result
+        return get_backend(self.fallback).submit(task, *args, **kwargs)
+
+    def _queue_length(self):
+        with self._lock:
+            pending, checked = self._backlog
+        if time.monotonic() - checked < self.backlog_ttl:
+            return pending
+        # Fuera del lock, un broker lento no bloquea los submit de los
+        # demás hilos
+        from gatinos.celery import app
+        with app.connection_for_write() as connection:
+            channel = connection.default_channel
+            declared = channel.queue_declare(queue=self.queue_name,
+                                             passive=True)
+        with self._lock:
+            self._backlog = (declared.message_count, time.monotonic())
+        return declared.message_count
+
+    def backlog(self):
+        if not self.available:
+            return 0
+        try:
+            return self._queue_length()
+        except Exception as exc:
+            self.mark_down(exc)
+            return 0
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(alias="default"):
+    with _backends_lock:
+        if alias not in _backends:
+            options = settings.TASK_QUEUES[alias]
+            backend_class = import_string(options["BACKEND"])
+            _backends[alias] = backend_class(alias, options)
+        return _backends[alias]
+
+
+def enqueue(task, *args, queue="default", **kwargs):
+    return get_backend(queue).submit(task, *args, **kwargs)
+
+
+def backlog():
+    """Pending tasks of every configured queue"""
+    return {alias: get_backend(alias).backlog()
+            for alias in settings.TASK_QUEUES}
+
+
+def shutdown(wait=True):
+    with _backends_lock:
+        backends = list(_backends.values())
+        _backends.clear()
+    for backend in backends:
+        backend.shutdown(wait=wait)
+
+
+atexit.register(shutdown)
+
+
+@receiver(setting_changed)
+def reset_backends(setting, **kwargs):
+    if setting == "TASK_QUEUES":
+        shutdown(wait=False)
@@ -11,7 +11,9 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
 import os
+import sys
 from pathlib import Path
+from django.core.exceptions import ImproperlyConfigured
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -135,6 +137,12 @@ USE_TZ = True
 
 LOGIN_URL = "cuentas/login"
 
+# Los permisos se compilan y se guardan en la caché, ver gatos.permisos.
+# ModelBackend sigue en la lista para no cerrar las sesiones que lo
+# guardaron, los dos comparten la caché de permisos del usuario
+AUTHENTICATION_BACKENDS = ["gatos.permisos.PermisosBackend",
+                           "django.contrib.auth.backends.ModelBackend"]
+
 GROUPS_PERMISSIONS = {
         "cuidador": ["view_colonia",
                      "view_gato",
@@ -220,10 +228,89 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 MODERNRPC_METHODS_MODULES = ["gatos.rpc"]
 
+# Cache, Redis in production and local memory for development and the
+# tests
+
+TESTING = sys.argv[1:2] == ["test"]
+
+if os.environ.get("REDIS_URL") and not TESTING:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.environ["REDIS_URL"],
+        }
+    }
+elif DEBUG or TESTING:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+else:
+    # Las versiones de gatos.versiones tienen que llegar a todos los
+    # procesos, con una caché por proceso los permisos, los accesos y las
+    # lecturas cacheadas quedarían viejos en los demás
+    raise ImproperlyConfigured("REDIS_URL is required without DEBUG")
+
+# Whether every process shares the cache. The tests run in one process,
+# in development the caches across requests are skipped
+
+CACHE_COMPARTIDA = TESTING or "redis" in CACHES["default"]["BACKEND"]
+
+# Live changes pushed to the browsers, through Redis between processes
+
+EVENTOS_REDIS_URL = None if TESTING else os.environ.get("REDIS_URL")
+
+# Seconds before a stream ends and the browser reconnects. Only served
+# with ASGI, under WSGI the events URL answers 204
+
+EVENTOS_DURACION = int(os.environ.get("EVENTOS_DURACION", default="300"))
+
+# Async read-only views, only worth it when served with ASGI
+
+ASYNC_VIEWS = os.environ.get("ASYNC_VIEWS", default="0") == "1"
+
+# Background tasks
+
+CELERY_BROKER_URL = os.environ.get("CELERY_BROKER_URL",
+                                   default="redis://redis:6379")
+CELERY_RESULT_BACKEND = os.environ.get("CELERY_RESULT_BACKEND",
+                                       default="redis://redis:6379/0")
+CELERY_TASK_IGNORE_RESULT = True
+CELERY_BROKER_CONNECTION_TIMEOUT = 2
+
+TASKS_BACKEND = os.environ.get("TASKS_BACKEND",
+                               default="gatinos.dispatch.CeleryBackend")
+
+TASK_QUEUES = {
+        "default": {
+            "BACKEND": TASKS_BACKEND,
+            "FALLBACK": "hilos",
+            "MAX_PENDING": 100,
+            },
+        "imagenes": {
+            "BACKEND": os.environ.get("TASKS_IMAGES_BACKEND",
+                                      default=TASKS_BACKEND),
+            "FALLBACK": "procesos",
+            "MAX_PENDING": 100,
+            },
+        "hilos": {
+            "BACKEND": "gatinos.dispatch.ThreadPoolBackend",
+            "WORKERS": int(os.environ.get("TASKS_THREADS", default=4)),
+            "MAX_PENDING": 100,
+            },
+        "procesos": {
+            "BACKEND": "gatinos.dispatch.ProcessPoolBackend",
+            "WORKERS": int(os.environ.get("TASKS_PROCESSES", default=2)),
+            "MAX_PENDING": 100,
+            },
+        }
+
 # Django Vite Configuration
 DJANGO_VITE = {
     "default": {
-        "dev_mode": DEBUG,  # Use Vite dev server in DEBUG mode
+        # Use Vite dev server in DEBUG mode, tests don't need the build
+        "dev_mode": DEBUG or TESTING,
         "dev_server_host": "localhost",
         "dev_server_port": 5173,
         "static_url_prefix": "/",  # No static prefix for dev server
@@ -0,0 +1,72 @@
+"""
+Colonies each user can access.
+
+The ids of the authorized colonies are loaded once and kept on the user
+object, which lives as long as the request, and in the session together
+with the versions they depend on, so the next requests of the session
+check access without any query until the authorized users change.
+The session copy needs a shared cache, see ``gatos.versiones``.
+
+    if tiene_acceso(request, colonia):
+        ...
+"""
+from .versiones import compartida, version
+
+SESION_KEY = "_colonias_autorizadas"
+
+
+class Todas:
+    """The colonies of a superuser"""
+
+    def __contains__(self, colonia_id):
+        return True
+
+    def __repr__(self):
+        return "<Todas>"
+
+
+TODAS = Todas()
+
+
+def versiones(user):
+    return [version("permisos"), version("autorizadas", user.pk)]
+
+
+def colonias_autorizadas(user, session=None):
+    """Ids of the colonies ``user`` can access, ``TODAS`` for superusers"""
+    if not user.is_authenticated or not user.is_active:
+        return frozenset()
+    if user.is_superuser:
+        return TODAS
+    ids = user.__dict__.get(SESION_KEY)
+    if ids is not None:
+        return ids
+    if not compartida():
+        session = None
+    actuales = versiones(user)
+    guardadas = session.get(SESION_KEY) if session is not None else None
+    if (guardadas and guardadas["usuario"] == user.pk
+            and guardadas["versiones"] == actuales):
+        ids = frozenset(guardadas["ids"])
+    else:
+        # La tabla intermedia basta, sin join con las colonias
+        autorizaciones = user.colonias_autorizadas.through.objects
+        ids = frozenset(autorizaciones.filter(user_id=user.pk)
+                        .values_list("colonia_id", flat=True))
+        if session is not None:
+            session[SESION_KEY] = {"usuario": user.pk, "versiones": actuales,
+                                   "ids": sorted(ids)}
+    user.__dict__[SESION_KEY] = ids
+    return ids
+
+
+def tiene_acceso(request, colonia):
+    """Whether the user of ``request`` can access ``colonia``, a colony or
+    its id"""
+    colonia_id = getattr(colonia, "pk", colonia)
+    try:
+        colonia_id = int(colonia_id)
+    except (TypeError, ValueError):
+        return False
+    session = getattr(request, "session", None)
+    return colonia_id in colonias_autorizadas(request.user, session)
@@ -1,4 +1,7 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.contrib.admin.helpers import ACTION_CHECKBOX_NAME
+from django.contrib.auth import get_user_model
+from django.template.response import TemplateResponse
 from gatinos.admin import admin_site
 from .models import (
         Gato,
@@ -10,6 +13,8 @@ from .models import (
         Anuncio
         )
 from .flows import GatoFlow
+from .forms import RotaForm
+from . import rotas
 
 
 class GatoAdmin(admin.ModelAdmin):
@@ -25,11 +30,66 @@ class ColoniaAdmin(admin.ModelAdmin):
     list_display = ('nombre', 'slug', 'get_usuarios_count')
     filter_horizontal = ('usuarios_autorizados',)
     search_fields = ('nombre', 'descripcion')
+    actions = ['generar_rota']
     
     def get_usuarios_count(self, obj):
         return obj.usuarios_autorizados.count()
     get_usuarios_count.short_description = 'Usuarios autorizados'
 
+    @admin.action(description="Generar la rota de comidas")
+    def generar_rota(self, request, queryset):
+        """Form with the range, feeders and rule, a preview of the plan of
+        each colony and, once confirmed, the rota written"""
+        alimentadores = {colonia: list(colonia.get_alimentadores()
+                                       .values_list("id", flat=True))
+                         for colonia in queryset}
+        usuarios = get_user_model().objects.filter(
+            id__in={id for ids in alimentadores.values() for id in ids}
+        ).order_by("username")
+        guardar = "guardar" in request.POST
+        if guardar or "previsualizar" in request.POST:
+            form = RotaForm(request.POST, alimentadores=usuarios)
+        else:
+            form = RotaForm(initial=RotaForm.mes_siguiente(),
+                            alimentadores=usuarios)
+        planes = []
+        if form.is_bound and form.is_valid():
+            datos = form.cleaned_data
+            elegidos = [usuario.id for usuario in datos["alimentadores"]]
+            nombres = dict(usuarios.values_list("id", "username"))
+            # La vista previa solo genera el plan, como dry_run en el RPC
+            rota = rotas.crear if guardar else rotas.generar
+            for colonia, ids in alimentadores.items():
+                try:
+                    plan = rota(colonia, datos["inicio"], datos["fin"],
+                                elegidos or ids, datos["regla"],
+                                form.semana())
+                except rotas.RotaInvalida as e:
+                    if guardar:
+                        self.message_user(request, f"{colonia}: {e}",
+                                          messages.ERROR)
+                    planes.append((colonia, str(e), []))
+                    continue
+                if guardar:
+                    self.message_user(
+                        request, f"{colonia}: {len(plan)} días asignados")
+                planes.append((colonia, None,
+                               [(fecha, nombres[usuario])
+                                for fecha, usuario in sorted(plan.items())]))
+            if guardar:
+                return None
+        context = {
+            **self.admin_site.each_context(request),
+            "title": "Generar la rota de comidas",
+            "opts": self.model._meta,
+            "form": form,
+            "planes": planes,
+            "queryset": queryset,
+            "action_checkbox_name": ACTION_CHECKBOX_NAME,
+        }
+        return TemplateResponse(request, "admin/gatos/colonia/rota.html",
+                                context)
+
 
 class FotoAdmin(admin.ModelAdmin):
     list_display = ("fecha", "usuario", "colonia", "lista_de_gatos")
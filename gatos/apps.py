@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class GatosConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'gatos'
+
+    def ready(self):
+        from . import signals
+        signals.conectar()
@@ -0,0 +1,341 @@
+"""
+Load test of the sessions of the volunteers.
+
+A session is a visit to a colony: its page, the cat roster, the roll call
+of the sightings toggling some cats, the feeding calendar RPCs and a photo
+upload. Sessions run in this process with the test client, which also
+counts the SQL of each request, or against a local server. Every toggle
+is made twice and the photos uploaded are deleted at the end, so runs over
+the same data, see ``gatos.sintetico``, can be compared between commits.
+
+The run writes to the colony, so it is meant for one nobody else uses.
+Its entries in the change feed, which would be pushed to the clients as
+real changes, and the sessions it opens are removed at the end.
+
+    resultados = cargar(Escenario(colonia), ClienteLocal(usuario),
+                        sesiones=50)
+"""
+from dataclasses import dataclass
+from datetime import date, timedelta
+from http.cookies import SimpleCookie
+import json
+import random
+import statistics
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.contrib.auth import (BACKEND_SESSION_KEY, HASH_SESSION_KEY,
+                                 SESSION_KEY)
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.client import encode_multipart
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from gatinos import dispatch
+from .models import Cambio, Foto
+from .sintetico import imagenes
+
+# Toggles de cada pasada por los avistamientos
+AVISTADOS = 3
+# Con la frontera del cliente de tests volvería a codificar el cuerpo
+FRONTERA = "GatinosCarga"
+
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(len(valores) * p / 100))]
+
+
+def crear_sesion(usuario):
+    """Cookie of a new session logged in as ``usuario``"""
+    sesion = SessionStore()
+    sesion[SESSION_KEY] = str(usuario.pk)
+    sesion[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+    sesion[HASH_SESSION_KEY] = usuario.get_session_auth_hash()
+    sesion.create()
+    return f"{settings.SESSION_COOKIE_NAME}={sesion.session_key}"
+
+
+@dataclass
+class Peticion:
+    tipo: str
+    ruta: str
+    cuerpo: bytes = None
+    content_type: str = None
+
+
+def fallida(estado, contenido):
+    """Whether the response is an error, JSON-RPC ones come with 200"""
+    if estado >= 400:
+        return True
+    if not contenido.startswith(b"{") and not contenido.startswith(b"["):
+        return False
+    try:
+        respuestas = json.loads(contenido)
+    except ValueError:
+        return False
+    if isinstance(respuestas, dict):
+        respuestas = [respuestas]
+    return any("error" in r or "error" in (r.get("result") or {})
+               for r in respuestas if isinstance(r, dict))
+
+
+def rpc(tipo, *llamadas):
+    """POST of a JSON-RPC call, a batch with more than one"""
+    cuerpo = [{"jsonrpc": "2.0", "id": i, "method": metodo, "params": params}
+              for i, (metodo, params) in enumerate(llamadas)]
+    if len(cuerpo) == 1:
+        cuerpo = cuerpo[0]
+    return Peticion(tipo, reverse("RPC"), json.dumps(cuerpo).encode(),
+                    "application/json")
+
+
+class Escenario:
+    """The requests of the sessions in ``colonia``"""
+
+    def __init__(self, colonia, semilla=1):
+        self.colonia = colonia
+        self.semilla = semilla
+        self.gatos = list(colonia.gatos_activos().values_list("slug", "id"))
+        self.imagenes = [datos for datos, _ in imagenes(semilla)]
+        hoy = date.today()
+        asignados = set(colonia.comidas.filter(fecha__gt=hoy)
+                        .values_list("fecha", flat=True))
+        self.libres = [hoy + timedelta(n) for n in range(1, 61)
+                       if hoy + timedelta(n) not in asignados]
+
+    def sesion(self, n):
+        rng = random.Random(f"{self.semilla}-{n}")
+        slug = self.colonia.slug
+        yield Peticion("colonia", reverse("colonia", kwargs={"colonia": slug}))
+        yield Peticion("gatos", reverse("gatos", kwargs={"colonia": slug}))
+        yield Peticion("avistamientos",
+                       reverse("avistamiento", kwargs={"colonia": slug}))
+        vistos = rng.sample(self.gatos, min(AVISTADOS, len(self.gatos)))
+        # Cada cambio se hace dos veces y todo queda como estaba
+        for gato_slug, _ in vistos * 2:
+            yield rpc("avistar_gato", ("avistar_gato",
+                                       {"colonia_slug": slug,
+                                        "gato_slug": gato_slug}))
+        colonia = {"colonia_id": self.colonia.id}
+        yield rpc("calendario",
+                  ("get_feeding_dates", {**colonia, "compact": True}),
+                  ("get_colony_feeding_users", colonia))
+        if self.libres:
+            dia = rng.choice(self.libres).isoformat()
+            for _ in range(2):
+                yield rpc("toggle_feeding_date",
+                          ("toggle_feeding_date", {**colonia,
+                                                   "date_str": dia}))
+        url = reverse("foto-add", kwargs={"colonia": slug})
+        yield Peticion("foto_form", url)
+        datos = {"colonia": self.colonia.id,
+                 "foto": SimpleUploadedFile(f"sesion-{n}.jpg",
+                                            rng.choice(self.imagenes),
+                                            content_type="image/jpeg")}
+        if vistos:
+            datos["gatos"] = [vistos[0][1]]
+        yield Peticion("foto_upload", url, encode_multipart(FRONTERA, datos),
+                       f"multipart/form-data; boundary={FRONTERA}")
+
+
+class ClienteLocal:
+    """Requests through the test client, counting their queries"""
+
+    def __init__(self, usuario):
+        self.usuario = usuario
+        self.lock = threading.Lock()
+
+    def nuevo(self):
+        # Un 500 cuenta como error en vez de parar la carga
+        cliente = Client(raise_request_exception=False)
+        with self.lock:
+            cliente.force_login(self.usuario)
+        return cliente
+
+    def pedir(self, cliente, peticion):
+        with CaptureQueriesContext(connection) as consultas:
+            inicio = time.perf_counter()
+            if peticion.cuerpo is None:
+                respuesta = cliente.get(peticion.ruta)
+            else:
+                respuesta = cliente.post(peticion.ruta, peticion.cuerpo,
+                                         content_type=peticion.content_type)
+            segundos = time.perf_counter() - inicio
+        return (fallida(respuesta.status_code, respuesta.content), segundos,
+                len(consultas))
+
+    def terminar(self, cliente):
+        # Borra la sesión de la base de datos
+        cliente.logout()
+        connection.close()
+
+    def esperar(self, timeout=30):
+        """Until the photos uploaded are processed"""
+        limite = time.monotonic() + timeout
+        while (dispatch.backlog().get("imagenes")
+               and time.monotonic() < limite):
+            time.sleep(0.1)
+
+
+class ClienteServidor:
+    """Requests to a running server, ``base`` like http://localhost:8000"""
+
+    def __init__(self, base, usuario):
+        self.base = base.rstrip("/")
+        self.usuario = usuario
+
+    def nuevo(self):
+        """The cookies of the session"""
+        return dict([crear_sesion(self.usuario).split("=", 1)])
+
+    def pedir(self, cookies, peticion):
+        cabeceras = {"Cookie": "; ".join(f"{k}={v}"
+                                         for k, v in cookies.items())}
+        if peticion.cuerpo is not None:
+            cabeceras["Content-Type"] = peticion.content_type
+            if settings.CSRF_COOKIE_NAME in cookies:
+                cabeceras["X-CSRFToken"] = cookies[settings.CSRF_COOKIE_NAME]
+                cabeceras["Referer"] = self.base + peticion.ruta
+        request = urllib.request.Request(self.base + peticion.ruta,
+                                         data=peticion.cuerpo,
+                                         headers=cabeceras)
+        inicio = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=30) as respuesta:
+                contenido = respuesta.read()
+                estado, recibidas = respuesta.status, respuesta.headers
+        except urllib.error.HTTPError as e:
+            contenido, estado, recibidas = b"", e.code, e.headers
+        except OSError:
+            return True, time.perf_counter() - inicio, None
+        segundos = time.perf_counter() - inicio
+        for cabecera in recibidas.get_all("Set-Cookie") or []:
+            for nombre, morsel in SimpleCookie(cabecera).items():
+                cookies[nombre] = morsel.value
+        return fallida(estado, contenido), segundos, None
+
+    def terminar(self, cookies):
+        clave = cookies.get(settings.SESSION_COOKIE_NAME)
+        if clave:
+            SessionStore(session_key=clave).delete()
+
+    def esperar(self, timeout=30):
+        pass
+
+
+def resumen(medidas, segundos):
+    """Latency, throughput and queries of each type of request"""
+    tipos = {}
+    for tipo, error, duracion, consultas in medidas:
+        tipos.setdefault(tipo, []).append((error, duracion, consultas))
+    tipos["total"] = [m[1:] for m in medidas]
+    resultado = {}
+    for tipo, filas in tipos.items():
+        tiempos = [duracion for error, duracion, _ in filas if not error]
+        consultas = [c for _, _, c in filas if c is not None]
+        resultado[tipo] = {
+            "peticiones": len(filas),
+            "errores": sum(error for error, _, _ in filas),
+            "rps": len(filas) / segundos if segundos else 0.0,
+            "media": statistics.mean(tiempos) if tiempos else 0.0,
+            "p50": percentil(tiempos, 50),
+            "p95": percentil(tiempos, 95),
+            "p99": percentil(tiempos, 99),
+            "consultas": statistics.mean(consultas) if consultas else None,
+            "consultas_max": max(consultas) if consultas else None,
+        }
+    return resultado
+
+
+def borrar_fotos(colonia, anteriores):
+    """Remove the photos uploaded during the run, ``anteriores`` are the ids
+    before it. The toggles of the sessions already leave the rest as it was"""
+    for foto in Foto.objects.filter(colonia=colonia).exclude(
+            id__in=anteriores):
+        for fichero in (foto.foto, foto.miniatura):
+            if fichero:
+                default_storage.delete(fichero.name)
+        foto.delete()
+
+
+def borrar_cambios(colonia, version):
+    """Remove the change feed entries after ``version``, those of the run,
+    which leaves the colony as it was"""
+    Cambio.objects.filter(colonia=colonia, version__gt=version).delete()
+
+
+def cargar(escenario, cliente, sesiones=20, concurrencia=1):
+    """Run ``sesiones`` sessions of ``escenario``, ``concurrencia`` at a
+    time, returns the summary by type of request"""
+    colonia = escenario.colonia
+    # Los ids de las fotos son aleatorios
+    anteriores = set(colonia.fotos.values_list("id", flat=True))
+    version = Cambio.objects.version(colonia)
+    siguiente = iter(range(sesiones))
+    lock = threading.Lock()
+    medidas = []
+
+    def trabajar():
+        sesion = cliente.nuevo()
+        try:
+            while True:
+                with lock:
+                    n = next(siguiente, None)
+                if n is None:
+                    return
+                for peticion in escenario.sesion(n):
+                    error, segundos, consultas = cliente.pedir(sesion,
+                                                               peticion)
+                    with lock:
+                        medidas.append((peticion.tipo, error, segundos,
+                                        consultas))
+        finally:
+            cliente.terminar(sesion)
+
+    hosts = [*settings.ALLOWED_HOSTS, "testserver"]
+    with override_settings(ALLOWED_HOSTS=hosts):
+        inicio = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrencia) as pool:
+            for futuro in [pool.submit(trabajar)
+                           for _ in range(concurrencia)]:
+                futuro.result()
+        segundos = time.perf_counter() - inicio
+    cliente.esperar()
+    borrar_fotos(colonia, anteriores)
+    borrar_cambios(colonia, version)
+    return resumen(medidas, segundos)
+
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def comparar(anterior, actual):
+    """Relative change of p50, p95 and queries of each request type,
+    ``None`` where a run has no value"""
+    cambios = {}
+    for tipo, datos in actual.items():
+        antes = anterior.get(tipo)
+        if antes is None:
+            continue
+        cambios[tipo] = {}
+        for medida in ("p50", "p95", "consultas"):
+            a, b = antes.get(medida), datos.get(medida)
+            cambios[tipo][medida] = (b - a) / a if a and b is not None \
+                else None
+    return cambios
@@ -3,7 +3,8 @@ Custom decorators for access control in the gatos app
 """
 from functools import wraps
 from django.core.exceptions import PermissionDenied
-from django.shortcuts import get_object_or_404
+from .accesos import tiene_acceso
+from .identidad import cargar_o_404
 from .models import Colonia
 
 
@@ -47,37 +48,32 @@ def colony_access_required(view_func=None, get_colony_id=None):
             if user.is_superuser:
                 return func(request_or_self, *args, **kwargs)
             
-            # Get colony identifier
+            # Colonies given by id are checked without loading them
             colony_identifier = None
-            
             if get_colony_id:
-                # Custom function to get colony ID
                 colony_identifier = get_colony_id(view_kwargs)
-                if colony_identifier:
-                    try:
-                        colonia = Colonia.objects.get(id=colony_identifier)
-                    except (Colonia.DoesNotExist, ValueError):
-                        colonia = None
-                else:
-                    colonia = None
-            elif 'colonia' in view_kwargs:
+            elif 'colonia_id' in view_kwargs:
+                colony_identifier = view_kwargs['colonia_id']
+            
+            if colony_identifier:
+                if not tiene_acceso(request, colony_identifier):
+                    raise PermissionDenied("No tiene acceso a la colonia")
+                return func(request_or_self, *args, **kwargs)
+            
+            if 'colonia' in view_kwargs:
                 # Colony slug in kwargs
-                colonia = get_object_or_404(Colonia, slug=view_kwargs['colonia'])
+                colonia = cargar_o_404(request, Colonia, slug=view_kwargs['colonia'])
             elif 'colonia_slug' in view_kwargs:
                 # Colony slug with different name
-                colonia = get_object_or_404(Colonia, slug=view_kwargs['colonia_slug'])
-            elif 'colonia_id' in view_kwargs:
-                # Colony ID in kwargs
-                colonia = get_object_or_404(Colonia, id=view_kwargs['colonia_id'])
-            else:
+                colonia = cargar_o_404(request, Colonia, slug=view_kwargs['colonia_slug'])
+            elif hasattr(request_or_self, 'colonia'):
                 # Try to get from self (class-based views)
-                if hasattr(request_or_self, 'colonia'):
-                    colonia = request_or_self.colonia
-                else:
-                    raise ValueError("Cannot determine colony from request")
+                colonia = request_or_self.colonia
+            else:
+                raise ValueError("Cannot determine colony from request")
             
             # Check access
-            if colonia and not colonia.user_has_access(user):
+            if not tiene_acceso(request, colonia):
                 raise PermissionDenied(f"No tiene acceso a la colonia '{colonia.nombre}'")
             
             return func(request_or_self, *args, **kwargs)
@@ -124,16 +120,9 @@ def require_colony_permission(permission_name):
             if user.is_superuser:
                 return func(*args, **kwargs)
             
-            # Check colony access
-            colonia = None
-            if 'colonia_id' in kwargs:
-                try:
-                    from .models import Colonia
-                    colonia = Colonia.objects.get(id=kwargs['colonia_id'])
-                    if not colonia.user_has_access(user):
-                        raise PermissionDenied(f"No tiene acceso a la colonia '{colonia.nombre}'")
-                except Colonia.DoesNotExist:
-                    raise PermissionDenied("Colonia no encontrada")
+            # Check colony access, an in-memory lookup
+            if 'colonia_id' in kwargs and not tiene_acceso(request, kwargs['colonia_id']):
+                raise PermissionDenied("No tiene acceso a la colonia")
             
             # Check specific permission
             if not user.has_perm(permission_name):
@@ -0,0 +1,196 @@
+"""
+Push of the feeding and sighting changes of a colony to the browsers.
+
+After a write commits, ``avisar`` publishes the changes as they come in
+the change feed (see ``sincronizacion.cambios``). Subscribers are
+asyncio queues of the SSE views of this process. With ``EVENTOS_REDIS_URL``
+the messages go through Redis and every process relays them to its own
+subscribers.
+
+A stream ends after ``EVENTOS_DURACION`` seconds, five minutes by
+default, and the browser reconnects with the id of the last event without
+missing anything, so a client that went away without closing doesn't
+hold a subscriber forever.
+
+    async for mensaje in escuchar(colonia.id):
+        ...
+"""
+import asyncio
+import json
+import logging
+import threading
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+CANAL = "gatinos:colonia:{}"
+MODELOS = ("asignacioncomida", "avistamiento")
+MAX_PENDIENTES = 100
+KEEPALIVE = 25
+DURACION = 300
+
+
+class Bus:
+    """In-process subscribers by colony, safe to publish from any thread"""
+
+    def __init__(self):
+        self.suscriptores = {}
+        self.lock = threading.Lock()
+
+    def suscribir(self, colonia_id):
+        cola = asyncio.Queue(maxsize=MAX_PENDIENTES)
+        suscripcion = (asyncio.get_running_loop(), cola)
+        with self.lock:
+            self.suscriptores.setdefault(colonia_id, set()).add(suscripcion)
+        return suscripcion
+
+    def cancelar(self, colonia_id, suscripcion):
+        with self.lock:
+            suscripciones = self.suscriptores.get(colonia_id, set())
+            suscripciones.discard(suscripcion)
+            if not suscripciones:
+                self.suscriptores.pop(colonia_id, None)
+
+    def entregar(self, colonia_id, mensaje):
+        with self.lock:
+            suscripciones = list(self.suscriptores.get(colonia_id, ()))
+        for loop, cola in suscripciones:
+            try:
+                loop.call_soon_threadsafe(poner, cola, mensaje)
+            except RuntimeError:
+                # El bucle ya se cerró
+                self.cancelar(colonia_id, (loop, cola))
+
+
+def poner(cola, mensaje):
+    if cola.full():
+        # Un cliente que no da abasto vuelve a pedirlo todo
+        while not cola.empty():
+            cola.get_nowait()
+        mensaje = json.dumps({"reset": True})
+    cola.put_nowait(mensaje)
+
+
+bus = Bus()
+
+
+# ------------------------------------------------------------------------
+#                Redis
+# ------------------------------------------------------------------------
+
+
+_redis = None
+_escuchas = {}
+
+
+def redis_url():
+    return getattr(settings, "EVENTOS_REDIS_URL", None)
+
+
+def publicar_redis(colonia_id, mensaje):
+    global _redis
+    if _redis is None:
+        import redis
+        _redis = redis.Redis.from_url(redis_url())
+    _redis.publish(CANAL.format(colonia_id), mensaje)
+
+
+async def reenviar():
+    """Relay the messages of every process to the subscribers of this one"""
+    import redis.asyncio
+    conexion = redis.asyncio.Redis.from_url(redis_url())
+    pubsub = conexion.pubsub()
+    await pubsub.psubscribe(CANAL.format("*"))
+    async for mensaje in pubsub.listen():
+        if mensaje["type"] != "pmessage":
+            continue
+        colonia_id = int(mensaje["channel"].decode().rsplit(":", 1)[1])
+        bus.entregar(colonia_id, mensaje["data"].decode())
+
+
+def escuchar_redis():
+    loop = asyncio.get_running_loop()
+    tarea = _escuchas.get(loop)
+    if tarea is None or tarea.done():
+        _escuchas[loop] = loop.create_task(reenviar())
+
+
+# ------------------------------------------------------------------------
+#                Publicación
+# ------------------------------------------------------------------------
+
+
+def publicar(colonia_id, datos):
+    mensaje = json.dumps(datos, cls=DjangoJSONEncoder)
+    if redis_url():
+        publicar_redis(colonia_id, mensaje)
+    else:
+        bus.entregar(colonia_id, mensaje)
+
+
+_pendientes = threading.local()
+
+
+def avisar(colonia_id, modelo, desde):
+    """Publish the changes after version ``desde`` once the transaction
+    commits, the writes of a transaction go in one message"""
+    if modelo not in MODELOS:
+        return
+    pendientes = _pendientes.__dict__.setdefault("colonias", {})
+    pendientes[colonia_id] = min(desde, pendientes.get(colonia_id, desde))
+    # El primero que se ejecute se lleva todos, si la transacción se
+    # deshace lo pendiente sale con la siguiente y no cambia nada
+    transaction.on_commit(enviar)
+
+
+def enviar():
+    from .models import Colonia
+    from .sincronizacion import cambios
+    pendientes = _pendientes.__dict__.pop("colonias", {})
+    if not redis_url():
+        # Sin nadie escuchando en este proceso no hay nada que calcular
+        pendientes = {colonia_id: desde
+                      for colonia_id, desde in pendientes.items()
+                      if colonia_id in bus.suscriptores}
+    if not pendientes:
+        return
+    for colonia in Colonia.objects.filter(id__in=pendientes):
+        try:
+            publicar(colonia.id, cambios(colonia, pendientes[colonia.id],
+                                         modelos=MODELOS))
+        except Exception:
+            # El cambio ya está guardado, los clientes se pondrán al día
+            logger.exception("No se pudo publicar el cambio de %s", colonia)
+
+
+async def escuchar(colonia_id, antes=None, duracion=None):
+    """Messages for the colony, ``None`` every ``KEEPALIVE`` seconds
+    without any, until ``duracion`` seconds, by default
+    ``EVENTOS_DURACION``.
+
+    ``antes`` is awaited once subscribed, what it returns goes first, so
+    nothing published meanwhile is lost.
+    """
+    if redis_url():
+        escuchar_redis()
+    suscripcion = bus.suscribir(colonia_id)
+    loop, cola = suscripcion
+    if duracion is None:
+        duracion = getattr(settings, "EVENTOS_DURACION", DURACION)
+    fin = loop.time() + duracion
+    try:
+        if antes is not None:
+            mensaje = await antes()
+            if mensaje is not None:
+                yield mensaje
+        while (queda := fin - loop.time()) > 0:
+            try:
+                yield await asyncio.wait_for(cola.get(),
+                                             min(KEEPALIVE, queda))
+            except asyncio.TimeoutError:
+                if queda > KEEPALIVE:
+                    yield None
+    finally:
+        bus.cancelar(colonia_id, suscripcion)
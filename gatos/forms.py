@@ -1,5 +1,6 @@
-from datetime import date
+from datetime import date, timedelta
 from django import forms
+from django.contrib.auth import get_user_model
 from .data import vacunas
 from .models import (Foto,
                      Gato,
@@ -8,6 +9,7 @@ from .models import (Foto,
                      Informe,
                      Vacunacion,
                      )
+from .rotas import MAX_DIAS
 
 
 class CustomCheckboxSelectMultiple(forms.CheckboxSelectMultiple):
@@ -35,7 +37,7 @@ class FotoBaseForm(forms.ModelForm):
         self.fields["colonia"].initial = colonia
         self.fields["colonia"].widget.attrs['readonly'] = True
         self.fields["colonia"].widget.attrs['class'] = "galeria-fotos"
-        self.fields["gatos"].queryset = colonia.gatos
+        self.fields["gatos"].queryset = colonia.gatos.galeria()
 
 
 class FotoCreateForm(FotoBaseForm):
@@ -90,7 +92,7 @@ class InformeForm(forms.ModelForm):
         super().__init__(*args, **kwargs)
         self.fields["colonia"].initial = colonia
         self.fields["colonia"].widget.attrs['readonly'] = True
-        self.fields["gatos"].queryset = colonia.gatos
+        self.fields["gatos"].queryset = colonia.gatos.galeria()
 
 
 class CapturaForm(forms.ModelForm):
@@ -139,3 +141,41 @@ class VacunarGatoForm(forms.ModelForm):
         vacuna = vacunas[tipo]
         self.instance.efecto = vacuna.efecto
         super().save(commit=commit)
+
+
+class RotaForm(forms.Form):
+    """Rota of the admin action of the colonies, see ``rotas.generar``"""
+    REGLAS = [("huecos", "Repartir los días libres"),
+              ("round_robin", "Por turnos, reemplazando lo asignado"),
+              ("dias_semana", "Por días de la semana")]
+    DIAS = ["Lunes", "Martes", "Miércoles", "Jueves", "Viernes", "Sábado",
+            "Domingo"]
+
+    inicio = forms.DateField(widget=forms.DateInput(attrs={"type": "date"}))
+    fin = forms.DateField(widget=forms.DateInput(attrs={"type": "date"}),
+                          help_text=f"Incluido, como mucho {MAX_DIAS} días")
+    regla = forms.ChoiceField(choices=REGLAS, initial="huecos")
+    alimentadores = forms.ModelMultipleChoiceField(
+        queryset=get_user_model().objects.none(), required=False,
+        widget=forms.CheckboxSelectMultiple,
+        help_text="Sin ninguno, todos los de cada colonia")
+
+    def __init__(self, *args, **kwargs):
+        alimentadores = kwargs.pop("alimentadores")
+        super().__init__(*args, **kwargs)
+        self.fields["alimentadores"].queryset = alimentadores
+        for n, dia in enumerate(self.DIAS):
+            self.fields[f"dia_{n}"] = forms.ModelChoiceField(
+                alimentadores, required=False, label=dia)
+
+    @staticmethod
+    def mes_siguiente():
+        siguiente = date.today().replace(day=1) + timedelta(days=32)
+        inicio = siguiente.replace(day=1)
+        fin = (inicio + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+        return {"inicio": inicio, "fin": fin}
+
+    def semana(self):
+        """Weekdays and user ids of the ``dias_semana`` rule"""
+        return {n: usuario.id for n in range(7)
+                if (usuario := self.cleaned_data.get(f"dia_{n}"))}
@@ -0,0 +1,92 @@
+"""
+Objects loaded once per request.
+
+The map lives on the request, keyed by model and by each unique field of
+the object, so a colony loaded by slug is also found by id. Foreign keys
+of the objects that go in the map point to the instances already there,
+``gato.colonia`` in ``get_absolute_url`` does not load the colony again.
+
+    colonia = cargar_o_404(request, Colonia, slug=slug)
+
+Lookups restricted to what the user can see, like ``for_user``, go under
+an ``ambito`` of their own. What they load is also found by unrestricted
+lookups, never the other way round.
+"""
+from django.db.models import Model
+from django.http import Http404
+
+ATRIBUTO = "_identidad"
+
+
+def mapa(request):
+    if request is None:
+        return {}
+    return request.__dict__.setdefault(ATRIBUTO, {})
+
+
+def claves(objeto, ambito):
+    opciones = objeto._meta
+    for campo in opciones.concrete_fields:
+        if campo.unique:
+            yield (ambito, opciones.label, campo.attname,
+                   getattr(objeto, campo.attname))
+
+
+def enlazar(objetos, objeto):
+    """Point the foreign keys of ``objeto`` to the loaded instances"""
+    for campo in objeto._meta.concrete_fields:
+        if not campo.many_to_one or campo.is_cached(objeto):
+            continue
+        clave = (None, campo.related_model._meta.label,
+                 campo.target_field.attname, getattr(objeto, campo.attname))
+        if clave in objetos:
+            campo.set_cached_value(objeto, objetos[clave])
+
+
+def registrar(request, objeto, ambito=None):
+    objetos = mapa(request)
+    enlazar(objetos, objeto)
+    for a in {None, ambito}:
+        objetos.update((clave, objeto) for clave in claves(objeto, a))
+    return objeto
+
+
+def buscar(request, modelo, ambito, lookup):
+    (campo, valor), = lookup.items()
+    if campo == "pk":
+        campo = modelo._meta.pk.attname
+    return mapa(request).get((ambito, modelo._meta.label, campo, valor))
+
+
+def consulta(modelo_o_queryset):
+    if isinstance(modelo_o_queryset, type) and \
+            issubclass(modelo_o_queryset, Model):
+        return modelo_o_queryset._default_manager.all()
+    return modelo_o_queryset
+
+
+def cargar(request, modelo_o_queryset, ambito=None, **lookup):
+    """Object with the unique field of ``lookup``, only queried the first
+    time in the request. Raises ``DoesNotExist`` like ``get``."""
+    queryset = consulta(modelo_o_queryset)
+    objeto = buscar(request, queryset.model, ambito, lookup)
+    if objeto is None:
+        objeto = registrar(request, queryset.get(**lookup), ambito)
+    return objeto
+
+
+async def acargar(request, modelo_o_queryset, ambito=None, **lookup):
+    queryset = consulta(modelo_o_queryset)
+    objeto = buscar(request, queryset.model, ambito, lookup)
+    if objeto is None:
+        objeto = registrar(request, await queryset.aget(**lookup), ambito)
+    return objeto
+
+
+def cargar_o_404(request, modelo_o_queryset, ambito=None, **lookup):
+    queryset = consulta(modelo_o_queryset)
+    try:
+        return cargar(request, queryset, ambito, **lookup)
+    except queryset.model.DoesNotExist:
+        raise Http404(f"No {queryset.model._meta.object_name} matches "
+                      f"the given query.")
@@ -0,0 +1,147 @@
+import json
+import os
+import statistics
+import subprocess
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from gatos.carga import crear_sesion, percentil
+from gatos.models import Colonia
+
+SERVIDORES = {
+    "wsgi": (["gunicorn", "gatinos.wsgi"], {"ASYNC_VIEWS": "0"}, "/rpc/"),
+    "asgi": (["gunicorn", "gatinos.asgi", "-k",
+              "uvicorn.workers.UvicornWorker"], {"ASYNC_VIEWS": "1"},
+             "/rpc/async/"),
+}
+
+
+class Command(BaseCommand):
+    help = ("Compares the throughput of the read-only pages and RPC calls "
+            "served with WSGI and with ASGI under concurrent load")
+
+    def add_arguments(self, parser):
+        parser.add_argument("colonia", help="Slug of the colony to read")
+        parser.add_argument("--usuario", required=True,
+                            help="User whose session makes the requests")
+        parser.add_argument("--peticiones", type=int, default=500)
+        parser.add_argument("--concurrencia", type=int, default=50)
+        parser.add_argument("--workers", type=int, default=2,
+                            help="Gunicorn workers of each server")
+        parser.add_argument("--puerto", type=int, default=8765)
+        parser.add_argument("--url", action="append", default=[],
+                            metavar="NOMBRE=URL",
+                            help="Use a running server instead of starting "
+                                 "one, e.g. asgi=http://localhost:8001")
+        parser.add_argument("--json", action="store_true",
+                            help="Print the results as JSON")
+
+    def handle(self, *args, **options):
+        try:
+            colonia = Colonia.objects.get(slug=options["colonia"])
+        except Colonia.DoesNotExist:
+            raise CommandError(f"No existe la colonia {options['colonia']}")
+        usuario = get_user_model().objects.get(username=options["usuario"])
+        cookie = crear_sesion(usuario)
+        urls = dict(u.split("=", 1) for u in options["url"])
+        resultados = {}
+        for puerto, (nombre, (comando, entorno, rpc)) in enumerate(
+                SERVIDORES.items(), start=options["puerto"]):
+            proceso = None
+            base = urls.get(nombre)
+            if base is None:
+                base = f"http://127.0.0.1:{puerto}"
+                proceso = self.arrancar(comando, entorno, puerto,
+                                        options["workers"])
+            try:
+                self.esperar(base)
+                peticiones = self.peticiones(base, rpc, colonia, cookie)
+                resultados[nombre] = self.cargar(peticiones,
+                                                 options["peticiones"],
+                                                 options["concurrencia"])
+            finally:
+                if proceso is not None:
+                    proceso.terminate()
+                    proceso.wait()
+        if options["json"]:
+            self.stdout.write(json.dumps(resultados, indent=2))
+            return
+        for nombre, datos in resultados.items():
+            self.stdout.write(
+                f"{nombre}: {datos['rps']:.1f} peticiones/s, "
+                f"p50 {datos['p50'] * 1000:.0f} ms, "
+                f"p95 {datos['p95'] * 1000:.0f} ms, "
+                f"p99 {datos['p99'] * 1000:.0f} ms, "
+                f"{datos['errores']} errores")
+
+    def arrancar(self, comando, entorno, puerto, workers):
+        env = {**os.environ, **entorno}
+        comando = [*comando, "-b", f"127.0.0.1:{puerto}", "-w", str(workers)]
+        try:
+            return subprocess.Popen(comando, env=env,
+                                    stdout=subprocess.DEVNULL,
+                                    stderr=subprocess.DEVNULL)
+        except FileNotFoundError:
+            raise CommandError(f"No se puede ejecutar {comando[0]}")
+
+    def esperar(self, base, timeout=20):
+        limite = time.monotonic() + timeout
+        while time.monotonic() < limite:
+            try:
+                urllib.request.urlopen(base + "/", timeout=1)
+                return
+            except urllib.error.HTTPError:
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise CommandError(f"El servidor {base} no responde")
+
+    def peticiones(self, base, rpc, colonia, cookie):
+        """The mix of a volunteer opening the colony page"""
+        cabeceras = {"Cookie": cookie}
+        llamadas = json.dumps([
+            {"jsonrpc": "2.0", "id": 1, "method": "get_feeding_dates",
+             "params": {"colonia_id": colonia.id, "compact": True}},
+            {"jsonrpc": "2.0", "id": 2, "method": "get_colony_feeding_users",
+             "params": {"colonia_id": colonia.id}},
+            {"jsonrpc": "2.0", "id": 3, "method": "get_colony_activity",
+             "params": {"colonia_slug": colonia.slug}},
+        ]).encode()
+        return [
+            urllib.request.Request(base + colonia.get_absolute_url(),
+                                   headers=cabeceras),
+            urllib.request.Request(base + rpc, data=llamadas,
+                                   headers={**cabeceras, "Content-Type":
+                                            "application/json"}),
+        ]
+
+    def cargar(self, peticiones, total, concurrencia):
+        def pedir(i):
+            inicio = time.perf_counter()
+            try:
+                with urllib.request.urlopen(peticiones[i % len(peticiones)],
+                                            timeout=30) as respuesta:
+                    respuesta.read()
+                error = False
+            except OSError:
+                error = True
+            return time.perf_counter() - inicio, error
+
+        inicio = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrencia) as pool:
+            medidas = list(pool.map(pedir, range(total)))
+        duracion = time.perf_counter() - inicio
+        tiempos = [t for t, error in medidas if not error]
+        return {
+            "peticiones": total,
+            "errores": sum(error for _, error in medidas),
+            "segundos": duracion,
+            "rps": total / duracion,
+            "media": statistics.mean(tiempos) if tiempos else 0.0,
+            "p50": percentil(tiempos, 50),
+            "p95": percentil(tiempos, 95),
+            "p99": percentil(tiempos, 99),
+        }
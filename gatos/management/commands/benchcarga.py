@@ -0,0 +1,99 @@
+import json
+from datetime import datetime
+from pathlib import Path
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from gatos.carga import (ClienteLocal, ClienteServidor, Escenario, cargar,
+                         commit, comparar)
+from gatos.models import Colonia
+
+
+class Command(BaseCommand):
+    help = ("Replays volunteer sessions on a colony and reports the latency, "
+            "throughput and SQL queries of each type of request. The "
+            "sessions write to the colony and undo their changes, use a "
+            "colony nobody else is using, e.g. one made by sembrar: its "
+            "change feed entries after the start of the run are deleted, "
+            "as are the login sessions opened")
+
+    def add_arguments(self, parser):
+        parser.add_argument("colonia", help="Slug of the colony to visit")
+        parser.add_argument("--usuario",
+                            help="User of the sessions, by default the "
+                                 "first one authorized in the colony")
+        parser.add_argument("--sesiones", type=int, default=20)
+        parser.add_argument("--concurrencia", type=int, default=1)
+        parser.add_argument("--semilla", type=int, default=1)
+        parser.add_argument("--url",
+                            help="Server to load, e.g. http://localhost:8000, "
+                                 "by default the requests run in this "
+                                 "process and their queries are counted")
+        parser.add_argument("--salida", type=Path,
+                            help="Write the results to this JSON file")
+        parser.add_argument("--comparar", type=Path, metavar="JSON",
+                            help="Results of a previous run to compare with")
+        parser.add_argument("--json", action="store_true",
+                            help="Print the results as JSON")
+
+    def handle(self, *args, **options):
+        try:
+            colonia = Colonia.objects.get(slug=options["colonia"])
+        except Colonia.DoesNotExist:
+            raise CommandError(f"No existe la colonia {options['colonia']}")
+        usuario = self.usuario(colonia, options["usuario"])
+        if options["url"]:
+            cliente = ClienteServidor(options["url"], usuario)
+        else:
+            cliente = ClienteLocal(usuario)
+        escenario = Escenario(colonia, semilla=options["semilla"])
+        resultados = cargar(escenario, cliente, sesiones=options["sesiones"],
+                            concurrencia=options["concurrencia"])
+        informe = {
+            "commit": commit(),
+            "fecha": datetime.now().isoformat(timespec="seconds"),
+            "colonia": colonia.slug,
+            "servidor": options["url"],
+            "sesiones": options["sesiones"],
+            "concurrencia": options["concurrencia"],
+            "semilla": options["semilla"],
+            "resultados": resultados,
+        }
+        if options["comparar"]:
+            anterior = json.loads(options["comparar"].read_text())
+            informe["cambios"] = comparar(anterior["resultados"], resultados)
+            informe["comparado_con"] = anterior.get("commit")
+        if options["salida"]:
+            options["salida"].write_text(json.dumps(informe, indent=2))
+        if options["json"]:
+            self.stdout.write(json.dumps(informe, indent=2))
+            return
+        self.mostrar(informe)
+
+    def usuario(self, colonia, username):
+        if username is not None:
+            try:
+                return get_user_model().objects.get(username=username)
+            except get_user_model().DoesNotExist:
+                raise CommandError(f"No existe el usuario {username}")
+        usuario = colonia.usuarios_autorizados.order_by("id").first()
+        if usuario is None:
+            raise CommandError("La colonia no tiene usuarios autorizados, "
+                               "indique uno con --usuario")
+        return usuario
+
+    def mostrar(self, informe):
+        cambios = informe.get("cambios", {})
+        for tipo, datos in informe["resultados"].items():
+            linea = (f"{tipo}: {datos['peticiones']} peticiones, "
+                     f"{datos['rps']:.1f}/s, "
+                     f"p50 {datos['p50'] * 1000:.1f} ms, "
+                     f"p95 {datos['p95'] * 1000:.1f} ms, "
+                     f"p99 {datos['p99'] * 1000:.1f} ms")
+            if datos["consultas"] is not None:
+                linea += f", {datos['consultas']:.1f} consultas"
+            if datos["errores"]:
+                linea += f", {datos['errores']} errores"
+            cambio = cambios.get(tipo, {})
+            if cambio.get("p95") is not None:
+                linea += f" (p95 {cambio['p95']:+.0%})"
+            self.stdout.write(linea)
@@ -0,0 +1,95 @@
+import json
+from datetime import datetime
+from pathlib import Path
+import platform
+from django.core.management.base import BaseCommand, CommandError
+from gatos.carga import commit
+from gatos.micro import CASOS, comparar, medir, perfilar
+
+
+class Command(BaseCommand):
+    help = ("Times the pure Python hot paths over several input sizes and "
+            "compares them with a stored baseline")
+
+    def add_arguments(self, parser):
+        parser.add_argument("casos", nargs="*", metavar="caso",
+                            help=f"Cases to run, by default all of them: "
+                                 f"{', '.join(CASOS)}")
+        parser.add_argument("--tamano", type=int, action="append",
+                            dest="tamanos",
+                            help="Input size, instead of those of each case")
+        parser.add_argument("--repeticiones", type=int, default=20)
+        parser.add_argument("--minimo", type=float, default=0.05,
+                            help="Minimum seconds of each repetition")
+        parser.add_argument("--salida", type=Path,
+                            help="Write the results to this JSON file, "
+                                 "a baseline for later runs")
+        parser.add_argument("--comparar", type=Path, metavar="JSON",
+                            help="Baseline to compare with")
+        parser.add_argument("--alfa", type=float, default=0.01,
+                            help="Significance level of the comparison")
+        parser.add_argument("--umbral", type=float, default=0.05,
+                            help="Smallest slowdown of the median reported")
+        parser.add_argument("--sin-normalizar", action="store_false",
+                            dest="normalizar",
+                            help="Compare the raw times, without dividing "
+                                 "them by those of the reference case")
+        parser.add_argument("--perfil", choices=["cprofile", "tracemalloc"],
+                            help="Attach the output of this profiler to "
+                                 "each case and size")
+        parser.add_argument("--fallar", action="store_true",
+                            help="Exit with an error if a case is slower")
+        parser.add_argument("--json", action="store_true",
+                            help="Print the results as JSON")
+
+    def handle(self, *args, **options):
+        try:
+            resultados = medir(options["casos"], options["repeticiones"],
+                               options["minimo"], options["tamanos"])
+        except KeyError as e:
+            raise CommandError(e.args[0])
+        if options["perfil"]:
+            for nombre, tamanos in resultados.items():
+                for tamano, medida in tamanos.items():
+                    medida["perfil"] = perfilar(nombre, int(tamano),
+                                                options["perfil"])
+        informe = {
+            "commit": commit(),
+            "fecha": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "resultados": resultados,
+        }
+        if options["comparar"]:
+            base = json.loads(options["comparar"].read_text())
+            informe["cambios"] = comparar(base["resultados"], resultados,
+                                          options["alfa"], options["umbral"],
+                                          options["normalizar"])
+            informe["comparado_con"] = base.get("commit")
+        if options["salida"]:
+            options["salida"].write_text(json.dumps(informe, indent=2))
+        if options["json"]:
+            self.stdout.write(json.dumps(informe, indent=2))
+        else:
+            self.mostrar(informe)
+        regresiones = [c for c in informe.get("cambios", [])
+                       if c["regresion"]]
+        if options["fallar"] and regresiones:
+            raise CommandError(f"{len(regresiones)} casos más lentos que en "
+                               f"{informe['comparado_con']}")
+
+    def mostrar(self, informe):
+        cambios = {(c["caso"], c["tamano"]): c
+                   for c in informe.get("cambios", [])}
+        for nombre, tamanos in informe["resultados"].items():
+            for tamano, medida in tamanos.items():
+                linea = (f"{nombre}[{tamano}]: "
+                         f"{medida['mediana'] * 1e6:.1f} µs")
+                cambio = cambios.get((nombre, tamano))
+                if cambio is not None:
+                    linea += (f" ({cambio['cambio']:+.1%}, "
+                              f"p={cambio['p']:.3f})")
+                    if cambio["regresion"]:
+                        linea += " MÁS LENTO"
+                self.stdout.write(linea)
+                if "perfil" in medida:
+                    self.stdout.write(medida["perfil"])
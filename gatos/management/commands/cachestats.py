@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from gatos import rpc  # noqa: F401 registra las funciones cacheadas
+from gatos.versiones import estadisticas
+
+
+class Command(BaseCommand):
+    help = "Shows the hit rate of the cached RPC reads"
+
+    def handle(self, *args, **options):
+        for nombre, datos in estadisticas().items():
+            self.stdout.write(f"{nombre}: {datos['aciertos']} aciertos, "
+                              f"{datos['fallos']} fallos, "
+                              f"{datos['esperas']} esperas "
+                              f"({datos['ratio']:.0%})")
@@ -0,0 +1,32 @@
+from datetime import timedelta
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from gatos.media import recoger_basura
+
+
+class Command(BaseCommand):
+    help = "Quarantines orphaned media files and purges the old quarantine"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--retencion", type=int, default=7,
+                            help="Days a file stays in quarantine")
+        parser.add_argument("--margen", type=int, default=60,
+                            help="Minutes before a new file can be orphan")
+        parser.add_argument("--batch-size", type=int, default=500,
+                            help="Files checked against the database at once")
+        parser.add_argument("--dry-run", action="store_true",
+                            help="Only report what would be done")
+
+    def handle(self, *args, **options):
+        informe = recoger_basura(
+                default_storage,
+                retencion=timedelta(days=options["retencion"]),
+                margen=timedelta(minutes=options["margen"]),
+                batch_size=options["batch_size"],
+                dry_run=options["dry_run"])
+        self.stdout.write(f"Puestos en cuarentena: {informe['en_cuarentena']}"
+                          f" ({informe['bytes_en_cuarentena']} bytes)")
+        self.stdout.write(self.style.SUCCESS(
+            f"Borrados: {informe['borrados']}"
+            f" ({informe['bytes_liberados']} bytes liberados)"))
@@ -0,0 +1,44 @@
+import time
+
+from django.core.management.base import BaseCommand
+from gatos.media import CAMPOS, reubicar
+from gatos.models import Foto
+
+
+class Command(BaseCommand):
+    help = "Moves photos and thumbnails to the hashed directory layout"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100,
+                            help="Photos processed per batch")
+        parser.add_argument("--pause", type=float, default=1.0,
+                            help="Seconds to sleep between batches")
+        parser.add_argument("--desde", default="",
+                            help="Resume after this photo id")
+        parser.add_argument("--dry-run", action="store_true",
+                            help="Only report what would be moved")
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        ultimo = options["desde"]
+        movidos = 0
+        while True:
+            lote = list(Foto.objects.filter(pk__gt=ultimo)
+                        .only("pk", *CAMPOS)
+                        .order_by("pk")[:batch_size])
+            if not lote:
+                break
+            for foto in lote:
+                for campo in CAMPOS:
+                    nuevo = reubicar(foto, campo,
+                                     dry_run=options["dry_run"])
+                    if nuevo is not None:
+                        movidos += 1
+                        self.stdout.write(f"{foto.pk}: {nuevo}")
+            ultimo = lote[-1].pk
+            # Permite retomar la migración con --desde si se interrumpe
+            self.stdout.write(f"Lote terminado en {ultimo}")
+            if len(lote) < batch_size:
+                break
+            time.sleep(options["pause"])
+        self.stdout.write(self.style.SUCCESS(f"Ficheros movidos: {movidos}"))
@@ -0,0 +1,47 @@
+import time
+from datetime import date
+from django.core.management.base import BaseCommand, CommandError
+from gatos.sintetico import sembrar
+
+
+class Command(BaseCommand):
+    help = ("Generates synthetic colonies with years of history to "
+            "benchmark against, the same seed gives the same data")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--colonias", type=int, default=3)
+        parser.add_argument("--gatos", type=int, default=300,
+                            help="Cats of each colony")
+        parser.add_argument("--dias", type=int, default=2 * 365,
+                            help="Days of history")
+        parser.add_argument("--voluntarios", type=int, default=8,
+                            help="Volunteers of each colony")
+        parser.add_argument("--semilla", type=int, default=1)
+        parser.add_argument("--hasta", type=date.fromisoformat,
+                            help="Last day of the history, YYYY-MM-DD, "
+                                 "today by default")
+        parser.add_argument("--prefijo", default="sintetica",
+                            help="The colonies are named PREFIJO-N")
+        parser.add_argument("--sin-imagenes", action="store_true",
+                            help="Don't write the image files of the photos")
+        parser.add_argument("--batch-size", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        inicio = time.perf_counter()
+        try:
+            informe = sembrar(colonias=options["colonias"],
+                              gatos=options["gatos"],
+                              dias=options["dias"],
+                              voluntarios=options["voluntarios"],
+                              semilla=options["semilla"],
+                              hasta=options["hasta"],
+                              prefijo=options["prefijo"],
+                              con_imagenes=not options["sin_imagenes"],
+                              batch_size=options["batch_size"])
+        except ValueError as e:
+            raise CommandError(str(e))
+        for modelo, total in informe.items():
+            self.stdout.write(f"{modelo}: {total}")
+        self.stdout.write(self.style.SUCCESS(
+            f"{sum(informe.values())} filas en "
+            f"{time.perf_counter() - inicio:.1f} s"))
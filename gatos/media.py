@@ -0,0 +1,201 @@
+"""
+Helpers to manage the files stored for the photos of the colonies.
+"""
+import hashlib
+import logging
+from datetime import timedelta
+from itertools import chain, islice
+from pathlib import PurePosixPath
+from django.db.models import Q
+from django.utils import timezone
+from .models import Foto, foto_upload_to, miniatura_upload_to
+
+logger = logging.getLogger(__name__)
+
+
+CAMPOS = {
+    "foto": foto_upload_to,
+    "miniatura": miniatura_upload_to,
+}
+
+RAICES = ("fotos", "miniaturas")
+CUARENTENA = "cuarentena"
+
+
+def ruta_esperada(foto, campo, nombre):
+    """Return where the file ``nombre`` of ``campo`` belongs in the layout"""
+    upload_to = CAMPOS[campo]
+    return upload_to(foto, PurePosixPath(nombre).name)
+
+
+def resumen(storage, nombre):
+    digest = hashlib.sha256()
+    with storage.open(nombre, "rb") as fichero:
+        for bloque in fichero.chunks():
+            digest.update(bloque)
+    return digest.digest()
+
+
+def mismo_contenido(storage, nombre, otro):
+    """Whether both files hold the same bytes, by size and then hash"""
+    if storage.size(nombre) != storage.size(otro):
+        return False
+    return resumen(storage, nombre) == resumen(storage, otro)
+
+
+def reubicar(foto, campo, dry_run=False):
+    """Move the file of ``campo`` to the hashed layout.
+
+    The new copy is written first, then the row is updated only if it still
+    points to the old file and finally the old file is removed, so readers
+    always find one of both paths while the site is online. A copy already
+    at the destination with the same content, left by a run that was
+    interrupted, is reused instead of saved again under another name.
+
+    Returns the new name, or ``None`` when nothing was moved.
+    """
+    fichero = getattr(foto, campo)
+    viejo = fichero.name
+    if not viejo:
+        return None
+    destino = ruta_esperada(foto, campo, viejo)
+    if viejo == destino:
+        return None
+    storage = fichero.storage
+    if not storage.exists(viejo):
+        logger.warning("Falta el fichero %s de la foto %s", viejo, foto.pk)
+        return None
+    if dry_run:
+        return destino
+    copiado = not (storage.exists(destino)
+                   and mismo_contenido(storage, viejo, destino))
+    if copiado:
+        with storage.open(viejo, "rb") as origen:
+            nuevo = storage.save(destino, origen)
+    else:
+        nuevo = destino
+    actualizados = Foto.objects.filter(pk=foto.pk, **{campo: viejo})
+    if not actualizados.update(**{campo: nuevo}):
+        # La foto ha cambiado mientras copiabamos, nos quedamos con la suya.
+        # Una copia que no es nuestra se queda para la recogida de basura
+        if copiado:
+            storage.delete(nuevo)
+        return None
+    storage.delete(viejo)
+    return nuevo
+
+
+# ------------------------------------------------------------------------
+#                Recogida de basura
+# ------------------------------------------------------------------------
+
+
+def recorrer(storage, directorio):
+    """Yield every file name under ``directorio`` without listing it all"""
+    try:
+        directorios, ficheros = storage.listdir(directorio)
+    except FileNotFoundError:
+        return
+    for fichero in ficheros:
+        yield f"{directorio}/{fichero}"
+    for subdirectorio in directorios:
+        yield from recorrer(storage, f"{directorio}/{subdirectorio}")
+
+
+def en_lotes(iterable, tamano):
+    iterador = iter(iterable)
+    while lote := list(islice(iterador, tamano)):
+        yield lote
+
+
+def referenciados(nombres):
+    """Return which of ``nombres`` are used by some photo"""
+    filtro = Q(foto__in=nombres) | Q(miniatura__in=nombres)
+    usados = Foto.objects.filter(filtro).values_list(*CAMPOS)
+    return set(chain.from_iterable(usados))
+
+
+def buscar_huerfanos(storage, batch_size=500, margen=timedelta(hours=1)):
+    """Yield the files that no photo references.
+
+    Files younger than ``margen`` are skipped because they may belong to an
+    upload whose row is not committed yet.
+    """
+    limite = timezone.now() - margen
+    nombres = chain.from_iterable(recorrer(storage, r) for r in RAICES)
+    for lote in en_lotes(nombres, batch_size):
+        usados = referenciados(lote)
+        for nombre in lote:
+            if nombre in usados:
+                continue
+            if storage.get_modified_time(nombre) > limite:
+                continue
+            yield nombre
+
+
+def mover(storage, origen, destino):
+    with storage.open(origen, "rb") as fichero:
+        nuevo = storage.save(destino, fichero)
+    storage.delete(origen)
+    return nuevo
+
+
+def poner_en_cuarentena(storage, nombre, dia=None):
+    dia = dia or timezone.now().date()
+    return mover(storage, nombre, f"{CUARENTENA}/{dia:%Y%m%d}/{nombre}")
+
+
+def purgar_cuarentena(storage, retencion=timedelta(days=7),
+                      batch_size=500, dry_run=False):
+    """Delete quarantined files older than ``retencion``.
+
+    Files that became referenced again are restored instead.
+
+    Returns a tuple with the number of deleted files and their bytes.
+    """
+    limite = timezone.now().date() - retencion
+    borrados = liberados = 0
+    try:
+        dias, _ = storage.listdir(CUARENTENA)
+    except FileNotFoundError:
+        return borrados, liberados
+    for dia in sorted(dias):
+        if dia > f"{limite:%Y%m%d}":
+            continue
+        prefijo = f"{CUARENTENA}/{dia}/"
+        for lote in en_lotes(recorrer(storage, prefijo.rstrip("/")),
+                             batch_size):
+            originales = {n: n[len(prefijo):] for n in lote}
+            usados = referenciados(list(originales.values()))
+            for nombre, original in originales.items():
+                if original in usados:
+                    logger.warning("Restaurando %s", original)
+                    if not dry_run:
+                        mover(storage, nombre, original)
+                    continue
+                liberados += storage.size(nombre)
+                borrados += 1
+                if not dry_run:
+                    storage.delete(nombre)
+    return borrados, liberados
+
+
+def recoger_basura(storage, retencion=timedelta(days=7),
+                   margen=timedelta(hours=1), batch_size=500, dry_run=False):
+    """Purge the expired quarantine and quarantine the new orphans"""
+    borrados, liberados = purgar_cuarentena(storage, retencion=retencion,
+                                            batch_size=batch_size,
+                                            dry_run=dry_run)
+    aislados = aislados_bytes = 0
+    for nombre in buscar_huerfanos(storage, batch_size=batch_size,
+                                   margen=margen):
+        aislados += 1
+        aislados_bytes += storage.size(nombre)
+        if not dry_run:
+            poner_en_cuarentena(storage, nombre)
+    return {
+        "borrados": borrados,
+        "bytes_liberados": liberados,
+        "en_cuarentena": aislados,
+        "bytes_en_cuarentena": aislados_bytes,
+    }
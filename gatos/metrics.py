@@ -0,0 +1,151 @@
+"""
+Metrics of the RPC methods.
+
+Every method decorated with ``medido`` records its calls, errors, latency,
+SQL queries and response size in aggregates local to the process. The
+``exportar`` function renders them in the Prometheus text format.
+"""
+import json
+import threading
+import time
+from functools import wraps
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+from . import versiones
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metrica:
+    def __init__(self):
+        self.llamadas = 0
+        self.errores = 0
+        self.segundos = 0.0
+        self.buckets = [0] * len(BUCKETS)
+        self.consultas = 0
+        self.segundos_sql = 0.0
+        self.bytes = 0
+
+    def registrar(self, segundos, consultas, segundos_sql, tamano, error):
+        self.llamadas += 1
+        self.errores += error
+        self.segundos += segundos
+        self.consultas += consultas
+        self.segundos_sql += segundos_sql
+        self.bytes += tamano
+        for i, limite in enumerate(BUCKETS):
+            if segundos <= limite:
+                self.buckets[i] += 1
+
+
+_metricas = {}
+_lock = threading.Lock()
+
+
+class ContadorSQL:
+    """``connection.execute_wrapper`` that counts and times queries"""
+
+    def __init__(self):
+        self.consultas = 0
+        self.segundos = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        inicio = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.consultas += 1
+            self.segundos += time.perf_counter() - inicio
+
+
+def tamano(resultado):
+    try:
+        return len(json.dumps(resultado, cls=DjangoJSONEncoder))
+    except (TypeError, ValueError):
+        return 0
+
+
+def registrar(nombre, segundos, consultas=0, segundos_sql=0.0, tamano=0,
+              error=False):
+    with _lock:
+        metrica = _metricas.setdefault(nombre, Metrica())
+        metrica.registrar(segundos, consultas, segundos_sql, tamano, error)
+
+
+def medido(funcion):
+    """Record the metrics of an RPC method, goes above ``rpc_method``"""
+    nombre = getattr(funcion, "modernrpc_name", funcion.__name__)
+
+    @wraps(funcion)
+    def envoltura(*args, **kwargs):
+        contador = ContadorSQL()
+        inicio = time.perf_counter()
+        resultado = None
+        error = True
+        try:
+            with connection.execute_wrapper(contador):
+                resultado = funcion(*args, **kwargs)
+            # Los métodos devuelven los errores esperados en el resultado
+            error = isinstance(resultado, dict) and "error" in resultado
+            return resultado
+        finally:
+            registrar(nombre, time.perf_counter() - inicio,
+                      contador.consultas, contador.segundos,
+                      tamano(resultado), error)
+    return envoltura
+
+
+def reiniciar():
+    with _lock:
+        _metricas.clear()
+
+
+def _etiqueta(valor):
+    valor = str(valor).replace("\\", "\\\\").replace('"', '\\"')
+    return valor.replace("\n", "\\n")
+
+
+def exportar():
+    """Metrics in the Prometheus text exposition format"""
+    with _lock:
+        metricas = {n: vars(m).copy() for n, m in sorted(_metricas.items())}
+    lineas = []
+
+    def familia(nombre, tipo, ayuda, campo):
+        lineas.append(f"# HELP {nombre} {ayuda}")
+        lineas.append(f"# TYPE {nombre} {tipo}")
+        for metodo, datos in metricas.items():
+            lineas.append(f'{nombre}{{method="{_etiqueta(metodo)}"}} '
+                          f'{datos[campo]}')
+
+    familia("gatinos_rpc_calls_total", "counter", "RPC calls", "llamadas")
+    familia("gatinos_rpc_errors_total", "counter", "RPC calls that failed",
+            "errores")
+    lineas.append("# HELP gatinos_rpc_latency_seconds RPC latency")
+    lineas.append("# TYPE gatinos_rpc_latency_seconds histogram")
+    for metodo, datos in metricas.items():
+        etiqueta = f'method="{_etiqueta(metodo)}"'
+        for limite, cuenta in zip(BUCKETS, datos["buckets"]):
+            lineas.append(f'gatinos_rpc_latency_seconds_bucket'
+                          f'{{{etiqueta},le="{limite}"}} {cuenta}')
+        lineas.append(f'gatinos_rpc_latency_seconds_bucket'
+                      f'{{{etiqueta},le="+Inf"}} {datos["llamadas"]}')
+        lineas.append(f'gatinos_rpc_latency_seconds_sum{{{etiqueta}}} '
+                      f'{datos["segundos"]}')
+        lineas.append(f'gatinos_rpc_latency_seconds_count{{{etiqueta}}} '
+                      f'{datos["llamadas"]}')
+    familia("gatinos_rpc_queries_total", "counter",
+            "SQL queries run by RPC calls", "consultas")
+    familia("gatinos_rpc_query_seconds_total", "counter",
+            "Time spent in SQL by RPC calls", "segundos_sql")
+    familia("gatinos_rpc_response_bytes_total", "counter",
+            "Size of the RPC results as JSON", "bytes")
+
+    cacheadas = versiones.estadisticas()
+    for evento, nombre in (("aciertos", "hits"), ("fallos", "misses")):
+        lineas.append(f"# TYPE gatinos_cache_{nombre}_total counter")
+        for funcion, datos in cacheadas.items():
+            lineas.append(f'gatinos_cache_{nombre}_total'
+                          f'{{function="{_etiqueta(funcion)}"}} '
+                          f'{datos[evento]}')
+    return "\n".join(lineas) + "\n"
@@ -0,0 +1,289 @@
+"""
+Microbenchmarks of the pure Python hot paths.
+
+Each case prepares its input for a size and returns the call to time, so
+the setup is left out of the measure. A measure is a list of samples, the
+seconds per call of each repetition, that is stored as a baseline in JSON
+and compared with a later run: a case is slower when the Mann-Whitney test
+says so and its median also grew more than a threshold. Every run also
+times ``referencia``, plain Python that never changes, and the times are
+divided by its median so a machine that is slower as a whole is not
+taken for a slower case.
+
+    base = medir(["activity"])
+    ...
+    regresiones = [c for c in comparar(base, medir(["activity"]))
+                   if c["regresion"]]
+
+``perfilar`` runs a case under cProfile or tracemalloc.
+"""
+from dataclasses import dataclass
+from datetime import date, datetime, time, timedelta
+from io import StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from zoneinfo import ZoneInfo
+import cProfile
+import pstats
+import random
+import statistics
+import timeit
+import tracemalloc
+import yaml
+from PIL import Image
+from utils.context_processors import check_intervalo
+from .activity import ActivityMap
+from .data import DATA_PATH, Vacunas
+from .templatetags.atleast import atleast
+from .utils import Agrupador, pil_to_django_file, random_choice
+
+REFERENCIA = date(2024, 6, 30)
+
+
+@dataclass
+class Caso:
+    nombre: str
+    tamanos: tuple
+    preparar: object
+
+
+CASOS = {}
+
+
+def caso(*tamanos):
+    """Register ``preparar(tamano)``, which returns the call to time"""
+    def registrar(preparar):
+        CASOS[preparar.__name__] = Caso(preparar.__name__, tamanos, preparar)
+        return preparar
+    return registrar
+
+
+@caso(1000)
+def referencia(n):
+    datos = list(range(n))
+
+    def contar():
+        cuentas = {}
+        for i in datos:
+            cuentas[i % 7] = cuentas.get(i % 7, 0) + 1
+        return cuentas
+    return contar
+
+
+class AgrupadorDeFechas(Agrupador):
+    @staticmethod
+    def get_value(item):
+        return item[0]
+
+
+def fechas(n, rng, dias=365):
+    return [REFERENCIA - timedelta(rng.randrange(dias)) for _ in range(n)]
+
+
+@caso(10, 100, 365)
+def activity(n):
+    rng = random.Random(n)
+    mapa = ActivityMap(REFERENCIA)
+    mapa.activity_dates = set(fechas(n, rng))
+    return mapa._build_data
+
+
+@caso(100, 1000, 10000)
+def agrupador(n):
+    rng = random.Random(n)
+    items = [(fecha, i) for i, fecha in enumerate(fechas(n, rng))]
+    return lambda: AgrupadorDeFechas.agrupador(items)
+
+
+@caso(100, 1000, 10000)
+def agrupador_iter(n):
+    rng = random.Random(n)
+    grupos = AgrupadorDeFechas([(fecha, i) for i, fecha
+                                in enumerate(fechas(n, rng))])
+    return lambda: list(grupos)
+
+
+@caso(10, 100, 1000)
+def intervalo(n):
+    rng = random.Random(n)
+    zona = ZoneInfo("Europe/Madrid")
+    ahora = datetime.combine(REFERENCIA, time(12), zona)
+
+    def hora():
+        horas = rng.randint(-48, 48)
+        return rng.choice([None, ahora + timedelta(hours=horas)])
+    anuncios = [(hora(), hora()) for _ in range(n)]
+    return lambda: [check_intervalo(ahora, h_i, h_f)
+                    for h_i, h_f in anuncios]
+
+
+@caso(5, 12, 500)
+def atleast_galeria(n):
+    # Las galerías piden 12
+    items = list(range(n))
+    return lambda: atleast(items, 12)
+
+
+@caso(1, 10, 100)
+def vacunas(n):
+    with open(DATA_PATH / "vacunas.yml") as f:
+        originales = list(yaml.safe_load(f).items())
+    datos = {f"{nombre} {i}": valores for i in range(n)
+             for nombre, valores in originales}
+    directorio = TemporaryDirectory()
+    fichero = Path(directorio.name) / "vacunas.yml"
+    fichero.write_text(yaml.safe_dump(datos, allow_unicode=True))
+
+    def construir():
+        # El directorio vive mientras se mide
+        directorio
+        return Vacunas.build(file_path=fichero)
+    return construir
+
+
+@caso(1, 100)
+def slugs(n):
+    return lambda: [random_choice() for _ in range(n)]
+
+
+@caso(64, 512, 1024)
+def jpeg(n):
+    imagen = Image.effect_noise((n, n), 64).convert("RGB")
+    return lambda: pil_to_django_file(imagen)
+
+
+def seleccionar(nombres=None):
+    if not nombres:
+        return list(CASOS.values())
+    desconocidos = set(nombres) - set(CASOS)
+    if desconocidos:
+        raise KeyError(f"Casos desconocidos: "
+                       f"{', '.join(sorted(desconocidos))}")
+    # La referencia se mide siempre, para normalizar
+    return [CASOS[nombre] for nombre
+            in dict.fromkeys(["referencia", *nombres])]
+
+
+def calibrar(timer, minimo=0.05):
+    """Calls in a repetition long enough to time"""
+    numero = 1
+    while timer.timeit(numero) < minimo and numero < 10 ** 6:
+        numero *= 2
+    return numero
+
+
+def medir(nombres=None, repeticiones=20, minimo=0.05, tamanos=None):
+    """``{case: {size: measure}}``, sizes as strings like in the JSON.
+
+    The repetitions of every case and size are interleaved, so a slow
+    moment of the machine spreads over all of them instead of moving one.
+    """
+    medidas = []
+    for c in seleccionar(nombres):
+        # La referencia siempre con el mismo tamaño
+        for tamano in (c.nombre != "referencia" and tamanos) or c.tamanos:
+            timer = timeit.Timer(c.preparar(tamano))
+            medidas.append((c.nombre, str(tamano), timer,
+                            calibrar(timer, minimo), []))
+    for _ in range(repeticiones):
+        for _, _, timer, numero, valores in medidas:
+            valores.append(timer.timeit(numero) / numero)
+    resultados = {}
+    for nombre, tamano, _, numero, valores in medidas:
+        resultados.setdefault(nombre, {})[tamano] = {
+            "numero": numero,
+            "mediana": statistics.median(valores),
+            "muestras": valores,
+        }
+    return resultados
+
+
+def mann_whitney(antes, despues):
+    """One-sided p-value of ``despues`` being greater than ``antes``,
+    normal approximation with ties correction"""
+    n1, n2 = len(antes), len(despues)
+    valores = sorted([(v, 0) for v in antes] + [(v, 1) for v in despues])
+    rangos = [0.0] * len(valores)
+    empates = 0
+    i = 0
+    while i < len(valores):
+        j = i
+        while j + 1 < len(valores) and valores[j + 1][0] == valores[i][0]:
+            j += 1
+        for k in range(i, j + 1):
+            rangos[k] = (i + j) / 2 + 1
+        t = j - i + 1
+        empates += t ** 3 - t
+        i = j + 1
+    suma = sum(r for r, (_, grupo) in zip(rangos, valores) if grupo == 1)
+    u = suma - n2 * (n2 + 1) / 2
+    n = n1 + n2
+    varianza = n1 * n2 / 12 * ((n + 1) - empates / (n * (n - 1)))
+    if varianza <= 0:
+        return 1.0
+    z = (u - n1 * n2 / 2 - 0.5) / varianza ** 0.5
+    return 1 - statistics.NormalDist().cdf(z)
+
+
+def escala(base, actual):
+    """How much slower the machine of ``actual`` is, by ``referencia``"""
+    try:
+        antes, = base["referencia"].values()
+        ahora, = actual["referencia"].values()
+    except (KeyError, ValueError):
+        return 1.0
+    return ahora["mediana"] / antes["mediana"]
+
+
+def comparar(base, actual, alfa=0.01, umbral=0.05, normalizar=True):
+    """Change of the median of each case and size in both runs, with the
+    p-value and whether it is a significant slowdown"""
+    factor = escala(base, actual) if normalizar else 1.0
+    cambios = []
+    for nombre, tamanos in actual.items():
+        if nombre == "referencia":
+            continue
+        for tamano, medida in tamanos.items():
+            anterior = base.get(nombre, {}).get(tamano)
+            if anterior is None:
+                continue
+            valores = [v / factor for v in medida["muestras"]]
+            cambio = statistics.median(valores) / anterior["mediana"] - 1
+            p = mann_whitney(anterior["muestras"], valores)
+            cambios.append({
+                "caso": nombre,
+                "tamano": tamano,
+                "cambio": cambio,
+                "p": p,
+                "regresion": p < alfa and cambio > umbral,
+            })
+    return cambios
+
+
+def perfilar(nombre, tamano, modo="cprofile", lineas=15):
+    """Report of cProfile on the calls of a fifth of a second, or of
+    tracemalloc on one call"""
+    funcion = CASOS[nombre].preparar(tamano)
+    numero = calibrar(timeit.Timer(funcion), minimo=0.2)
+    salida = StringIO()
+    if modo == "cprofile":
+        perfil = cProfile.Profile()
+        perfil.runcall(lambda: [funcion() for _ in range(numero)])
+        pstats.Stats(perfil, stream=salida).sort_stats(
+            "cumulative").print_stats(lineas)
+    elif modo == "tracemalloc":
+        tracemalloc.start()
+        try:
+            # Lo que sigue ocupando el resultado
+            resultado = funcion()
+            foto = tracemalloc.take_snapshot()
+            _, pico = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        del resultado
+        salida.write(f"Pico: {pico / 1024:.1f} KiB\n")
+        for estadistica in foto.statistics("lineno")[:lineas]:
+            salida.write(f"{estadistica}\n")
+    else:
+        raise ValueError(f"Modo de perfil desconocido: {modo}")
+    return salida.getvalue()
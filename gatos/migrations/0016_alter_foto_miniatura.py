@@ -0,0 +1,19 @@
+# Generated by Django 4.2.23 on 2026-10-19 10:12
+
+from django.db import migrations, models
+import gatos.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gatos', '0015_fix_gato_slug_blank'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='foto',
+            name='miniatura',
+            field=models.ImageField(default='', upload_to=gatos.models.miniatura_upload_to),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.23 on 2026-10-19 10:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gatos', '0016_alter_foto_miniatura'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='foto',
+            name='hash_contenido',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='foto',
+            name='version_proceso',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
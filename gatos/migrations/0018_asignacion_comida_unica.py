@@ -0,0 +1,33 @@
+# Generated by Django 4.2.23 on 2026-10-19 15:33
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def borrar_duplicadas(apps, schema_editor):
+    """Keep the oldest assignment of each day, as toggle_comida did"""
+    AsignacionComida = apps.get_model("gatos", "AsignacionComida")
+    duplicadas = (AsignacionComida.objects
+                  .values("colonia", "fecha")
+                  .annotate(n=Count("id"), primera=Min("id"))
+                  .filter(n__gt=1))
+    for dia in duplicadas:
+        (AsignacionComida.objects
+         .filter(colonia=dia["colonia"], fecha=dia["fecha"])
+         .exclude(id=dia["primera"])
+         .delete())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gatos', '0017_foto_hash_contenido'),
+    ]
+
+    operations = [
+        migrations.RunPython(borrar_duplicadas, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='asignacioncomida',
+            constraint=models.UniqueConstraint(fields=('colonia', 'fecha'), name='asignacion_comida_unica'),
+        ),
+    ]
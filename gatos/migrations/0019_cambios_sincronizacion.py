@@ -0,0 +1,40 @@
+# Generated by Django 4.2.23 on 2026-10-19 15:45
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('gatos', '0018_asignacion_comida_unica'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OperacionSync',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('clave', models.CharField(max_length=64)),
+                ('resultado', models.JSONField()),
+                ('fecha', models.DateTimeField(auto_now_add=True)),
+                ('usuario', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='operaciones_sync', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Cambio',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('modelo', models.CharField(max_length=50)),
+                ('objeto', models.CharField(max_length=50)),
+                ('borrado', models.BooleanField(default=False)),
+                ('colonia', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cambios', to='gatos.colonia')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='operacionsync',
+            constraint=models.UniqueConstraint(fields=('usuario', 'clave'), name='operacion_sync_unica'),
+        ),
+    ]
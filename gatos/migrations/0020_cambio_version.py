@@ -0,0 +1,42 @@
+from django.db import migrations, models
+from django.db.models import F, Max
+import django.db.models.deletion
+
+
+def versiones_desde_ids(apps, schema_editor):
+    # Los tokens que ya tienen los clientes eran ids y siguen valiendo
+    Cambio = apps.get_model("gatos", "Cambio")
+    SecuenciaCambios = apps.get_model("gatos", "SecuenciaCambios")
+    Cambio.objects.update(version=F("id"))
+    SecuenciaCambios.objects.bulk_create([
+        SecuenciaCambios(colonia_id=colonia_id, ultima=ultima)
+        for colonia_id, ultima in Cambio.objects.values("colonia_id")
+        .annotate(ultima=Max("id")).values_list("colonia_id", "ultima")])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gatos', '0019_cambios_sincronizacion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SecuenciaCambios',
+            fields=[
+                ('colonia', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='secuencia_cambios', serialize=False, to='gatos.colonia')),
+                ('ultima', models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='cambio',
+            name='version',
+            field=models.PositiveBigIntegerField(default=0),
+            preserve_default=False,
+        ),
+        migrations.RunPython(versiones_desde_ids, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cambio',
+            constraint=models.UniqueConstraint(fields=('colonia', 'version'), name='cambio_version_unica'),
+        ),
+    ]
@@ -1,14 +1,19 @@
 from datetime import date, timedelta
 from functools import reduce
+import hashlib
 from pathlib import Path
 from PIL import Image
 from PIL.ExifTags import TAGS
 from django.conf import settings
 from django.urls import reverse
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import (BooleanField, Exists, ExpressionWrapper, F,
+                              OuterRef, Q)
 from django.utils.text import slugify
 from .data import vacunas
-from .utils import pil_to_django_file, random_choice
+from .accesos import colonias_autorizadas
+from .utils import pil_to_django_file, random_choice, fan_out
+from .versiones import invalidar
 
 SEXOS = [
           ("M", "Macho"),
@@ -45,7 +50,39 @@ class EstadoGato(models.TextChoices):
 # Ver https://docs.viewflow.io/fsm/models.html
 
 
-class GatosColoniaManager(models.Manager):
+class AccesoQuerySet(models.QuerySet):
+    """Rows of the colonies a user is authorized for.
+
+    Models set ``RUTA_COLONIA`` to the lookup of their colony, the filter
+    is a join with the authorization table so unauthorized rows are never
+    fetched.
+    """
+
+    def for_user(self, user):
+        if not user.is_authenticated or not user.is_active:
+            return self.none()
+        if user.is_superuser:
+            return self.all()
+        ruta = self.model.RUTA_COLONIA
+        campo = f"{ruta}__usuarios_autorizados" if ruta else \
+            "usuarios_autorizados"
+        return self.filter(**{campo: user.pk})
+
+
+class GatoQuerySet(AccesoQuerySet):
+    def galeria(self):
+        """Cats with what the gallery shows loaded: the portrait, whether
+        it is ugly and the colony for the URL"""
+        feos = Foto.gatos.through.objects.filter(foto_id=OuterRef("retrato_id"),
+                                                 gato__feo=True)
+        retrato_feo = ExpressionWrapper(Q(retrato__fea=True) | Q(Exists(feos)),
+                                        output_field=BooleanField())
+        return (self.select_related("colonia", "retrato")
+                .annotate(retrato_feo=retrato_feo)
+                .order_by("nombre"))
+
+
+class GatosColoniaManager(models.Manager.from_queryset(GatoQuerySet)):
     def get_queryset(self):
         return super().get_queryset().filter(vecino=False)
 
@@ -70,7 +107,9 @@ class Gato(models.Model):
     estado = models.CharField(max_length=200, default="LIBRE")
     marcado = models.BooleanField(default=False)
 
-    objects = models.Manager()
+    RUTA_COLONIA = "colonia"
+
+    objects = GatoQuerySet.as_manager()
     gatos_colonia = GatosColoniaManager()
 
     class Meta:
@@ -137,7 +176,9 @@ class Gato(models.Model):
     def save(self, *args, **kwargs):
         if not self.slug or self.slug.strip() == "":
             self.slug = slugify(self.nombre)
-        super().save(*args, **kwargs)
+        # El cambio lo registra post_save, en la misma transacción
+        with transaction.atomic(savepoint=False):
+            super().save(*args, **kwargs)
 
     @property
     def color_estado(self):
@@ -154,6 +195,13 @@ class Gato(models.Model):
         else:
             return "pink"
 
+    @property
+    def retrato_es_fea(self):
+        if hasattr(self, "retrato_feo"):
+            # Calculado en GatoQuerySet.galeria
+            return self.retrato_feo
+        return self.retrato is not None and self.retrato.es_fea()
+
     def get_absolute_url(self):
         return reverse("gato", kwargs={"colonia": self.colonia.slug,
                                        "gato": self.slug})
@@ -180,6 +228,10 @@ class Colonia(models.Model):
         help_text='Usuarios que tienen acceso a esta colonia'
     )
 
+    RUTA_COLONIA = ""
+
+    objects = AccesoQuerySet.as_manager()
+
     def get_eventos(self, min_fecha=None, max_fecha=None):
         informes = self.informes
         fotos = self.fotos
@@ -205,32 +257,44 @@ class Colonia(models.Model):
         eventos = self.get_eventos(min_fecha=min_fecha, max_fecha=max_fecha)
         return [x.fecha for x in eventos]
 
-    def get_gatos_activos(self, min_fecha=None, max_fecha=None):
+    def gatos_activos(self, min_fecha=None, max_fecha=None):
+        """Cats in the photos, reports, sightings or registrations of the
+        period, in one query"""
         if min_fecha is None:
             min_fecha = date.today() - self.periodo_activo
-        result = set()
-        eventos = self.get_eventos(min_fecha=min_fecha, max_fecha=max_fecha)
-        for evento in eventos:
-            if hasattr(evento, "gatos"):
-                for gato in evento.gatos.filter(muerto=False):
-                    result.add(gato)
-            if hasattr(evento, "gato"):
-                result.add(evento.gato)
-        return list(result)
+        rango = {"gte": min_fecha, "lte": max_fecha}
+
+        def periodo(campo):
+            return {f"{campo}__{op}": valor for op, valor in rango.items()
+                    if valor is not None}
+        fotos = Foto.gatos.through.objects.filter(
+            foto__in=self.fotos.filter(**periodo("fecha")))
+        informes = Informe.gatos.through.objects.filter(
+            informe__in=self.informes.filter(**periodo("fecha")))
+        avistamientos = self.avistamientos.filter(**periodo("fecha"))
+        return Gato.objects.filter(
+            Q(id__in=fotos.values("gato_id"), muerto=False)
+            | Q(id__in=informes.values("gato_id"), muerto=False)
+            | Q(id__in=avistamientos.values("gato_id"))
+            | Q(colonia=self, **periodo("fecha_alta")))
+
+    def gatos_desaparecidos(self):
+        activos = self.gatos_activos()
+        return self.gatos.filter(muerto=False).exclude(
+            id__in=activos.values("id"))
+
+    def get_gatos_activos(self, min_fecha=None, max_fecha=None):
+        return list(self.gatos_activos(min_fecha, max_fecha).galeria())
 
     def get_gatos_desaparecidos(self):
-        result = []
-        activos = self.get_gatos_activos()
-        for gato in self.gatos.filter(muerto=False):
-            if gato not in activos:
-                result.append(gato)
-        return result
+        return list(self.gatos_desaparecidos().galeria())
 
     def get_avistamientos(self, date):
-        vistos_set = {av.gato for av in self.avistamientos.filter(fecha=date)}
+        vistos_set = set(self.avistamientos.filter(fecha=date)
+                         .values_list("gato_id", flat=True))
         gatos = self.get_gatos_activos()
-        vistos = [x for x in gatos if x in vistos_set]
-        no_vistos = [x for x in gatos if x not in vistos_set]
+        vistos = [x for x in gatos if x.id in vistos_set]
+        no_vistos = [x for x in gatos if x.id not in vistos_set]
         return vistos, no_vistos
 
     def get_gatos_muertos(self):
@@ -240,24 +304,39 @@ class Colonia(models.Model):
         return ""
 
     def user_has_access(self, user):
-        """Check if a user has access to this colony"""
-        if user.is_superuser:
-            return True
-        return self.usuarios_autorizados.filter(id=user.id).exists()
-    
+        """Check if a user has access to this colony, see gatos.accesos"""
+        return self.id in colonias_autorizadas(user)
+
+    def get_alimentadores(self):
+        """Active users that may feed this colony, in a single query.
+
+        Superusers always can, the rest need access to the colony and the
+        ``alimentar_colonia`` permission, directly or through a group.
+        """
+        from django.contrib.auth import get_user_model
+        from django.contrib.auth.models import Permission
+        User = get_user_model()
+        permiso = Permission.objects.filter(content_type__app_label="gatos",
+                                            codename="alimentar_colonia")
+        directos = (User.user_permissions.through.objects
+                    .filter(permission__in=permiso).values("user_id"))
+        por_grupo = (User.groups.through.objects
+                     .filter(group__permissions__in=permiso)
+                     .values("user_id"))
+        autorizados = (self.usuarios_autorizados.through.objects
+                       .filter(colonia=self).values("user_id"))
+        con_permiso = Q(id__in=directos) | Q(id__in=por_grupo)
+        return (User.objects.filter(is_active=True)
+                .filter(Q(is_superuser=True) |
+                        Q(id__in=autorizados) & con_permiso)
+                .order_by("id"))
+
     def toggle_comida(self, fecha, user):
-        if not fecha > date.today():
+        if not AsignacionComida.modificable(fecha):
             return
-        comidas = self.comidas.filter(fecha=fecha).order_by('id')
-        if not comidas:
-            comida = AsignacionComida(fecha=fecha, usuario=user, colonia=self)
-            comida.save()
-        else:
-            if comidas[0].usuario == user:
-                comidas.delete()
-            else:
-                comidas[0].usuario = user
-                comidas[0].save()
+        def decidir(actual):
+            return None if actual == user.id else user.id
+        AsignacionComida.objects.cambiar(self, fecha, decidir)
 
     def save(self, *args, **kwargs):
         if not self.slug:
@@ -281,11 +360,17 @@ class UserBound(models.Model):
                                 null=True)
     nombre_usuario = models.CharField(max_length=200, blank=True, default="")
 
+    RUTA_COLONIA = "colonia"
+
+    objects = AccesoQuerySet.as_manager()
+
     def save(self, *args, **kwargs):
         if self.usuario is not None and self.nombre_usuario != "":
             self.nombre_usuario = " ".join((self.usuario.first_name,
                                             self.usuario.last_name))
-        super().save(*args, **kwargs)
+        # El cambio lo registra post_save, en la misma transacción
+        with transaction.atomic(savepoint=False):
+            super().save(*args, **kwargs)
 
     class Meta:
         abstract = True
@@ -294,24 +379,34 @@ class UserBound(models.Model):
 def foto_upload_to(instance, filename):
     path = Path(filename)
     ext = path.suffix
-    return f"fotos/{instance.id}{ext}"
+    return f"fotos/{fan_out(instance.id)}/{instance.id}{ext}"
+
+
+def miniatura_upload_to(instance, filename):
+    path = Path(filename)
+    ext = path.suffix
+    return f"miniaturas/{fan_out(instance.id)}/{instance.id}{ext}"
 
 
 class Foto(UserBound):
     MINIATURA_SIZE = (170, 120)
+    # Hay que incrementarla cuando cambie la forma de procesar las fotos
+    VERSION_PROCESO = 1
 
     id = models.CharField(max_length=20, primary_key=True,
                           default=random_choice, editable=False)
     colonia = models.ForeignKey("gatos.Colonia", on_delete=models.CASCADE,
                                 related_name="fotos")
     foto = models.ImageField(upload_to=foto_upload_to)
-    miniatura = models.ImageField(upload_to="miniaturas/%Y/%m/%d", default="")
+    miniatura = models.ImageField(upload_to=miniatura_upload_to, default="")
     exif = models.JSONField(default=dict)
     descripcion = models.TextField(blank=True)
     gatos = models.ManyToManyField("gatos.Gato", related_name="fotos",
                                    blank=True)
     fecha = models.DateField(auto_now_add=True)
     fea = models.BooleanField(default=False)
+    hash_contenido = models.CharField(max_length=64, blank=True, default="")
+    version_proceso = models.PositiveSmallIntegerField(default=0)
 
     @property
     def foto_name(self):
@@ -330,8 +425,11 @@ class Foto(UserBound):
             pil = self.get_pil_image()
         pil.thumbnail(self.MINIATURA_SIZE)
         django_file = pil_to_django_file(pil)
+        anterior = self.miniatura.name
         self.miniatura.save(self.foto_name, django_file)
         self.save()
+        if anterior and anterior != self.miniatura.name:
+            self.miniatura.storage.delete(anterior)
 
     def update_exif(self, pil=None):
         if pil is None:
@@ -341,6 +439,34 @@ class Foto(UserBound):
             self.exif = {TAGS.get(t, t): v for t, v in exif.items()}
         self.save()
 
+    def calcular_hash(self):
+        sha = hashlib.sha256()
+        with self.foto.open("rb") as f:
+            for chunk in f.chunks():
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def esta_procesada(self, hash_contenido):
+        return (bool(self.miniatura)
+                and self.hash_contenido == hash_contenido
+                and self.version_proceso == self.VERSION_PROCESO)
+
+    def procesar(self, forzar=False):
+        """Build the thumbnail and EXIF unless they are already current.
+
+        Returns whether the image had to be decoded.
+        """
+        hash_contenido = self.calcular_hash()
+        if not forzar and self.esta_procesada(hash_contenido):
+            return False
+        pil = self.get_pil_image()
+        self.update_exif(pil=pil)
+        self.update_miniatura(pil=pil)
+        self.hash_contenido = hash_contenido
+        self.version_proceso = self.VERSION_PROCESO
+        self.save(update_fields=["hash_contenido", "version_proceso"])
+        return True
+
     def get_absolute_url(self):
         return reverse("foto", kwargs={"colonia": self.colonia.slug,
                                        "foto": self.id})
@@ -386,6 +512,8 @@ class Captura(UserBound):
     esterilizacion = models.BooleanField(default=False)
     observaciones = models.TextField(blank=True, default="")
 
+    RUTA_COLONIA = "gato__colonia"
+
     class Meta:
         permissions = [
                 ("capturar_gato", ""),
@@ -432,6 +560,8 @@ class Vacunacion(UserBound):
                             choices=vacunas.get_choices())
     efecto = models.DurationField()
 
+    RUTA_COLONIA = "captura__gato__colonia"
+
     class Meta:
         verbose_name_plural = "vacunaciones"
         permissions = [
@@ -481,6 +611,8 @@ class Enfermedad(UserBound):
     fecha_curacion = models.DateField(blank=True, null=True)
     observaciones = models.TextField(blank=True, default="")
 
+    RUTA_COLONIA = "gato__colonia"
+
     class Meta:
         verbose_name_plural = "enfermedades"
 
@@ -535,6 +667,81 @@ class Avistamiento(UserBound):
         return f"<{cls} gato={g} usuario={u} fecha={f}>"
 
 
+class ConflictoAsignacion(Exception):
+    pass
+
+
+class AsignacionComidaQuerySet(AccesoQuerySet):
+    """Bulk changes also invalidate the calendars of their colonies and
+    enter the change feed"""
+
+    def _dias(self):
+        return list(self.values_list("colonia_id", "fecha"))
+
+    def _cambiados(self, dias, borrado=False):
+        for colonia_id in {colonia_id for colonia_id, _ in dias}:
+            invalidar("comidas", colonia_id)
+        Cambio.objects.registrar_dias(dias, borrado)
+
+    def delete(self):
+        with transaction.atomic(savepoint=False):
+            dias = self._dias()
+            resultado = super().delete()
+            self._cambiados(dias, borrado=True)
+        return resultado
+
+    def update(self, **kwargs):
+        with transaction.atomic(savepoint=False):
+            dias = self._dias()
+            cambiadas = super().update(**kwargs)
+            if "colonia" in kwargs or "fecha" in kwargs:
+                # Las filas dejan sus días y pasan a los nuevos
+                self._cambiados(dias, borrado=True)
+                colonia = getattr(kwargs.get("colonia"), "pk", None)
+                fecha = kwargs.get("fecha")
+                dias = [(colonia or c, fecha or f) for c, f in dias]
+            self._cambiados(dias)
+        return cambiadas
+
+
+class AsignacionComidaManager(models.Manager.from_queryset(
+        AsignacionComidaQuerySet)):
+    def cambiar(self, colonia, fecha, decidir, intentos=5):
+        """Compare-and-set of the user that feeds ``colonia`` on ``fecha``.
+
+        ``decidir`` receives the id of the assigned user, or ``None``, and
+        returns the id of the user to assign, or ``None`` to leave the day
+        free. When somebody else changes the day in between it is called
+        again with the new value.
+
+        Returns the id of the assigned user after the change.
+        """
+        dia = self.filter(colonia=colonia, fecha=fecha)
+        for _ in range(intentos):
+            actual = dia.values_list("usuario_id", flat=True).first()
+            nuevo = decidir(actual)
+            if nuevo == actual:
+                return actual
+            if actual is None:
+                try:
+                    with transaction.atomic():
+                        self.create(colonia=colonia, fecha=fecha,
+                                    usuario_id=nuevo)
+                    return nuevo
+                except IntegrityError:
+                    continue
+            # Sin receptores de señales el borrado es un único DELETE con
+            # la condición, igual que el UPDATE
+            asignada = dia.filter(usuario_id=actual)
+            if nuevo is None:
+                cambiadas, _ = asignada.delete()
+            else:
+                cambiadas = asignada.update(usuario_id=nuevo)
+            if cambiadas:
+                return nuevo
+        raise ConflictoAsignacion(f"{colonia} {fecha}")
+
+
 class AsignacionComida(models.Model):
     fecha = models.DateField()
     usuario = models.ForeignKey(settings.AUTH_USER_MODEL,
@@ -542,10 +749,37 @@ class AsignacionComida(models.Model):
     colonia = models.ForeignKey("gatos.Colonia", on_delete=models.CASCADE,
                                 related_name="comidas")
 
+    RUTA_COLONIA = "colonia"
+
+    objects = AsignacionComidaManager()
+
     class Meta:
         permissions = [
                 ("alimentar_colonia", ""),
                 ]
+        constraints = [
+            models.UniqueConstraint(fields=["colonia", "fecha"],
+                                    name="asignacion_comida_unica"),
+        ]
+
+    @staticmethod
+    def modificable(fecha):
+        """Only the days after today can be assigned or freed"""
+        return fecha > date.today()
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic(savepoint=False):
+            super().save(*args, **kwargs)
+            invalidar("comidas", self.colonia_id)
+            Cambio.objects.registrar_dias([(self.colonia_id, self.fecha)])
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic(savepoint=False):
+            resultado = super().delete(*args, **kwargs)
+            invalidar("comidas", self.colonia_id)
+            Cambio.objects.registrar_dias([(self.colonia_id, self.fecha)],
+                                          borrado=True)
+        return resultado
 
     def str(self):
         f = self.fecha
@@ -560,6 +794,113 @@ class AsignacionComida(models.Model):
         return f"<{cls} usuario={u} fecha={f} colonia={c}>"
 
 
+class SecuenciaCambios(models.Model):
+    """Last version of the change feed of each colony"""
+    colonia = models.OneToOneField("gatos.Colonia", on_delete=models.CASCADE,
+                                   primary_key=True,
+                                   related_name="secuencia_cambios")
+    ultima = models.PositiveBigIntegerField(default=0)
+
+    @classmethod
+    def reservar(cls, colonia_id, n):
+        """Reserve ``n`` versions, returns the last one.
+
+        The row stays locked by the update until the transaction commits,
+        so a version is only visible once every version before it is, and
+        a client at version N never misses a change below it.
+        """
+        secuencia = cls.objects.filter(colonia_id=colonia_id)
+        if not secuencia.update(ultima=F("ultima") + n):
+            try:
+                with transaction.atomic():
+                    cls.objects.create(colonia_id=colonia_id, ultima=n)
+                return n
+            except IntegrityError:
+                # Otro la creó a la vez
+                secuencia.update(ultima=F("ultima") + n)
+        return secuencia.values_list("ultima", flat=True).get()
+
+
+class CambioManager(models.Manager):
+    def crear(self, cambios):
+        if not cambios:
+            return
+        por_colonia = {}
+        for cambio in cambios:
+            por_colonia.setdefault(cambio.colonia_id, []).append(cambio)
+        with transaction.atomic(savepoint=False):
+            # Siempre en el mismo orden para no bloquearse entre sí
+            for colonia_id in sorted(por_colonia):
+                filas = por_colonia[colonia_id]
+                ultima = SecuenciaCambios.reservar(colonia_id, len(filas))
+                for version, cambio in enumerate(filas,
+                                                 ultima - len(filas) + 1):
+                    cambio.version = version
+            self.bulk_create(cambios)
+        from .eventos import avisar
+        for colonia_id, modelo in {(c.colonia_id, c.modelo) for c in cambios}:
+            avisar(colonia_id, modelo, por_colonia[colonia_id][0].version - 1)
+
+    def registrar(self, colonia_id, modelo, objetos, borrado=False):
+        """Append the changes of ``objetos``, ids or keys of ``modelo``"""
+        self.crear([self.model(colonia_id=colonia_id, modelo=modelo,
+                               objeto=str(objeto), borrado=borrado)
+                    for objeto in objetos])
+
+    def registrar_dias(self, dias, borrado=False):
+        """Feeding assignments are identified by their day"""
+        self.crear([self.model(colonia_id=colonia_id,
+                               modelo="asignacioncomida",
+                               objeto=fecha.isoformat(), borrado=borrado)
+                    for colonia_id, fecha in dias])
+
+    def version(self, colonia):
+        ultima = (self.filter(colonia=colonia).order_by("-version")
+                  .values_list("version", flat=True).first())
+        return ultima or 0
+
+
+class Cambio(models.Model):
+    """Change feed of the colonies, ``version`` numbers the changes of
+    each colony in commit order and is the version after the change"""
+    colonia = models.ForeignKey("gatos.Colonia", on_delete=models.CASCADE,
+                                related_name="cambios")
+    version = models.PositiveBigIntegerField()
+    modelo = models.CharField(max_length=50)
+    objeto = models.CharField(max_length=50)
+    borrado = models.BooleanField(default=False)
+
+    objects = CambioManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["colonia", "version"],
+                                    name="cambio_version_unica"),
+        ]
+
+    def __repr__(self):
+        cls = self.__class__.__name__
+        accion = "borrado" if self.borrado else "cambio"
+        return f"<{cls} {self.version} {accion} {self.modelo}={self.objeto}>"
+
+
+class OperacionSync(models.Model):
+    """Result of an operation uploaded by an offline client, kept so that
+    retrying the upload doesn't apply it twice"""
+    usuario = models.ForeignKey(settings.AUTH_USER_MODEL,
+                                on_delete=models.CASCADE,
+                                related_name="operaciones_sync")
+    clave = models.CharField(max_length=64)
+    resultado = models.JSONField()
+    fecha = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["usuario", "clave"],
+                                    name="operacion_sync_unica"),
+        ]
+
+
 class Anuncio(models.Model):
     class NivelesDeAviso(models.TextChoices):
         BAJO = "BAJO", "Bajo"
@@ -0,0 +1,81 @@
+"""
+Permissions of each user compiled once per version of ``permisos``.
+
+The groups of ``settings.GROUPS_PERMISSIONS`` that ``syncpermissions``
+creates are compiled to sets of ``"app.codename"`` names, and each user's
+direct and group permissions are stored in the cache under the current
+version. Any change to users, groups or their permissions bumps the
+version, so ``has_perm`` in loops and on every view costs no queries.
+The version is bumped when the change commits, see ``gatos.versiones``.
+Only a shared cache carries the bump from ``syncpermissions`` or the admin
+to the workers, without one the permissions are loaded on every request.
+
+    AUTHENTICATION_BACKENDS = ["gatos.permisos.PermisosBackend",
+                               "django.contrib.auth.backends.ModelBackend"]
+
+``ModelBackend`` stays for the sessions stored with it, it finds the
+permissions already loaded by this one on the user.
+"""
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import Group, Permission
+from .versiones import NOMBRES, compartida, obtener, version
+
+TIMEOUT = 24 * 60 * 60
+USUARIO_KEY = "_permisos"
+NOMBRES.add("permisos")
+
+
+def nombres(filas):
+    return {f"{app}.{codename}" for app, codename in filas}
+
+
+def permisos_grupos():
+    """``{group_id: permission names}`` of every group"""
+    def calcular():
+        grupos = {grupo_id: set() for grupo_id
+                  in Group.objects.values_list("id", flat=True)}
+        filas = Group.permissions.through.objects.values_list(
+            "group_id", "permission__content_type__app_label",
+            "permission__codename")
+        for grupo_id, app, codename in filas:
+            grupos[grupo_id].add(f"{app}.{codename}")
+        return grupos
+    if not compartida():
+        return calcular()
+    return obtener(f"permisos:grupos:{version('permisos')}", calcular,
+                   TIMEOUT, nombre="permisos")
+
+
+def permisos_usuario(user):
+    """Direct and group permission names of ``user``"""
+    def calcular():
+        directos = Permission.objects.filter(user=user).values_list(
+            "content_type__app_label", "codename")
+        grupos = permisos_grupos()
+        ids = user.groups.through.objects.filter(
+            user_id=user.pk).values_list("group_id", flat=True)
+        return {
+            "user": nombres(directos),
+            "group": set().union(*(grupos.get(i, ()) for i in ids)),
+        }
+    if not compartida():
+        # Solo duran lo que el usuario, que es de la petición
+        if USUARIO_KEY not in user.__dict__:
+            user.__dict__[USUARIO_KEY] = calcular()
+        return user.__dict__[USUARIO_KEY]
+    clave = f"permisos:usuario:{user.pk}:{version('permisos')}"
+    return obtener(clave, calcular, TIMEOUT, nombre="permisos")
+
+
+class PermisosBackend(ModelBackend):
+    """ModelBackend that reads the permissions from ``permisos_usuario``"""
+
+    def _get_permissions(self, user_obj, obj, from_name):
+        if (not user_obj.is_active or user_obj.is_anonymous
+                or obj is not None or user_obj.is_superuser):
+            return super()._get_permissions(user_obj, obj, from_name)
+        atributo = f"_{from_name}_perm_cache"
+        if not hasattr(user_obj, atributo):
+            setattr(user_obj, atributo,
+                    set(permisos_usuario(user_obj)[from_name]))
+        return getattr(user_obj, atributo)
@@ -0,0 +1,117 @@
+"""
+Generation of feeding rotas.
+
+A rota is computed in memory for a range of days, validated and written
+with a single ``bulk_create`` instead of one assignment per day.
+
+    crear(colonia, inicio, fin, [ana.id, luis.id], "round_robin")
+"""
+from datetime import timedelta
+from itertools import cycle
+from django.db import transaction
+from .models import AsignacionComida, Cambio
+from .versiones import invalidar
+
+MAX_DIAS = 92
+
+
+class RotaInvalida(ValueError):
+    pass
+
+
+def dias(inicio, fin):
+    return [inicio + timedelta(days=n) for n in range((fin - inicio).days + 1)]
+
+
+def round_robin(fechas, alimentadores, ocupadas, semana):
+    """Each day the next feeder of the list"""
+    turnos = cycle(alimentadores)
+    return {fecha: next(turnos) for fecha in fechas}
+
+
+def dias_semana(fechas, alimentadores, ocupadas, semana):
+    """Every feeder keeps the weekdays given in ``semana``"""
+    return {fecha: semana[fecha.weekday()] for fecha in fechas
+            if fecha.weekday() in semana}
+
+
+def huecos(fechas, alimentadores, ocupadas, semana):
+    """Round robin over the days nobody has taken yet"""
+    libres = [fecha for fecha in fechas if fecha not in ocupadas]
+    return round_robin(libres, alimentadores, ocupadas, semana)
+
+
+REGLAS = {
+    "round_robin": round_robin,
+    "dias_semana": dias_semana,
+    "huecos": huecos,
+}
+
+
+def validar(colonia, inicio, fin, alimentadores, regla, semana):
+    if regla not in REGLAS:
+        raise RotaInvalida(f"Regla desconocida: {regla}")
+    if fin < inicio:
+        raise RotaInvalida("La fecha final es anterior a la inicial")
+    if (fin - inicio).days >= MAX_DIAS:
+        raise RotaInvalida(f"La rota no puede pasar de {MAX_DIAS} días")
+    if regla == "dias_semana":
+        if not semana:
+            raise RotaInvalida("Faltan los días de la semana")
+        if not set(semana) <= set(range(7)):
+            raise RotaInvalida("Los días de la semana van de 0 a 6")
+        alimentadores = list(semana.values())
+    if not alimentadores:
+        raise RotaInvalida("Faltan los alimentadores")
+    validos = set(colonia.get_alimentadores().values_list("id", flat=True))
+    ajenos = set(alimentadores) - validos
+    if ajenos:
+        raise RotaInvalida(f"No pueden alimentar la colonia: {sorted(ajenos)}")
+
+
+def generar(colonia, inicio, fin, alimentadores, regla="round_robin",
+            semana=None):
+    """Return the plan as a dict of dates and user ids.
+
+    ``semana`` maps weekdays, 0 being Monday, to user ids for the
+    ``dias_semana`` rule.
+    """
+    semana = {int(k): v for k, v in (semana or {}).items()}
+    validar(colonia, inicio, fin, alimentadores, regla, semana)
+    ocupadas = set(colonia.comidas.filter(fecha__range=(inicio, fin))
+                   .values_list("fecha", flat=True))
+    return REGLAS[regla](dias(inicio, fin), alimentadores, ocupadas, semana)
+
+
+def aplicar(colonia, plan, reemplazar=True):
+    """Write the plan in one transaction and return the days written.
+
+    With ``reemplazar`` the assignments of the planned days are replaced,
+    otherwise days taken meanwhile by a volunteer are kept.
+    """
+    with transaction.atomic():
+        dias = colonia.comidas.filter(fecha__in=list(plan))
+        if reemplazar:
+            dias.delete()
+        else:
+            ocupadas = set(dias.values_list("fecha", flat=True))
+            plan = {fecha: usuario for fecha, usuario in plan.items()
+                    if fecha not in ocupadas}
+        AsignacionComida.objects.bulk_create(
+            [AsignacionComida(colonia=colonia, fecha=fecha, usuario_id=usuario)
+             for fecha, usuario in sorted(plan.items())],
+            ignore_conflicts=not reemplazar)
+        # bulk_create no pasa por save()
+        Cambio.objects.registrar_dias([(colonia.id, fecha) for fecha in plan])
+    invalidar("comidas", colonia.id)
+    return plan
+
+
+def crear(colonia, inicio, fin, alimentadores, regla="round_robin",
+          semana=None, dry_run=False):
+    """Generate and write a rota, returning the plan, without the days
+    taken meanwhile once written"""
+    plan = generar(colonia, inicio, fin, alimentadores, regla, semana)
+    if not dry_run:
+        plan = aplicar(colonia, plan, reemplazar=regla != "huecos")
+    return plan
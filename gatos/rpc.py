@@ -1,26 +1,97 @@
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
+import hashlib
 from modernrpc.core import rpc_method
 from modernrpc.auth.basic import http_basic_auth_permissions_required
 from modernrpc.auth.basic import http_basic_auth_login_required
 from .models import Colonia, Gato, CodigoCalendarioComidas, AsignacionComida
 from .decorators import colony_access_required, require_colony_permission
+from .identidad import cargar
+from . import metrics, rotas, sincronizacion, versiones
 
 
+def get_colonia(request, **lookup):
+    """Load a colony by ``id`` or ``slug`` once per HTTP request.
+
+    Only the colonies the user of the request is authorized for are found,
+    the rest raise ``Colonia.DoesNotExist``. All the calls of a JSON-RPC
+    batch share the request, so they also share the lookup.
+    """
+    if request is None:
+        return Colonia.objects.get(**lookup)
+    return cargar(request, Colonia.objects.for_user(request.user),
+                  ambito="autorizadas", **lookup)
+
+
+@versiones.cacheado("alimentadores", ambitos=("permisos", "colonia"))
+def get_alimentadores(colonia):
+    """Feeders of the colony, cached until users, groups, permissions or
+    the authorized users of the colony change"""
+    return [{
+        'id': u.id,
+        'username': u.username,
+        'first_name': u.first_name,
+        'last_name': u.last_name,
+        'full_name': f"{u.first_name} {u.last_name}".strip() or u.username
+    } for u in colonia.get_alimentadores()]
+
+
+@versiones.cacheado("comidas", ambitos=("permisos", "comidas"))
+def get_calendario(colonia, start, end):
+    """Users and user ids assigned to each day of the range"""
+    query = (AsignacionComida.objects
+             .filter(colonia=colonia, fecha__range=(start, end))
+             .select_related("usuario")
+             .order_by("fecha", "id"))
+    users = {}
+    dates = {}
+    for asignacion in query:
+        usuario = asignacion.usuario
+        if usuario.id not in users:
+            users[usuario.id] = {
+                "username": usuario.username,
+                "full_name": f"{usuario.first_name} {usuario.last_name}".strip() or usuario.username
+            }
+        dia = asignacion.fecha.strftime("%Y-%m-%d")
+        dates.setdefault(dia, []).append(usuario.id)
+    return {"users": users, "dates": dates}
+
+
+def filas_calendario(calendario):
+    """The calendar as the rows of one assignment each that clients built
+    before the compact payload expect"""
+    return [{"date": dia, "user_id": user_id, **calendario["users"][user_id]}
+            for dia, ids in calendario["dates"].items() for user_id in ids]
+
+
+@versiones.cacheado("actividad_colonia")
+def get_actividad_colonia(colonia):
+    return [d.isoformat() if hasattr(d, 'isoformat') else str(d)
+            for d in colonia.get_actividad()]
+
+
+@versiones.cacheado("actividad_gato")
+def get_actividad_gato(colonia, gato_slug):
+    gato = Gato.objects.get(slug=gato_slug, colonia=colonia)
+    return {
+        "dates": [d.isoformat() if hasattr(d, 'isoformat') else str(d)
+                  for d in gato.get_actividad()],
+        "cat_name": gato.nombre
+    }
+
+
+@metrics.medido
 @rpc_method(name="alternar_comida_usuario")
 def alternar_comida_usuario(colonia_slug, ano, mes, dia, **kwargs):
     request = kwargs['request']
     user = request.user
-    colonia = Colonia.objects.get(slug=colonia_slug)
-    
-    # Check if user has access to this colony
-    if not colonia.user_has_access(user):
-        return {"error": "No tiene acceso a esta colonia"}
+    colonia = get_colonia(request, slug=colonia_slug)
     
     fecha = date(ano, mes, dia)
     colonia.toggle_comida(fecha, user)
     return {}
 
 
+@metrics.medido
 @http_basic_auth_login_required
 @rpc_method(name="set_feeding_assignment")
 def set_feeding_assignment(date_str, colonia_id, user_id=None, **kwargs):
@@ -29,7 +100,8 @@ def set_feeding_assignment(date_str, colonia_id, user_id=None, **kwargs):
     Args:
         date_str: Date in YYYY-MM-DD format
         colonia_id: Colony ID
-        user_id: User ID to assign (None or 0 to unassign)
+        user_id: User ID to assign, None or 0 to unassign. Users that
+            aren't admins toggle themselves with None
     """
     request = kwargs.get('request')
     if not request or not request.user.is_authenticated:
@@ -41,11 +113,7 @@ def set_feeding_assignment(date_str, colonia_id, user_id=None, **kwargs):
         
         # Parse date string (YYYY-MM-DD format)
         fecha = datetime.strptime(date_str, "%Y-%m-%d").date()
-        colonia = Colonia.objects.get(id=colonia_id)
-        
-        # Check if user has access to this colony
-        if not colonia.user_has_access(request.user):
-            return {"error": "No tiene acceso a esta colonia"}
+        colonia = get_colonia(request, id=colonia_id)
         
         # Check if user has permission to feed
         if not request.user.has_perm('gatos.alimentar_colonia'):
@@ -54,50 +122,42 @@ def set_feeding_assignment(date_str, colonia_id, user_id=None, **kwargs):
         # Check if user is admin
         is_admin = request.user.is_superuser or request.user.is_staff
         
-        # Get current assignment for this date
-        current_assignment = AsignacionComida.objects.filter(
-            colonia=colonia,
-            fecha=fecha
-        ).first()
-        
         # For normal users, they can only assign/unassign themselves
-        if not is_admin:
-            # Check if there's an existing assignment by another user
-            if current_assignment and current_assignment.usuario_id != request.user.id:
-                # Cannot modify another user's assignment
-                return {"error": "No puede modificar la asignación de otro usuario"}
-            
-            # If user_id is provided and it's not the current user, deny
-            if user_id and user_id != request.user.id:
-                return {"error": "No puede asignar a otro usuario"}
-            
-            # Default to toggling current user
-            if user_id is None:
-                if current_assignment and current_assignment.usuario_id == request.user.id:
-                    user_id = 0  # Unassign
-                else:
-                    user_id = request.user.id  # Assign self
-        
-        # Delete current assignment
-        AsignacionComida.objects.filter(colonia=colonia, fecha=fecha).delete()
-        
-        # Create new assignment if user_id is provided and not 0
-        if user_id: 
+        if not is_admin and user_id and user_id != request.user.id:
+            return {"error": "No puede asignar a otro usuario"}
+        
+        if user_id:
             try:
                 target_user = User.objects.get(id=user_id)
-                AsignacionComida.objects.create(
-                    colonia=colonia,
-                    fecha=fecha,
-                    usuario=target_user
-                )
-                return {
-                    "assigned": True,
-                    "user_id": target_user.id,
-                    "username": target_user.username,
-                    "full_name": f"{target_user.first_name} {target_user.last_name}".strip() or target_user.username
-                }
             except User.DoesNotExist:
                 return {"error": "Usuario no encontrado"}
+        
+        def decidir(actual):
+            # Cannot modify another user's assignment
+            if not is_admin and actual not in (None, request.user.id):
+                return actual
+            if user_id is None and not is_admin:
+                # Default to toggling current user
+                return None if actual == request.user.id else request.user.id
+            # Admins unassign with None or 0
+            return user_id or None
+        
+        # Compare-and-set, concurrent clicks never leave two rows or
+        # overwrite an assignment they did not see
+        assigned_id = AsignacionComida.objects.cambiar(colonia, fecha, decidir)
+        
+        if assigned_id is not None and assigned_id != (user_id or request.user.id):
+            return {"error": "No puede modificar la asignación de otro usuario"}
+        
+        if assigned_id is not None:
+            if not user_id:
+                target_user = request.user
+            return {
+                "assigned": True,
+                "user_id": target_user.id,
+                "username": target_user.username,
+                "full_name": f"{target_user.first_name} {target_user.last_name}".strip() or target_user.username
+            }
         else:
             # No assignment
             return {
@@ -113,6 +173,7 @@ def set_feeding_assignment(date_str, colonia_id, user_id=None, **kwargs):
         return {"error": str(e)}
 
 
+@metrics.medido
 @http_basic_auth_login_required
 @rpc_method(name="toggle_feeding_date")
 def toggle_feeding_date(date_str, colonia_id, **kwargs):
@@ -120,35 +181,63 @@ def toggle_feeding_date(date_str, colonia_id, **kwargs):
     return set_feeding_assignment(date_str, colonia_id, None, **kwargs)
 
 
-@rpc_method(name="get_colony_feeding_users")
-def get_colony_feeding_users(colonia_id, **kwargs):
-    """Get list of users who can be assigned to feed in a colony"""
+@metrics.medido
+@http_basic_auth_login_required
+@rpc_method(name="generate_feeding_rota")
+def generate_feeding_rota(colonia_id, start_date, end_date, user_ids=None,
+                          rule="round_robin", weekdays=None, dry_run=False,
+                          **kwargs):
+    """Assign a whole range of days at once, only for admins
+
+    Args:
+        colonia_id: Colony ID
+        start_date, end_date: Range in YYYY-MM-DD format, both included
+        user_ids: Feeders for the round_robin and gaps rules
+        rule: round_robin, weekdays or gaps
+        weekdays: For the weekdays rule, {weekday: user_id}, 0 is Monday
+        dry_run: Return the rota without saving it
+    """
     request = kwargs.get('request')
+    reglas = {"round_robin": "round_robin", "weekdays": "dias_semana",
+              "gaps": "huecos"}
     
     try:
-        colonia = Colonia.objects.get(id=colonia_id)
+        colonia = get_colonia(request, id=colonia_id)
         
-        # Check if user has access to this colony
-        if request and hasattr(request, 'user') and not colonia.user_has_access(request.user):
-            return {"error": "No tiene acceso a esta colonia"}
+        if not (request.user.is_superuser or request.user.is_staff):
+            return {"error": "Permission denied"}
         
-        from django.contrib.auth import get_user_model
-        User = get_user_model()
+        if rule not in reglas:
+            return {"error": f"Unknown rule: {rule}"}
         
-        # Get all active users with feeding permission
-        available_users = []
-        seen_ids = set()
+        start = datetime.strptime(start_date, "%Y-%m-%d").date()
+        end = datetime.strptime(end_date, "%Y-%m-%d").date()
+        plan = rotas.crear(colonia, start, end, user_ids or [],
+                           reglas[rule], weekdays, dry_run=dry_run)
         
-        for u in User.objects.filter(is_active=True):
-            if u.has_perm('gatos.alimentar_colonia') and u.id not in seen_ids:
-                available_users.append({
-                    'id': u.id,
-                    'username': u.username,
-                    'first_name': u.first_name,
-                    'last_name': u.last_name,
-                    'full_name': f"{u.first_name} {u.last_name}".strip() or u.username
-                })
-                seen_ids.add(u.id)
+        return {
+            "dates": {f"{fecha:%Y-%m-%d}": usuario
+                      for fecha, usuario in sorted(plan.items())},
+            "saved": not dry_run
+        }
+        
+    except Colonia.DoesNotExist:
+        return {"error": "Colony not found"}
+    except Exception as e:
+        return {"error": str(e)}
+
+
+@metrics.medido
+@rpc_method(name="get_colony_feeding_users")
+def get_colony_feeding_users(colonia_id, **kwargs):
+    """Get list of users who can be assigned to feed in a colony"""
+    request = kwargs.get('request')
+    
+    try:
+        colonia = get_colonia(request, id=colonia_id)
+        
+        available_users = list(get_alimentadores(colonia))
+        seen_ids = {u['id'] for u in available_users}
         
         # Check if current user is admin
         is_admin = False
@@ -183,48 +272,72 @@ def get_colony_feeding_users(colonia_id, **kwargs):
         return {"error": str(e)}
 
 
+FEEDING_MAX_DAYS = 366
+
+
+def feeding_window(start_date=None, end_date=None):
+    """Range of the calendar, by default the current and next month as
+    shown by the frontend. Ranges are capped to ``FEEDING_MAX_DAYS``."""
+    if start_date:
+        start = datetime.strptime(start_date, "%Y-%m-%d").date()
+    else:
+        start = date.today().replace(day=1)
+    if end_date:
+        end = datetime.strptime(end_date, "%Y-%m-%d").date()
+    else:
+        end = (start + timedelta(days=62)).replace(day=1) - timedelta(days=1)
+    return start, min(end, start + timedelta(days=FEEDING_MAX_DAYS))
+
+
+def feeding_version(colonia, start, end):
+    """Token that changes when the assignments or the user names do"""
+    partes = (versiones.version("comidas", colonia.id),
+              versiones.version("permisos"), start, end)
+    return hashlib.md5(repr(partes).encode()).hexdigest()
+
+
+@metrics.medido
 @rpc_method(name="get_feeding_dates")
-def get_feeding_dates(colonia_id, start_date=None, end_date=None, **kwargs):
-    """Get feeding dates for a colony to display on calendar"""
+def get_feeding_dates(colonia_id, start_date=None, end_date=None,
+                      version=None, compact=False, **kwargs):
+    """Get feeding dates for a colony to display on calendar
+
+    With ``compact`` returns a table of users and the ids of the users
+    assigned to each date, otherwise a row per assignment as the bundles
+    already deployed expect. When ``version`` is the one of the last
+    response only ``not_modified`` is returned.
+    """
     request = kwargs.get('request')
     
     try:
-        colonia = Colonia.objects.get(id=colonia_id)
-        
-        # Check if user has access to this colony (if request is provided)
-        if request and request.user and not colonia.user_has_access(request.user):
-            return {"error": "No tiene acceso a esta colonia"}
+        colonia = get_colonia(request, id=colonia_id)
         
         # Get current user for comparison
         current_user = request.user if request and hasattr(request, 'user') else None
         
-        # Query feeding assignments
-        query = AsignacionComida.objects.filter(colonia=colonia)
-        
-        if start_date:
-            start = datetime.strptime(start_date, "%Y-%m-%d").date()
-            query = query.filter(fecha__gte=start)
-        
-        if end_date:
-            end = datetime.strptime(end_date, "%Y-%m-%d").date()
-            query = query.filter(fecha__lte=end)
-        
-        # Group by date and return user info (colors determined on frontend)
-        dates = []
-        for asignacion in query:
-            dates.append({
-                "date": asignacion.fecha.strftime("%Y-%m-%d"),
-                "user_id": asignacion.usuario.id if asignacion.usuario else None,
-                "username": asignacion.usuario.username if asignacion.usuario else None,
-                "full_name": f"{asignacion.usuario.first_name} {asignacion.usuario.last_name}".strip() or asignacion.usuario.username if asignacion.usuario else None
-            })
-        
         # Check if current user is admin (only superuser or staff)
         is_admin = False
         if current_user and current_user.is_authenticated:
             is_admin = current_user.is_superuser or current_user.is_staff
         
-        return {"dates": dates, "is_admin": is_admin}
+        start, end = feeding_window(start_date, end_date)
+        token = feeding_version(colonia, start, end)
+        if version == token:
+            return {"not_modified": True, "version": token,
+                    "is_admin": is_admin}
+        
+        # Colors are determined on frontend
+        calendario = get_calendario(colonia, start, end)
+        if not compact:
+            calendario = {"dates": filas_calendario(calendario)}
+        
+        return {
+            **calendario,
+            "start_date": start.strftime("%Y-%m-%d"),
+            "end_date": end.strftime("%Y-%m-%d"),
+            "version": token,
+            "is_admin": is_admin
+        }
         
     except Colonia.DoesNotExist:
         return {"error": "Colony not found"}
@@ -232,16 +345,73 @@ def get_feeding_dates(colonia_id, start_date=None, end_date=None, **kwargs):
         return {"error": str(e)}
 
 
+@metrics.medido
 @http_basic_auth_login_required
 @rpc_method(name="avistar_gato")
 def avistar_gato(colonia_slug, gato_slug, **kwargs):
     request = kwargs['request']
-    gato = Gato.objects.get(slug=gato_slug)
     user = request.user
+    gato = cargar(request, Gato.objects.for_user(user), ambito="autorizadas",
+                  slug=gato_slug)
     gato.toggle_avistamiento(date.today(), user)
     return {}
 
 
+@metrics.medido
+@http_basic_auth_login_required
+@rpc_method(name="sync_colony")
+def sync_colony(colonia_id, operations, since=None, **kwargs):
+    """Apply the operations queued by an offline client in one transaction
+
+    Args:
+        colonia_id: Colony ID
+        operations: List of operations, each with a unique "key", a
+            "timestamp" in ISO format and a "type":
+            sighting: {"cat": slug, "seen": true}
+            feeding: {"date": "YYYY-MM-DD", "assigned": true}
+            note: {"text": "...", "cats": [slugs]}
+        since: Version of the last sync, to get the changes after it
+    """
+    request = kwargs.get('request')
+    
+    try:
+        colonia = get_colonia(request, id=colonia_id)
+        
+        return sincronizacion.aplicar(colonia, request.user, operations,
+                                      desde=since)
+        
+    except Colonia.DoesNotExist:
+        return {"error": "Colony not found"}
+    except sincronizacion.OperacionInvalida as e:
+        return {"error": str(e)}
+
+
+@metrics.medido
+@http_basic_auth_login_required
+@rpc_method(name="get_colony_changes")
+def get_colony_changes(colonia_id, since=0, **kwargs):
+    """Cats, photos, reports, sightings and feedings changed or deleted
+    after the version ``since``
+
+    Start from the snapshot at /colonia/c/<slug>/snapshot.json and keep
+    the returned version for the next call. When "reset" comes in the
+    result there are too many changes and the client should download the
+    snapshot again.
+    """
+    request = kwargs.get('request')
+    
+    try:
+        colonia = get_colonia(request, id=colonia_id)
+        
+        return sincronizacion.cambios(colonia, int(since))
+        
+    except Colonia.DoesNotExist:
+        return {"error": "Colony not found"}
+    except (TypeError, ValueError):
+        return {"error": "Invalid version"}
+
+
+@metrics.medido
 @http_basic_auth_login_required
 @rpc_method(name="nuevo_codigo_qr")
 def nuevo_codigo_qr(**kwargs):
@@ -252,6 +422,7 @@ def nuevo_codigo_qr(**kwargs):
     return "Ok"
 
 
+@metrics.medido
 @http_basic_auth_login_required
 @rpc_method(name="borrar_codigo_qr")
 def borrar_codigo_qr(**kwargs):
@@ -260,20 +431,16 @@ def borrar_codigo_qr(**kwargs):
     return "Ok"
 
 
+@metrics.medido
 @rpc_method(name="get_colony_activity")
 def get_colony_activity(colonia_slug, **kwargs):
     """Get activity data for a colony to display in activity chart"""
     try:
-        colonia = Colonia.objects.get(slug=colonia_slug)
-        
-        # Check if user has access to this colony if request is provided
         request = kwargs.get('request')
-        if request and hasattr(request, 'user') and not colonia.user_has_access(request.user):
-            return {"error": "No tiene acceso a esta colonia"}
+        colonia = get_colonia(request, slug=colonia_slug)
         
         # Get activity dates for the colony
-        activity_dates = colonia.get_actividad()
-        dates = [d.isoformat() if hasattr(d, 'isoformat') else str(d) for d in activity_dates]
+        dates = get_actividad_colonia(colonia)
         
         return {"dates": dates, "colony_name": colonia.nombre}
         
@@ -283,23 +450,16 @@ def get_colony_activity(colonia_slug, **kwargs):
         return {"error": str(e)}
 
 
+@metrics.medido
 @rpc_method(name="get_cat_activity")
 def get_cat_activity(colonia_slug, gato_slug, **kwargs):
     """Get activity data for a cat to display in activity chart"""
     try:
-        colonia = Colonia.objects.get(slug=colonia_slug)
-        gato = Gato.objects.get(slug=gato_slug, colonia=colonia)
-        
-        # Check if user has access to this colony if request is provided
         request = kwargs.get('request')
-        if request and hasattr(request, 'user') and not colonia.user_has_access(request.user):
-            return {"error": "No tiene acceso a esta colonia"}
+        colonia = get_colonia(request, slug=colonia_slug)
         
         # Get activity dates for the cat
-        activity_dates = gato.get_actividad()
-        dates = [d.isoformat() if hasattr(d, 'isoformat') else str(d) for d in activity_dates]
-        
-        return {"dates": dates, "cat_name": gato.nombre}
+        return get_actividad_gato(colonia, gato_slug)
         
     except Colonia.DoesNotExist:
         return {"error": "Colony not found"}
@@ -325,7 +485,7 @@ def gato_flow_factory(action_name):
 
     function.__name__ = func_name
     function.__doc__ = ""
-    return function
+    return metrics.medido(function)
 
 
 capturar_gato = gato_flow_factory("capturar")
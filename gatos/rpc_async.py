@@ -0,0 +1,72 @@
+"""
+Async JSON-RPC entry point for the read-only methods.
+
+django-modern-rpc 1.x only runs sync methods, so the reads the calendar and
+the activity charts make on every page load are also served here, at
+``/rpc/async/``. They are the methods of ``gatos.rpc``, run in the thread
+pool: under ASGI a slow history query no longer holds a worker. The calls
+of a batch run one after the other in the same thread, they share the
+request and its identity map, see ``gatos.identidad``.
+"""
+import json
+from django.http import HttpResponseNotAllowed, JsonResponse
+from . import rpc
+from .utils import en_hilo
+
+
+METODOS = {
+    "get_colony_activity": rpc.get_colony_activity,
+    "get_cat_activity": rpc.get_cat_activity,
+    "get_colony_feeding_users": rpc.get_colony_feeding_users,
+    "get_feeding_dates": rpc.get_feeding_dates,
+}
+
+
+def error(id, code, message):
+    return {"jsonrpc": "2.0", "id": id,
+            "error": {"code": code, "message": message}}
+
+
+def ejecutar(request, llamada):
+    if not isinstance(llamada, dict) or "method" not in llamada:
+        return error(None, -32600, "Invalid request")
+    id = llamada.get("id")
+    metodo = METODOS.get(llamada["method"])
+    if metodo is None:
+        return error(id, -32601, f"Method not found: {llamada['method']}")
+    params = llamada.get("params", {})
+    try:
+        if isinstance(params, list):
+            resultado = metodo(*params, request=request)
+        else:
+            resultado = metodo(**params, request=request)
+    except TypeError as e:
+        return error(id, -32602, f"Invalid params: {e}")
+    except Exception as e:
+        return error(id, -32000, str(e))
+    return {"jsonrpc": "2.0", "id": id, "result": resultado}
+
+
+def ejecutar_lote(request, llamadas):
+    return [ejecutar(request, llamada) for llamada in llamadas]
+
+
+async def entry_point(request):
+    """JSON-RPC 2.0, the calls of a batch run in order in one thread"""
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+    try:
+        datos = json.loads(request.body)
+    except ValueError:
+        return JsonResponse(error(None, -32700, "Parse error"))
+    if isinstance(datos, list):
+        if not datos:
+            return JsonResponse(error(None, -32600, "Empty batch"))
+        respuestas = await en_hilo(ejecutar_lote)(request, datos)
+        return JsonResponse(respuestas, safe=False)
+    return JsonResponse(await en_hilo(ejecutar)(request, datos))
+
+
+# Los decoradores de Django 4.2 no aceptan vistas asíncronas, como el
+# RPCEntryPoint las llamadas de solo lectura no necesitan CSRF
+entry_point.csrf_exempt = True
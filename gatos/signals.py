@@ -0,0 +1,127 @@
+"""
+Invalidation of the cached data that depends on users, permissions,
+authorized users and the models that belong to a colony.
+
+The same writes enter the change feed of the colony, see Cambio. The
+synced models save in a transaction, so the change is recorded together
+with the write, deletes and relations already send their signals inside
+Django's own. Feeding assignments invalidate their own version and record
+their own changes, see AsignacionComida.
+"""
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group, Permission
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from .models import (Avistamiento, Cambio, Captura, Colonia, Enfermedad, Foto,
+                     Gato, Informe, Vacunacion)
+from .versiones import invalidar
+
+User = get_user_model()
+
+CAMBIOS = ("post_add", "post_remove", "post_clear")
+
+# Camino desde cada modelo hasta el id de su colonia
+COLONIAS = {
+    Colonia: "pk",
+    Gato: "colonia_id",
+    Foto: "colonia_id",
+    Informe: "colonia_id",
+    Avistamiento: "colonia_id",
+    Captura: "gato.colonia_id",
+    Enfermedad: "gato.colonia_id",
+    Vacunacion: "captura.gato.colonia_id",
+}
+
+# Modelos que los clientes sincronizan, ver gatos.sincronizacion
+SINCRONIZADOS = (Gato, Foto, Avistamiento, Informe)
+
+
+def colonia_de(instance):
+    valor = instance
+    try:
+        for atributo in COLONIAS[type(instance)].split("."):
+            valor = getattr(valor, atributo)
+    except ObjectDoesNotExist:
+        # Se está borrando en cascada junto con la colonia o el gato
+        return None
+    return valor
+
+
+def invalidar_permisos(sender, action=None, update_fields=None, **kwargs):
+    if update_fields is not None and set(update_fields) <= {"last_login"}:
+        # Cada login guarda el usuario, no cambia nada de lo que dependa
+        return
+    if action is None or action in CAMBIOS:
+        invalidar("permisos")
+
+
+def invalidar_autorizados(sender, instance, action, reverse, pk_set,
+                          **kwargs):
+    if action not in CAMBIOS:
+        return
+    if pk_set is None:
+        # clear() no dice qué usuarios o colonias había
+        invalidar("permisos")
+        if not reverse:
+            invalidar("colonia", instance.pk)
+        return
+    colonias, usuarios = (pk_set, [instance.pk]) if reverse else \
+        ([instance.pk], pk_set)
+    for pk in colonias:
+        invalidar("colonia", pk)
+    for pk in usuarios:
+        invalidar("autorizadas", pk)
+
+
+def invalidar_colonia(sender, instance, action=None, **kwargs):
+    if action is not None and action not in CAMBIOS:
+        return
+    colonia_id = colonia_de(instance)
+    if colonia_id is not None:
+        invalidar("colonia", colonia_id)
+
+
+def registrar_cambio(sender, instance, origin=None, **kwargs):
+    if isinstance(origin, Colonia) or getattr(origin, "model", None) is Colonia:
+        # El registro de la colonia se borra con ella
+        return
+    colonia_id = colonia_de(instance)
+    if colonia_id is not None:
+        borrado = kwargs.get("signal") is post_delete
+        Cambio.objects.registrar(colonia_id, instance._meta.model_name,
+                                 [instance.pk], borrado)
+
+
+def registrar_relacion(sender, instance, action, reverse, model, pk_set,
+                       **kwargs):
+    """The objects whose list of cats changed"""
+    if action not in CAMBIOS:
+        return
+    if not reverse:
+        registrar_cambio(sender, instance)
+    elif pk_set:
+        colonia_id = colonia_de(instance)
+        if colonia_id is not None:
+            Cambio.objects.registrar(colonia_id, model._meta.model_name,
+                                     sorted(pk_set))
+
+
+def conectar():
+    for through in (User.groups.through, User.user_permissions.through,
+                    Group.permissions.through):
+        m2m_changed.connect(invalidar_permisos, sender=through)
+    m2m_changed.connect(invalidar_autorizados,
+                        sender=Colonia.usuarios_autorizados.through)
+    for modelo in (User, Group, Permission):
+        post_save.connect(invalidar_permisos, sender=modelo)
+        post_delete.connect(invalidar_permisos, sender=modelo)
+    for modelo in COLONIAS:
+        post_save.connect(invalidar_colonia, sender=modelo)
+        post_delete.connect(invalidar_colonia, sender=modelo)
+    for through in (Foto.gatos.through, Informe.gatos.through):
+        m2m_changed.connect(invalidar_colonia, sender=through)
+    for modelo in SINCRONIZADOS:
+        post_save.connect(registrar_cambio, sender=modelo)
+        post_delete.connect(registrar_cambio, sender=modelo)
+    for through in (Foto.gatos.through, Informe.gatos.through):
+        m2m_changed.connect(registrar_relacion, sender=through)
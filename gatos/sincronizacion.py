@@ -0,0 +1,415 @@
+"""
+Synchronization of offline clients.
+
+A client in the field queues its operations while there is no signal and
+uploads them in one batch when it gets it back:
+
+    aplicar(colonia, usuario, [
+        {"key": "8f1c...", "type": "sighting", "timestamp":
+         "2026-10-19T08:15:00+02:00", "cat": "misi", "seen": True},
+        {"key": "9a2e...", "type": "feeding", "timestamp": ...,
+         "date": "2026-10-20", "assigned": True},
+        {"key": "b37d...", "type": "note", "timestamp": ...,
+         "text": "Misi cojea", "cats": ["misi"]},
+    ])
+
+Operations are applied in the order of their timestamps, which must have
+a UTC offset, in a single transaction. Each one carries an idempotency
+key, the results are stored with it and a repeated upload gets them back
+without applying anything. As online, only the feedings of the days after
+today can change.
+Sightings and feedings state what the client saw, not a toggle, so
+replaying them is harmless anyway.
+
+Every write to a synchronized model enters the change feed of its colony
+(``Cambio``), whose versions work as sync tokens: ``cambios`` returns what
+changed after the token the client got in its last sync. A client without
+a token starts from ``snapshot``, the whole colony at a version.
+"""
+from datetime import date, datetime, timedelta, timezone
+from functools import cached_property
+import gzip
+import json
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, transaction
+from .models import (AsignacionComida, Avistamiento, Cambio, Informe,
+                     OperacionSync)
+from .versiones import NOMBRES, invalidar, obtener
+
+# Días que puede pasar un cliente sin conexión
+MAX_DIAS_OFFLINE = 31
+MAX_OPERACIONES = 500
+# Con más cambios pendientes sale más a cuenta bajar el snapshot
+MAX_CAMBIOS = 2000
+SNAPSHOT_TIMEOUT = 24 * 60 * 60
+
+NOMBRES.add("snapshot")
+
+
+class OperacionInvalida(ValueError):
+    pass
+
+
+def fecha_cliente(operacion):
+    """Day of the operation in the timezone of the client"""
+    try:
+        fecha = datetime.fromisoformat(operacion["timestamp"]).date()
+    except (KeyError, TypeError, ValueError):
+        raise OperacionInvalida("Invalid timestamp")
+    hoy = date.today()
+    # El cliente puede ir por delante si está más al este
+    desde = hoy - timedelta(days=MAX_DIAS_OFFLINE)
+    if not desde <= fecha <= hoy + timedelta(days=1):
+        raise OperacionInvalida("Timestamp out of range")
+    return min(fecha, hoy)
+
+
+def instante(operacion):
+    """Moment of the operation in UTC, to apply them in order"""
+    try:
+        momento = datetime.fromisoformat(operacion["timestamp"])
+    except (KeyError, TypeError, ValueError):
+        raise OperacionInvalida("Invalid timestamp")
+    if momento.tzinfo is None:
+        raise OperacionInvalida("Timestamp without timezone")
+    return momento.astimezone(timezone.utc)
+
+
+def nombre_completo(usuario):
+    return f"{usuario.first_name} {usuario.last_name}".strip()
+
+
+# ------------------------------------------------------------------------
+#                Serialización de los cambios
+# ------------------------------------------------------------------------
+
+
+def url(fichero):
+    return fichero.url if fichero else None
+
+
+def dia(fecha):
+    return fecha.isoformat() if fecha else None
+
+
+def gato(g):
+    return {"id": g.id, "slug": g.slug, "name": g.nombre, "color": g.color,
+            "sex": g.sexo, "status": g.estado, "portrait": g.retrato_id,
+            "sterilized": dia(g.esterilizacion), "dead": g.muerto,
+            "dead_date": dia(g.muerto_fecha), "neighbour": g.vecino,
+            "neighbour_name": g.nombre_vecino, "ugly": g.feo,
+            "marked": g.marcado, "url": g.get_absolute_url()}
+
+
+def foto(f):
+    return {"id": f.id, "date": dia(f.fecha), "description": f.descripcion,
+            "ugly": f.fea, "user_id": f.usuario_id, "url": url(f.foto),
+            "thumbnail": url(f.miniatura),
+            "cats": [g.slug for g in f.gatos.all()]}
+
+
+def avistamiento(a):
+    return {"id": a.id, "cat": a.gato.slug, "date": a.fecha.isoformat(),
+            "user_id": a.usuario_id}
+
+
+def asignacion(a):
+    return {"date": a.fecha.isoformat(), "user_id": a.usuario_id}
+
+
+def informe(i):
+    return {"id": i.id, "title": i.titulo, "text": i.texto,
+            "date": i.fecha.isoformat(), "user_id": i.usuario_id,
+            "cats": [g.slug for g in i.gatos.all()]}
+
+
+# Nombre en el cliente, objetos de la colonia, campo de la clave y
+# serialización de cada modelo del registro de cambios
+MODELOS = {
+    "gato": ("cats", lambda c: c.gatos.select_related("colonia"), "id",
+             gato),
+    "foto": ("photos", lambda c: c.fotos.prefetch_related("gatos"), "id",
+             foto),
+    "avistamiento": ("sightings",
+                     lambda c: c.avistamientos.select_related("gato"),
+                     "id", avistamiento),
+    "asignacioncomida": ("feedings", lambda c: c.comidas.all(), "fecha",
+                         asignacion),
+    "informe": ("reports",
+                lambda c: c.informes.prefetch_related("gatos"), "id",
+                informe),
+}
+
+
+def cambios(colonia, desde=0, limite=MAX_CAMBIOS, modelos=None):
+    """Changes of the colony after the version ``desde``.
+
+    Each object appears once, with its current state or among the deleted
+    ones, whatever number of times it changed. With more than ``limite``
+    changes the result only has ``reset`` and the client should start
+    again from the snapshot. ``modelos`` restricts them to some models.
+    """
+    modelos = {m: MODELOS[m] for m in modelos or MODELOS}
+    filas = list(colonia.cambios
+                 .filter(version__gt=desde, modelo__in=list(modelos))
+                 .order_by("version")
+                 .values_list("version", "modelo", "objeto", "borrado")
+                 [:limite + 1])
+    if len(filas) > limite:
+        return {"reset": True, "version": Cambio.objects.version(colonia)}
+    ultimos = {}
+    version = desde
+    for version, modelo, objeto, borrado in filas:
+        ultimos[(modelo, objeto)] = borrado
+    changed = {}
+    deleted = {}
+    for modelo, (nombre, objetos, campo, serializar) in modelos.items():
+        claves = {objeto: borrado
+                  for (m, objeto), borrado in ultimos.items() if m == modelo}
+        if not claves:
+            changed[nombre] = deleted[nombre] = []
+            continue
+        queryset = objetos(colonia)
+        a_python = queryset.model._meta.get_field(campo).to_python
+        claves = {a_python(objeto): borrado
+                  for objeto, borrado in claves.items()}
+        vivos = queryset.filter(**{f"{campo}__in": [
+            clave for clave, borrado in claves.items() if not borrado]})
+        encontrados = set()
+        changed[nombre] = []
+        for objeto in vivos:
+            encontrados.add(getattr(objeto, campo))
+            changed[nombre].append(serializar(objeto))
+        # Lo que se borró después de cambiar también está borrado
+        deleted[nombre] = sorted(
+            str(clave) if campo == "fecha" else clave
+            for clave in claves if clave not in encontrados)
+    return {"version": version, "changed": changed, "deleted": deleted}
+
+
+def snapshot(colonia, version=None):
+    """Everything a client synchronizes of the colony.
+
+    The version is read first, a change made while the snapshot is built
+    comes again in the next ``cambios``, which is harmless.
+    """
+    if version is None:
+        version = Cambio.objects.version(colonia)
+    datos = {nombre: [serializar(o) for o in objetos(colonia)]
+             for nombre, objetos, _, serializar in MODELOS.values()}
+    return {"version": version, "colony": {"id": colonia.id,
+                                           "slug": colonia.slug,
+                                           "name": colonia.nombre},
+            **datos}
+
+
+def snapshot_gzip(colonia, version):
+    """The snapshot at ``version`` as compressed JSON, cached per version"""
+
+    def calcular():
+        datos = json.dumps(snapshot(colonia, version), cls=DjangoJSONEncoder,
+                           separators=(",", ":"))
+        return gzip.compress(datos.encode(), compresslevel=6)
+
+    clave = f"snapshot:{colonia.id}:{version}"
+    return obtener(clave, calcular, SNAPSHOT_TIMEOUT, nombre="snapshot")
+
+
+# ------------------------------------------------------------------------
+#                Aplicación de las operaciones
+# ------------------------------------------------------------------------
+
+
+class Lote:
+    """Operations of one upload, grouped to write them in bulk"""
+
+    def __init__(self, colonia, usuario):
+        self.colonia = colonia
+        self.usuario = usuario
+        self.avistamientos = {}
+        self.notas = []
+
+    @cached_property
+    def gatos(self):
+        return {g.slug: g for g in self.colonia.gatos.all()}
+
+    def gato(self, slug):
+        try:
+            return self.gatos[slug]
+        except KeyError:
+            raise OperacionInvalida(f"Cat not found: {slug}")
+
+    def permiso(self, permiso):
+        if not self.usuario.has_perm(permiso):
+            raise OperacionInvalida("Permission denied")
+
+    def sighting(self, operacion):
+        self.permiso("gatos.avistar_gato")
+        gato = self.gato(operacion.get("cat"))
+        fecha = fecha_cliente(operacion)
+        # Gana la última operación de cada gato y día
+        visto = bool(operacion.get("seen", True))
+        self.avistamientos[(gato.id, fecha)] = visto
+        return {"cat": gato.slug, "date": fecha.isoformat()}
+
+    def feeding(self, operacion):
+        self.permiso("gatos.alimentar_colonia")
+        fecha_cliente(operacion)
+        try:
+            fecha = date.fromisoformat(operacion["date"])
+        except (KeyError, TypeError, ValueError):
+            raise OperacionInvalida("Invalid date")
+        if not AsignacionComida.modificable(fecha):
+            raise OperacionInvalida("Past date")
+        usuario_id = self.usuario.id
+        asignar = bool(operacion.get("assigned", True))
+
+        def decidir(actual):
+            if actual not in (None, usuario_id):
+                return actual
+            return usuario_id if asignar else None
+
+        # Cada día es un compare-and-set, ver AsignacionComida.objects
+        asignado = AsignacionComida.objects.cambiar(self.colonia, fecha,
+                                                    decidir)
+        if asignado not in (None, usuario_id):
+            raise OperacionInvalida("Assigned to another user")
+        return {"date": fecha.isoformat(), "user_id": asignado}
+
+    def note(self, operacion):
+        self.permiso("gatos.add_informe")
+        texto = str(operacion.get("text", "")).strip()
+        if not texto:
+            raise OperacionInvalida("Empty note")
+        gatos = [self.gato(slug) for slug in operacion.get("cats", [])]
+        informe = Informe(colonia=self.colonia, usuario=self.usuario,
+                          nombre_usuario=nombre_completo(self.usuario),
+                          titulo=texto.splitlines()[0][:250], texto=texto)
+        self.notas.append((informe, gatos))
+        return {"title": informe.titulo}
+
+    def guardar(self):
+        self.guardar_avistamientos()
+        self.guardar_notas()
+
+    def guardar_avistamientos(self):
+        if not self.avistamientos:
+            return
+        existentes = {}
+        gatos = {g for g, _ in self.avistamientos}
+        fechas = {f for _, f in self.avistamientos}
+        for id, gato_id, fecha in (Avistamiento.objects
+                                   .filter(colonia=self.colonia,
+                                           gato_id__in=gatos,
+                                           fecha__in=fechas)
+                                   .values_list("id", "gato_id", "fecha")):
+            existentes.setdefault((gato_id, fecha), []).append(id)
+        nuevos = [clave for clave, visto in self.avistamientos.items()
+                  if visto and clave not in existentes]
+        borrados = [id for clave, visto in self.avistamientos.items()
+                    if not visto for id in existentes.get(clave, [])]
+        if borrados:
+            Avistamiento.objects.filter(id__in=borrados).delete()
+        creados = Avistamiento.objects.bulk_create([
+            Avistamiento(colonia=self.colonia, gato_id=gato_id,
+                         usuario=self.usuario,
+                         nombre_usuario=nombre_completo(self.usuario))
+            for gato_id, _ in nuevos])
+        # La fecha es auto_now, la del cliente se pone después
+        for (_, fecha), avistamiento in zip(nuevos, creados):
+            avistamiento.fecha = fecha
+        for fecha in {fecha for _, fecha in nuevos} - {date.today()}:
+            Avistamiento.objects.filter(
+                id__in=[a.id for a in creados if a.fecha == fecha]
+            ).update(fecha=fecha)
+        Cambio.objects.registrar(self.colonia.id, "avistamiento",
+                                 [a.id for a in creados])
+
+    def guardar_notas(self):
+        if not self.notas:
+            return
+        informes = Informe.objects.bulk_create([i for i, _ in self.notas])
+        Informe.gatos.through.objects.bulk_create([
+            Informe.gatos.through(informe_id=informe.id, gato_id=gato.id)
+            for informe, (_, gatos) in zip(informes, self.notas)
+            for gato in gatos])
+        Cambio.objects.registrar(self.colonia.id, "informe",
+                                 [i.id for i in informes])
+
+
+TIPOS = ("sighting", "feeding", "note")
+
+
+def _aplicar(colonia, usuario, operaciones):
+    claves = [o["key"] for o in operaciones]
+    resultados = dict(OperacionSync.objects
+                      .filter(usuario=usuario, clave__in=claves)
+                      .values_list("clave", "resultado"))
+    lote = Lote(colonia, usuario)
+    nuevos = {}
+    validas = []
+    invalidas = {}
+    for operacion in operaciones:
+        try:
+            validas.append((instante(operacion), operacion))
+        except OperacionInvalida as e:
+            invalidas.setdefault(operacion["key"], str(e))
+    # Las horas de cada cliente pueden venir con distinto desfase
+    validas.sort(key=lambda v: v[0])
+    for _, operacion in validas:
+        clave = operacion["key"]
+        if clave in resultados or clave in nuevos:
+            continue
+        try:
+            tipo = operacion.get("type")
+            if tipo not in TIPOS:
+                raise OperacionInvalida(f"Unknown type: {tipo}")
+            nuevos[clave] = {"ok": True, "result":
+                             getattr(lote, operacion["type"])(operacion)}
+        except OperacionInvalida as e:
+            nuevos[clave] = {"ok": False, "error": str(e)}
+    for clave, error in invalidas.items():
+        if clave not in resultados and clave not in nuevos:
+            nuevos[clave] = {"ok": False, "error": error}
+    lote.guardar()
+    OperacionSync.objects.bulk_create([
+        OperacionSync(usuario=usuario, clave=clave, resultado=resultado)
+        for clave, resultado in nuevos.items()])
+    return {**resultados, **nuevos}
+
+
+def validar(operaciones):
+    if not isinstance(operaciones, list):
+        raise OperacionInvalida("Operations must be a list")
+    if len(operaciones) > MAX_OPERACIONES:
+        raise OperacionInvalida(
+            f"No more than {MAX_OPERACIONES} operations per sync")
+    for operacion in operaciones:
+        clave = operacion.get("key") if isinstance(operacion, dict) else None
+        if not isinstance(clave, str) or not 0 < len(clave) <= 64:
+            raise OperacionInvalida("Every operation needs a key")
+
+
+def aplicar(colonia, usuario, operaciones, desde=None, intentos=2):
+    """Apply the operations and return their results, by key, and the
+    changes after the version ``desde`` if given"""
+    validar(operaciones)
+    for intento in range(intentos):
+        try:
+            with transaction.atomic():
+                resultados = _aplicar(colonia, usuario, operaciones)
+            break
+        except IntegrityError:
+            # Otra subida con las mismas claves ganó, la siguiente vuelta
+            # devuelve sus resultados
+            if intento == intentos - 1:
+                raise
+    if any(r["ok"] for r in resultados.values()):
+        invalidar("colonia", colonia.id)
+    respuesta = {"results": [{"key": o["key"], **resultados[o["key"]]}
+                             for o in operaciones]}
+    if desde is not None:
+        respuesta["changes"] = cambios(colonia, desde)
+    else:
+        respuesta["version"] = Cambio.objects.version(colonia)
+    return respuesta
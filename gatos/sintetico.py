@@ -0,0 +1,382 @@
+"""
+Synthetic colonies for benchmarks and load tests.
+
+The data of the volunteers can't leave production, so performance work is
+measured against colonies generated here: cats in every ``EstadoGato``,
+years of photos, reports, captures with the vaccines of ``vacunas.yml``,
+diseases, daily sightings and feeding rotas. The same seed generates the
+same data, and all of it goes in with ``bulk_create``, so there are no
+signals, no change feed entries and no thumbnails to build.
+
+    informe = sembrar(colonias=3, gatos=1000, dias=3 * 365, semilla=1)
+"""
+from contextlib import contextmanager
+from datetime import date, timedelta
+from decimal import Decimal
+import hashlib
+from io import BytesIO
+import random
+from PIL import Image, ImageDraw
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import Group
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils.text import slugify
+from .data import vacunas
+from .models import (AsignacionComida, Avistamiento, Captura, Colonia,
+                     Enfermedad, EstadoGato, Foto, Gato, Informe, SEXOS,
+                     Vacunacion)
+from .versiones import invalidar
+
+NOMBRES = ["Misi", "Pelusa", "Tigre", "Luna", "Simba", "Nala", "Garfield",
+           "Canela", "Bigotes", "Sombra", "Copito", "Chispa", "Manchas",
+           "Nieve", "Oreo", "Pantera", "Rayas", "Trufa", "Zarpas", "Milo"]
+COLORES = ["negro", "blanco", "atigrado", "naranja", "gris", "carey",
+           "tricolor", "blanco y negro", "siamés", "pardo"]
+DIAGNOSTICOS = ["Catarro", "Conjuntivitis", "Sarna", "Herida", "Otitis",
+                "Gingivitis", "Parásitos", "Cojera"]
+
+# Proporción de gatos en cada estado
+ESTADOS = {
+    EstadoGato.LIBRE: 60,
+    EstadoGato.CAPTURADO: 5,
+    EstadoGato.DESAPARECIDO: 15,
+    EstadoGato.OLVIDADO: 10,
+    EstadoGato.MUERTO: 10,
+}
+IMAGENES = 16
+TAMANO_IMAGEN = (64, 48)
+
+
+@contextmanager
+def fechas_manuales():
+    """Turn off ``auto_now`` and ``auto_now_add``, that ``bulk_create``
+    applies too and would date the whole history today"""
+    campos = [campo for modelo in apps.get_app_config("gatos").get_models()
+              for campo in modelo._meta.concrete_fields
+              if getattr(campo, "auto_now", False)
+              or getattr(campo, "auto_now_add", False)]
+    antes = [(campo.auto_now, campo.auto_now_add) for campo in campos]
+    for campo in campos:
+        campo.auto_now = campo.auto_now_add = False
+    try:
+        yield
+    finally:
+        for campo, (auto_now, auto_now_add) in zip(campos, antes):
+            campo.auto_now, campo.auto_now_add = auto_now, auto_now_add
+
+
+def imagenes(semilla, total=IMAGENES):
+    """JPEG contents of ``total`` small cat-like drawings"""
+    rng = random.Random(f"{semilla}-imagenes")
+    resultado = []
+    for _ in range(total):
+        fondo = tuple(rng.randrange(256) for _ in range(3))
+        gato = tuple(rng.randrange(256) for _ in range(3))
+        imagen = Image.new("RGB", TAMANO_IMAGEN, fondo)
+        dibujo = ImageDraw.Draw(imagen)
+        dibujo.ellipse((16, 14, 48, 44), fill=gato)
+        dibujo.polygon([(18, 20), (22, 4), (30, 16)], fill=gato)
+        dibujo.polygon([(46, 20), (42, 4), (34, 16)], fill=gato)
+        contenido = BytesIO()
+        imagen.save(contenido, format="JPEG")
+        datos = contenido.getvalue()
+        resultado.append((datos, hashlib.sha256(datos).hexdigest()))
+    return resultado
+
+
+def insertar(modelo, filas, batch_size):
+    """``bulk_create`` of an iterable too big for memory, returns how many
+    rows went in"""
+    total = 0
+    lote = []
+    for fila in filas:
+        lote.append(fila)
+        if len(lote) == batch_size:
+            modelo.objects.bulk_create(lote)
+            total += len(lote)
+            lote = []
+    if lote:
+        modelo.objects.bulk_create(lote)
+        total += len(lote)
+    return total
+
+
+def dias_entre(inicio, fin):
+    for n in range((fin - inicio).days + 1):
+        yield inicio + timedelta(n)
+
+
+class Sembrador:
+    """Generator of one colony, every random choice comes from ``rng``"""
+
+    def __init__(self, colonia, rng, inicio, hasta, voluntarios, imagenes,
+                 batch_size):
+        self.colonia = colonia
+        self.rng = rng
+        self.inicio = inicio
+        self.hasta = hasta
+        self.voluntarios = voluntarios
+        self.imagenes = imagenes
+        self.batch_size = batch_size
+        self.informe = {}
+
+    def contar(self, modelo, total):
+        nombre = modelo._meta.model_name
+        self.informe[nombre] = self.informe.get(nombre, 0) + total
+
+    def crear(self, modelo, objetos):
+        creados = modelo.objects.bulk_create(objetos,
+                                             batch_size=self.batch_size)
+        self.contar(modelo, len(creados))
+        return creados
+
+    def voluntario(self):
+        return self.rng.choice(self.voluntarios).pk
+
+    def fecha(self, inicio, fin):
+        return inicio + timedelta(self.rng.randint(0, (fin - inicio).days))
+
+    def sembrar(self, gatos):
+        self.crear_gatos(gatos)
+        self.crear_fotos()
+        self.crear_capturas()
+        self.crear_informes()
+        self.contar(Avistamiento, insertar(Avistamiento, self.avistamientos(),
+                                           self.batch_size))
+        self.contar(AsignacionComida, insertar(
+            AsignacionComida, self.comidas(), self.batch_size))
+        return self.informe
+
+    def vida(self, estado):
+        """First and last day a cat of ``estado`` was around"""
+        ultimo = self.hasta - timedelta(30)
+        alta = self.fecha(self.inicio, max(self.inicio, ultimo))
+        if estado in (EstadoGato.LIBRE, EstadoGato.CAPTURADO):
+            return alta, self.hasta
+        # Ya no entra en el periodo activo de la colonia
+        limite = self.hasta - self.colonia.periodo_activo - timedelta(10)
+        if limite <= alta:
+            alta = self.fecha(self.inicio, max(self.inicio, limite))
+        return alta, self.fecha(alta, max(alta, limite))
+
+    def crear_gatos(self, total):
+        estados = list(ESTADOS)
+        gatos = []
+        vidas = []
+        for i in range(total):
+            # Al menos uno de cada estado
+            estado = estados[i] if i < len(estados) else \
+                self.rng.choices(estados, weights=ESTADOS.values())[0]
+            alta, fin = self.vida(estado)
+            nombre = f"{self.rng.choice(NOMBRES)} {self.colonia.slug} {i}"
+            muerto = estado == EstadoGato.MUERTO
+            vecino = self.rng.random() < 0.03
+            gatos.append(Gato(
+                nombre=nombre, slug=slugify(nombre),
+                color=self.rng.choice(COLORES),
+                descripcion=f"Gato sintético número {i}",
+                colonia=self.colonia, sexo=self.rng.choice(SEXOS)[0],
+                feo=self.rng.random() < 0.02, vecino=vecino,
+                nombre_vecino="la vecina" if vecino else "",
+                fecha_alta=alta, muerto=muerto,
+                muerto_fecha=fin if muerto else None, estado=estado,
+                marcado=self.rng.random() < 0.5))
+            vidas.append((alta, fin))
+        self.gatos = self.crear(Gato, gatos)
+        self.vidas = {gato.pk: vida for gato, vida in zip(self.gatos, vidas)}
+
+    def guardar_imagen(self, carpeta, n):
+        datos, hash_contenido = self.imagenes[n % len(self.imagenes)]
+        nombre = f"sintetico/{self.colonia.slug}/{carpeta}/{n}.jpg"
+        return default_storage.save(nombre, ContentFile(datos)), \
+            hash_contenido
+
+    def crear_fotos(self):
+        fotos = []
+        retratados = []
+        for gato in self.gatos:
+            alta, fin = self.vidas[gato.pk]
+            dia = alta
+            while dia <= fin:
+                n = len(fotos)
+                foto = Foto(colonia=self.colonia, usuario_id=self.voluntario(),
+                            fecha=dia, fea=self.rng.random() < 0.03,
+                            version_proceso=Foto.VERSION_PROCESO)
+                if self.imagenes:
+                    foto.foto, foto.hash_contenido = \
+                        self.guardar_imagen("fotos", n)
+                    foto.miniatura, _ = self.guardar_imagen("miniaturas", n)
+                else:
+                    foto.foto = f"sintetico/{self.colonia.slug}/fotos/{n}.jpg"
+                    foto.miniatura = (f"sintetico/{self.colonia.slug}/"
+                                      f"miniaturas/{n}.jpg")
+                fotos.append(foto)
+                retratados.append(gato)
+                dia += timedelta(self.rng.randint(20, 90))
+        fotos = self.crear(Foto, fotos)
+        relaciones = []
+        for foto, gato in zip(fotos, retratados):
+            relaciones.append(Foto.gatos.through(foto_id=foto.pk,
+                                                 gato_id=gato.pk))
+            otro = self.rng.choice(self.gatos)
+            if otro is not gato and self.rng.random() < 0.1:
+                relaciones.append(Foto.gatos.through(foto_id=foto.pk,
+                                                     gato_id=otro.pk))
+            # La última foto de cada gato es su retrato
+            gato.retrato_id = foto.pk
+        Foto.gatos.through.objects.bulk_create(relaciones,
+                                               batch_size=self.batch_size)
+        Gato.objects.bulk_update(self.gatos, ["retrato"],
+                                 batch_size=self.batch_size)
+
+    def crear_capturas(self):
+        tipos = [tipo for tipo, _ in vacunas.get_choices()]
+        capturas = []
+        for gato in self.gatos:
+            alta, fin = self.vidas[gato.pk]
+            veces = self.rng.choices((0, 1, 2, 3), weights=(3, 4, 2, 1))[0]
+            if gato.estado == EstadoGato.CAPTURADO:
+                veces = max(veces, 1)
+            fechas = sorted(self.fecha(alta, fin) for _ in range(veces))
+            for n, dia in enumerate(fechas):
+                ultima = n == len(fechas) - 1
+                if ultima and gato.estado == EstadoGato.CAPTURADO:
+                    dia = self.fecha(max(alta, fin - timedelta(10)), fin)
+                    liberacion = None
+                else:
+                    liberacion = dia + timedelta(self.rng.randint(1, 10))
+                capturas.append(Captura(
+                    gato=gato, usuario_id=self.voluntario(),
+                    fecha_captura=dia, fecha_liberacion=liberacion,
+                    peso=Decimal(self.rng.randint(250, 650)) / 100,
+                    esterilizacion=n == 0,
+                    observaciones=""))
+                if n == 0:
+                    gato.esterilizacion = dia
+        capturas = self.crear(Captura, capturas)
+        Gato.objects.bulk_update(self.gatos, ["esterilizacion"],
+                                 batch_size=self.batch_size)
+        vacunaciones = []
+        enfermedades = []
+        for captura in capturas:
+            for tipo in self.rng.sample(tipos,
+                                        self.rng.randint(0, len(tipos))):
+                vacunaciones.append(Vacunacion(
+                    captura=captura, tipo=tipo, efecto=vacunas[tipo].efecto,
+                    usuario_id=captura.usuario_id))
+            if self.rng.random() < 0.15:
+                curacion = captura.fecha_captura + \
+                    timedelta(self.rng.randint(7, 30))
+                enfermedades.append(Enfermedad(
+                    gato=captura.gato, usuario_id=captura.usuario_id,
+                    diagnostico=self.rng.choice(DIAGNOSTICOS),
+                    fecha_diagnostico=captura.fecha_captura,
+                    fecha_curacion=curacion if curacion <= self.hasta
+                    else None))
+        self.crear(Vacunacion, vacunaciones)
+        self.crear(Enfermedad, enfermedades)
+
+    def crear_informes(self):
+        informes = []
+        for n, dia in enumerate(dias_entre(self.inicio, self.hasta)):
+            if n % 7 or self.rng.random() < 0.2:
+                continue
+            informes.append(Informe(colonia=self.colonia,
+                                    usuario_id=self.voluntario(), fecha=dia,
+                                    titulo=f"Informe del {dia:%d/%m/%Y}",
+                                    texto="Todo tranquilo en la colonia."))
+        informes = self.crear(Informe, informes)
+        relaciones = []
+        for informe in informes:
+            vivos = [gato for gato in self.rng.sample(
+                        self.gatos, min(len(self.gatos), 8))
+                     if self.vidas[gato.pk][0] <= informe.fecha
+                     <= self.vidas[gato.pk][1]]
+            for gato in vivos[:self.rng.randint(1, 4)]:
+                relaciones.append(Informe.gatos.through(informe_id=informe.pk,
+                                                        gato_id=gato.pk))
+        Informe.gatos.through.objects.bulk_create(relaciones,
+                                                  batch_size=self.batch_size)
+
+    def avistamientos(self):
+        for gato in self.gatos:
+            alta, fin = self.vidas[gato.pk]
+            frecuencia = self.rng.uniform(0.3, 0.9)
+            for dia in dias_entre(alta, fin):
+                if self.rng.random() < frecuencia:
+                    yield Avistamiento(gato_id=gato.pk,
+                                       colonia_id=self.colonia.pk,
+                                       usuario_id=self.voluntario(),
+                                       fecha=dia)
+
+    def comidas(self):
+        """Each volunteer has a day of the week, some swap it"""
+        for dia in dias_entre(self.inicio, self.hasta + timedelta(60)):
+            if self.rng.random() < 0.1:
+                continue
+            if self.rng.random() < 0.15:
+                usuario_id = self.voluntario()
+            else:
+                turno = dia.toordinal() % len(self.voluntarios)
+                usuario_id = self.voluntarios[turno].pk
+            yield AsignacionComida(colonia_id=self.colonia.pk,
+                                   usuario_id=usuario_id, fecha=dia)
+
+
+def crear_voluntarios(colonia, total):
+    User = get_user_model()
+    voluntarios = User.objects.bulk_create(
+        User(username=f"{colonia.slug}-voluntario-{n}",
+             first_name="Voluntario", last_name=str(n),
+             password=make_password(None))
+        for n in range(total))
+    colonia.usuarios_autorizados.through.objects.bulk_create(
+        colonia.usuarios_autorizados.through(colonia_id=colonia.pk,
+                                             user_id=usuario.pk)
+        for usuario in voluntarios)
+    cuidadores = Group.objects.filter(name="cuidador").first()
+    if cuidadores is not None:
+        User.groups.through.objects.bulk_create(
+            User.groups.through(group_id=cuidadores.pk, user_id=usuario.pk)
+            for usuario in voluntarios)
+    return voluntarios
+
+
+def sembrar(colonias=3, gatos=300, dias=2 * 365, voluntarios=8, semilla=1,
+            hasta=None, prefijo="sintetica", con_imagenes=True,
+            batch_size=2000):
+    """Create ``colonias`` colonies named ``prefijo-N`` with ``dias`` days
+    of history up to ``hasta``, returns the rows created of each model"""
+    for nombre, valor in (("colonias", colonias), ("gatos", gatos),
+                          ("dias", dias), ("voluntarios", voluntarios),
+                          ("batch_size", batch_size)):
+        if valor < 1:
+            raise ValueError(f"{nombre} tiene que ser positivo: {valor}")
+    hasta = hasta or date.today()
+    inicio = hasta - timedelta(dias)
+    slugs = [f"{prefijo}-{n}" for n in range(colonias)]
+    existentes = list(Colonia.objects.filter(slug__in=slugs)
+                      .values_list("slug", flat=True))
+    if existentes:
+        raise ValueError(f"Ya existen las colonias {', '.join(existentes)}")
+    contenidos = imagenes(semilla) if con_imagenes else []
+    informe = {}
+    with fechas_manuales(), transaction.atomic():
+        for n, slug in enumerate(slugs):
+            colonia = Colonia.objects.create(
+                slug=slug, nombre=f"Colonia sintética {n}",
+                descripcion="Datos generados para pruebas de rendimiento")
+            sembrador = Sembrador(
+                colonia, random.Random(f"{semilla}-{n}"), inicio, hasta,
+                crear_voluntarios(colonia, voluntarios), contenidos,
+                batch_size)
+            for modelo, total in sembrador.sembrar(gatos).items():
+                informe[modelo] = informe.get(modelo, 0) + total
+            invalidar("colonia", colonia.pk)
+            invalidar("comidas", colonia.pk)
+        invalidar("permisos")
+    return informe
@@ -26,11 +26,66 @@ function alternar_comida_usuario(colonia_slug, ano, mes, dia) {
   jsonRpcRequest("alternar_comida_usuario", [colonia_slug, ano, mes, dia]).then(() => {window.location.reload()})
 }
 
-function avistar_gato(colonia_slug, gato_slug) {
-  jsonRpcRequest("avistar_gato", [colonia_slug, gato_slug]).then(() => 
-  window.location.reload())
+// Operaciones hechas sin conexión, se suben todas juntas al volver
+const COLA_SYNC = "gatinos-sync";
+
+function leer_cola() {
+  return JSON.parse(localStorage.getItem(COLA_SYNC) || "[]");
+}
+
+function ahora() {
+  // ISO con la zona del cliente, el servidor usa su día
+  const d = new Date();
+  const offset = -d.getTimezoneOffset();
+  const signo = offset >= 0 ? "+" : "-";
+  const dos = (n) => String(Math.floor(Math.abs(n))).padStart(2, "0");
+  const local = new Date(d.getTime() + offset * 60000).toISOString().slice(0, 19);
+  return `${local}${signo}${dos(offset / 60)}:${dos(offset % 60)}`;
+}
+
+function encolar(colonia_id, operacion) {
+  const cola = leer_cola();
+  cola.push({colonia_id: colonia_id, operacion: {
+    key: crypto.randomUUID(), timestamp: ahora(), ...operacion}});
+  localStorage.setItem(COLA_SYNC, JSON.stringify(cola));
+}
+
+async function sincronizar() {
+  const cola = leer_cola();
+  const colonias = [...new Set(cola.map((o) => o.colonia_id))];
+  for (const colonia_id of colonias) {
+    const operaciones = cola.filter((o) => o.colonia_id === colonia_id)
+                            .map((o) => o.operacion);
+    const resultado = await jsonRpcRequest("sync_colony", [colonia_id, operaciones]);
+    if (resultado.error) {
+      throw new Error(resultado.error);
+    }
+    // Los resultados quedan en el servidor con su clave, repetir es seguro
+    const subidas = new Set(operaciones.map((o) => o.key));
+    const pendientes = leer_cola().filter((o) => !subidas.has(o.operacion.key));
+    localStorage.setItem(COLA_SYNC, JSON.stringify(pendientes));
+  }
+  return cola.length > 0;
 }
 
+function avistar_gato(colonia_id, gato_slug, visto, elemento) {
+  encolar(colonia_id, {type: "sighting", cat: gato_slug, seen: visto});
+  sincronizar().then(() => window.location.reload()).catch(() => {
+    // Sin conexión, queda en la cola
+    if (elemento) {
+      elemento.style.opacity = 0.5;
+    }
+  });
+}
+
+window.addEventListener("online", () => {
+  sincronizar().then((subidas) => {
+    if (subidas) {
+      window.location.reload();
+    }
+  });
+});
+
 function nuevo_codigo_qr() {
   jsonRpcRequest("nuevo_codigo_qr", []).then(() => {
     setTimeout( () => {window.location.reload() }, 500)
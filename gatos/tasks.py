@@ -1,17 +1,43 @@
-from datetime import date
+from concurrent.futures import Future
+from datetime import date, timedelta
 from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
 from celery import shared_task
+from gatinos.dispatch import enqueue
 from .models import Foto, Colonia, Gato
 from .flows import GatoFlow
+from . import media
+
+
+PROCESS_IMAGE_KEY = "process-image:{}"
+PROCESS_IMAGE_TIMEOUT = 600
 
 
 @shared_task()
-def process_image(foto_id):
+def process_image(foto_id, forzar=False):
+    # Se libera al empezar para que los cambios posteriores se vuelvan a
+    # encolar, si la foto no cambia procesar no la vuelve a decodificar.
+    cache.delete(PROCESS_IMAGE_KEY.format(foto_id))
     foto_instancia = Foto.objects.get(id=foto_id)
-    foto_pil = foto_instancia.get_pil_image()
-    foto_instancia.update_miniatura(pil=foto_pil)
-    foto_instancia.update_exif(pil=foto_pil)
-    foto_instancia.save()
+    foto_instancia.procesar(forzar=forzar)
+
+
+def encolar_proceso(foto_id):
+    """Queue process_image unless it is already queued for the photo"""
+    clave = PROCESS_IMAGE_KEY.format(foto_id)
+    if not cache.add(clave, True, timeout=PROCESS_IMAGE_TIMEOUT):
+        return False
+    try:
+        resultado = enqueue(process_image, foto_id, queue="imagenes")
+    except Exception:
+        cache.delete(clave)
+        raise
+    if isinstance(resultado, Future):
+        # Un proceso del pool borra la clave de su propia caché si no es
+        # compartida, la de este proceso se libera al terminar
+        resultado.add_done_callback(lambda _: cache.delete(clave))
+    return True
 
 
 @shared_task()
@@ -30,6 +56,12 @@ def update_exif(colonia_slug):
             foto.update_exif()
 
 
+@shared_task()
+def recoger_basura(retencion_dias=7):
+    retencion = timedelta(days=retencion_dias)
+    return media.recoger_basura(default_storage, retencion=retencion)
+
+
 def get_ultima_fecha(gato):
     fechas = gato.get_actividad()
     if not fechas:
@@ -1,11 +1,52 @@
+import asyncio
+import base64
+from contextlib import redirect_stdout
+import difflib
+import gzip
+from datetime import date, timedelta
+from io import StringIO
+import json
+import locale
+import re
+import statistics
+import threading
+import time
 from pathlib import Path
+from tempfile import mkdtemp
 from PIL import Image
-from django.test import TestCase
-from .models import Foto, Colonia
-from .utils import pil_to_django_file
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import (AnonymousUser, Group, Permission,
+                                        User)
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection, transaction
+from django.db.models.signals import post_save
+from django.test import (AsyncRequestFactory, RequestFactory, TestCase,
+                         TransactionTestCase, override_settings)
+from django.test.utils import CaptureQueriesContext
+from django.http import Http404
+from django.urls import URLResolver, reverse
+from modernrpc.core import registry
+from gatinos import dispatch
+from .models import (AsignacionComida, Avistamiento, Cambio, Captura,
+                     Enfermedad, EstadoGato, Foto, Colonia, Gato, Informe,
+                     Vacunacion)
+from . import (accesos, carga, eventos, identidad, media, metrics, micro,
+               rotas, rpc, rpc_async, sincronizacion, sintetico, tasks, urls,
+               versiones, views)
+from .utils import pil_to_django_file, fan_out
 
 FIXTURES_DIR = Path(__file__).resolve().parent / "fixtures"
 
+BLOQUEO = threading.Event()
+
+
+def tarea_bloqueada():
+    BLOQUEO.wait(5)
+
 
 class FotoTest(TestCase):
     GATO_NAME = "pelirrojo.jpg"
@@ -30,3 +71,1754 @@ class FotoTest(TestCase):
 
     def test_exif(self):
         self.foto.update_exif()
+
+
+@override_settings(MEDIA_ROOT=mkdtemp())
+class FanOutTest(TestCase):
+    GATO_PATH = FIXTURES_DIR / "pelirrojo.jpg"
+
+    def setUp(self):
+        self.colonia = Colonia.objects.create(slug="mi-colonia",
+                                              nombre="Mi Colonia")
+        self.imagen_file = pil_to_django_file(Image.open(self.GATO_PATH))
+
+    def test_upload_to(self):
+        foto = Foto.objects.create(colonia=self.colonia)
+        foto.foto.save("pelirrojo.jpg", self.imagen_file)
+        foto.update_miniatura()
+        directorio = fan_out(foto.id)
+        self.assertEqual(foto.foto.name,
+                         f"fotos/{directorio}/{foto.id}.jpg")
+        self.assertEqual(foto.miniatura.name,
+                         f"miniaturas/{directorio}/{foto.id}.jpg")
+
+    def test_relocatefotos(self):
+        foto = Foto.objects.create(colonia=self.colonia)
+        viejo = default_storage.save(f"fotos/{foto.id}.jpg",
+                                     self.imagen_file)
+        Foto.objects.filter(pk=foto.pk).update(foto=viejo)
+        call_command("relocatefotos", pause=0, stdout=StringIO())
+        foto.refresh_from_db()
+        self.assertEqual(foto.foto.name,
+                         f"fotos/{fan_out(foto.id)}/{foto.id}.jpg")
+        self.assertTrue(default_storage.exists(foto.foto.name))
+        self.assertFalse(default_storage.exists(viejo))
+
+    def test_reubicar_copia_previa(self):
+        # Una ejecución interrumpida dejó la copia sin actualizar la fila
+        foto = Foto.objects.create(colonia=self.colonia)
+        viejo = default_storage.save(f"fotos/{foto.id}.jpg",
+                                     ContentFile(b"miau"))
+        Foto.objects.filter(pk=foto.pk).update(foto=viejo)
+        foto.refresh_from_db()
+        destino = media.ruta_esperada(foto, "foto", viejo)
+        # Los ids se repiten entre tests y el directorio es compartido
+        default_storage.delete(destino)
+        default_storage.save(destino, ContentFile(b"miau"))
+        self.assertEqual(media.reubicar(foto, "foto"), destino)
+        _, ficheros = default_storage.listdir(destino.rsplit("/", 1)[0])
+        self.assertEqual([f for f in ficheros
+                          if f.startswith(f"{foto.id}_")], [])
+        self.assertFalse(default_storage.exists(viejo))
+        # Con otro contenido no se pisa
+        otra = Foto.objects.create(colonia=self.colonia)
+        viejo = default_storage.save(f"fotos/{otra.id}.jpg",
+                                     ContentFile(b"guau"))
+        Foto.objects.filter(pk=otra.pk).update(foto=viejo)
+        otra.refresh_from_db()
+        destino = media.ruta_esperada(otra, "foto", viejo)
+        default_storage.delete(destino)
+        default_storage.save(destino, ContentFile(b"miau"))
+        nuevo = media.reubicar(otra, "foto")
+        self.assertNotEqual(nuevo, destino)
+        with default_storage.open(nuevo) as fichero:
+            self.assertEqual(fichero.read(), b"guau")
+
+
+@override_settings(MEDIA_ROOT=mkdtemp())
+class RecogerBasuraTest(TestCase):
+    GATO_PATH = FIXTURES_DIR / "pelirrojo.jpg"
+
+    def setUp(self):
+        self.colonia = Colonia.objects.create(slug="mi-colonia",
+                                              nombre="Mi Colonia")
+        self.foto = Foto.objects.create(colonia=self.colonia)
+        imagen = pil_to_django_file(Image.open(self.GATO_PATH))
+        self.foto.foto.save("pelirrojo.jpg", imagen)
+        self.huerfano = default_storage.save("fotos/aa/bb/huerfano.jpg",
+                                             ContentFile(b"miau"))
+
+    def test_cuarentena_y_purga(self):
+        informe = media.recoger_basura(default_storage, margen=timedelta(0))
+        self.assertEqual(informe["en_cuarentena"], 1)
+        self.assertFalse(default_storage.exists(self.huerfano))
+        self.assertTrue(default_storage.exists(self.foto.foto.name))
+        informe = media.recoger_basura(default_storage, margen=timedelta(0),
+                                       retencion=timedelta(days=-1))
+        self.assertEqual(informe["borrados"], 1)
+        self.assertEqual(informe["bytes_liberados"], 4)
+
+    def test_miniatura_sustituida(self):
+        self.foto.update_miniatura()
+        anterior = self.foto.miniatura.name
+        self.foto.update_miniatura()
+        self.assertFalse(default_storage.exists(anterior))
+        self.assertTrue(default_storage.exists(self.foto.miniatura.name))
+
+
+EAGER = {"default": {"BACKEND": "gatinos.dispatch.EagerBackend"},
+         "imagenes": {"BACKEND": "gatinos.dispatch.EagerBackend"}}
+
+
+@override_settings(MEDIA_ROOT=mkdtemp(), TASK_QUEUES=EAGER)
+class DispatchTest(TestCase):
+    GATO_PATH = FIXTURES_DIR / "pelirrojo.jpg"
+
+    def test_eager(self):
+        colonia = Colonia.objects.create(slug="mi-colonia",
+                                         nombre="Mi Colonia")
+        foto = Foto.objects.create(colonia=colonia)
+        imagen = pil_to_django_file(Image.open(self.GATO_PATH))
+        foto.foto.save("pelirrojo.jpg", imagen)
+        dispatch.enqueue(tasks.process_image, foto.id, queue="imagenes")
+        foto.refresh_from_db()
+        self.assertTrue(foto.miniatura)
+        self.assertEqual(dispatch.backlog(), {"default": 0, "imagenes": 0})
+
+    @override_settings(TASK_QUEUES={"default": {
+        "BACKEND": "gatinos.dispatch.ThreadPoolBackend",
+        "WORKERS": 1,
+        "MAX_PENDING": 2}})
+    def test_cola_limitada(self):
+        BLOQUEO.clear()
+        dispatch.enqueue(tarea_bloqueada)
+        dispatch.enqueue(tarea_bloqueada)
+        self.assertEqual(dispatch.backlog(), {"default": 2})
+        with self.assertRaises(dispatch.QueueFull):
+            dispatch.enqueue(tarea_bloqueada)
+        BLOQUEO.set()
+        dispatch.shutdown()
+        self.assertEqual(dispatch.backlog(), {"default": 0})
+
+    @override_settings(TASK_QUEUES={"default": {
+        "BACKEND": "gatinos.dispatch.ThreadPoolBackend",
+        "WORKERS": 1}})
+    def test_cancelada(self):
+        BLOQUEO.clear()
+        dispatch.enqueue(tarea_bloqueada)
+        pendiente = dispatch.enqueue(tarea_bloqueada)
+        with self.assertNoLogs(level="ERROR"):
+            self.assertTrue(pendiente.cancel())
+        self.assertEqual(dispatch.backlog(), {"default": 1})
+        BLOQUEO.set()
+        dispatch.shutdown()
+        self.assertEqual(dispatch.backlog(), {"default": 0})
+
+
+@override_settings(MEDIA_ROOT=mkdtemp(), TASK_QUEUES=EAGER)
+class ProcesarFotoTest(TestCase):
+    GATO_PATH = FIXTURES_DIR / "pelirrojo.jpg"
+
+    def setUp(self):
+        colonia = Colonia.objects.create(slug="mi-colonia",
+                                         nombre="Mi Colonia")
+        self.foto = Foto.objects.create(colonia=colonia)
+        imagen = pil_to_django_file(Image.open(self.GATO_PATH))
+        self.foto.foto.save("pelirrojo.jpg", imagen)
+
+    def test_idempotente(self):
+        self.assertTrue(self.foto.procesar())
+        self.assertFalse(self.foto.procesar())
+        self.foto.version_proceso = 0
+        self.assertTrue(self.foto.procesar())
+
+    def test_encolado_unico(self):
+        clave = tasks.PROCESS_IMAGE_KEY.format(self.foto.id)
+        cache.add(clave, True)
+        self.assertFalse(tasks.encolar_proceso(self.foto.id))
+        cache.delete(clave)
+        self.assertTrue(tasks.encolar_proceso(self.foto.id))
+        self.foto.refresh_from_db()
+        self.assertEqual(self.foto.version_proceso, Foto.VERSION_PROCESO)
+        self.assertIsNone(cache.get(clave))
+
+    @override_settings(TASK_QUEUES={"imagenes": {
+        "BACKEND": "gatinos.dispatch.ProcessPoolBackend",
+        "WORKERS": 1}})
+    def test_encolado_proceso(self):
+        # El proceso no ve la base de datos de los tests, la tarea falla
+        with self.assertLogs("gatinos.dispatch", "ERROR"):
+            self.assertTrue(tasks.encolar_proceso(self.foto.id))
+            self.assertFalse(tasks.encolar_proceso(self.foto.id))
+            dispatch.shutdown()
+            self.assertTrue(tasks.encolar_proceso(self.foto.id))
+            dispatch.shutdown()
+        clave = tasks.PROCESS_IMAGE_KEY.format(self.foto.id)
+        self.assertIsNone(cache.get(clave))
+
+
+class RPCBatchTest(TestCase):
+    def setUp(self):
+        self.colonia = Colonia.objects.create(slug="mi-colonia",
+                                              nombre="Mi Colonia")
+        self.usuario = User.objects.create_user("voluntario")
+        self.colonia.usuarios_autorizados.add(self.usuario)
+        self.client.force_login(self.usuario)
+
+    def llamar(self, *llamadas):
+        payload = [{"jsonrpc": "2.0", "id": i, "method": m, "params": p}
+                   for i, (m, p) in enumerate(llamadas)]
+        return self.client.post("/rpc/", json.dumps(payload),
+                                content_type="application/json").json()
+
+    def test_batch(self):
+        params = {"colonia_id": self.colonia.id}
+        with CaptureQueriesContext(connection) as consultas:
+            respuesta = self.llamar(("get_feeding_dates", params),
+                                    ("get_colony_feeding_users", params))
+        self.assertEqual([r["id"] for r in respuesta], [0, 1])
+        self.assertIn("dates", respuesta[0]["result"])
+        self.assertIn("users", respuesta[1]["result"])
+        colonias = [q for q in consultas.captured_queries
+                    if 'FROM "gatos_colonia"' in q["sql"]]
+        self.assertEqual(len(colonias), 1)
+
+
+class AlimentadoresTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.colonia = Colonia.objects.create(slug="mi-colonia",
+                                              nombre="Mi Colonia")
+        self.otra = Colonia.objects.create(slug="otra", nombre="Otra")
+        permiso = Permission.objects.get(codename="alimentar_colonia")
+        self.grupo = Group.objects.create(name="Alimentadores")
+        self.grupo.permissions.add(permiso)
+        self.directo = User.objects.create_user("directo")
+        self.directo.user_permissions.add(permiso)
+        self.por_grupo = User.objects.create_user("por_grupo")
+        self.por_grupo.groups.add(self.grupo)
+        self.sin_permiso = User.objects.create_user("sin_permiso")
+        self.de_otra = User.objects.create_user("de_otra")
+        self.de_otra.user_permissions.add(permiso)
+        self.admin = User.objects.create_superuser("admin")
+        self.colonia.usuarios_autorizados.add(self.directo, self.por_grupo,
+                                              self.sin_permiso)
+        self.otra.usuarios_autorizados.add(self.de_otra)
+
+    def nombres(self):
+        return [u["username"] for u in rpc.get_alimentadores(self.colonia)]
+
+    def test_alimentadores(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.nombres(),
+                             ["directo", "por_grupo", "admin"])
+        with self.assertNumQueries(0):
+            self.nombres()
+
+    def test_invalidacion(self):
+        self.nombres()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.sin_permiso.groups.add(self.grupo)
+        self.assertIn("sin_permiso", self.nombres())
+        with self.captureOnCommitCallbacks(execute=True):
+            self.colonia.usuarios_autorizados.remove(self.directo)
+        self.assertNotIn("directo", self.nombres())
+        with self.captureOnCommitCallbacks(execute=True):
+            self.de_otra.colonias_autorizadas.add(self.colonia)
+        self.assertIn("de_otra", self.nombres())
+        with self.captureOnCommitCallbacks(execute=True):
+            self.grupo.permissions.clear()
+        self.assertNotIn("por_grupo", self.nombres())
+        self.admin.is_active = False
+        with self.captureOnCommitCallbacks(execute=True):
+            self.admin.save()
+        self.assertNotIn("admin", self.nombres())
+
+
+class FeedingDatesTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.colonia = Colonia.objects.create(slug="mi-colonia",
+                                              nombre="Mi Colonia")
+        self.usuarios = [User.objects.create_user(f"u{i}", first_name="U",
+                                                  last_name=str(i))
+                         for i in range(3)]
+        self.hoy = date.today()
+        for i in range(9):
+            AsignacionComida.objects.create(
+                colonia=self.colonia, usuario=self.usuarios[i % 3],
+                fecha=self.hoy + timedelta(days=i))
+        AsignacionComida.objects.create(colonia=self.colonia,
+                                        usuario=self.usuarios[0],
+                                        fecha=self.hoy - timedelta(days=400))
+        self.params = {"start_date": f"{self.hoy:%Y-%m-%d}",
+                       "end_date": f"{self.hoy + timedelta(days=30):%Y-%m-%d}",
+                       "compact": True}
+
+    def test_payload(self):
+        with self.assertNumQueries(2):
+            datos = rpc.get_feeding_dates(self.colonia.id, **self.params)
+        self.assertEqual(len(datos["users"]), 3)
+        self.assertEqual(len(datos["dates"]), 9)
+        self.assertEqual(datos["dates"][f"{self.hoy:%Y-%m-%d}"],
+                         [self.usuarios[0].id])
+        self.assertEqual(datos["users"][self.usuarios[1].id]["full_name"],
+                         "U 1")
+
+    def test_filas(self):
+        # Lo que espera el bundle ya desplegado
+        datos = rpc.get_feeding_dates(self.colonia.id,
+                                      **{**self.params, "compact": False})
+        self.assertNotIn("users", datos)
+        self.assertEqual(len(datos["dates"]), 9)
+        self.assertEqual(datos["dates"][1],
+                         {"date": f"{self.hoy + timedelta(days=1):%Y-%m-%d}",
+                          "user_id": self.usuarios[1].id, "username": "u1",
+                          "full_name": "U 1"})
+
+    def test_ventana(self):
+        datos = rpc.get_feeding_dates(self.colonia.id, compact=True)
+        inicio = self.hoy.replace(day=1)
+        self.assertEqual(datos["start_date"], f"{inicio:%Y-%m-%d}")
+        self.assertNotIn(f"{self.hoy - timedelta(days=400):%Y-%m-%d}",
+                         datos["dates"])
+
+    def test_not_modified(self):
+        token = rpc.get_feeding_dates(self.colonia.id, **self.params)["version"]
+        datos = rpc.get_feeding_dates(self.colonia.id, version=token,
+                                      **self.params)
+        self.assertTrue(datos["not_modified"])
+        with self.captureOnCommitCallbacks(execute=True):
+            AsignacionComida.objects.filter(fecha=self.hoy).delete()
+        datos = rpc.get_feeding_dates(self.colonia.id, version=token,
+                                      **self.params)
+        self.assertNotIn("not_modified", datos)
+        self.assertEqual(len(datos["dates"]), 8)
+
+    def test_desasignar(self):
+        fecha = f"{self.hoy:%Y-%m-%d}"
+        peticion = RequestFactory().post("/rpc/")
+        peticion.user = User.objects.create_superuser("admin")
+        for user_id in (None, 0):
+            rpc.set_feeding_assignment(fecha, self.colonia.id,
+                                       self.usuarios[1].id, request=peticion)
+            datos = rpc.set_feeding_assignment(fecha, self.colonia.id,
+                                               user_id, request=peticion)
+            self.assertFalse(datos["assigned"])
+            self.assertFalse(self.colonia.comidas.filter(fecha=self.hoy)
+                             .exists())
+        # Los voluntarios sin user_id se apuntan o se borran ellos
+        usuario = self.usuarios[2]
+        usuario.user_permissions.add(
+            Permission.objects.get(codename="alimentar_colonia"))
+        self.colonia.usuarios_autorizados.add(usuario)
+        peticion = RequestFactory().post("/rpc/")
+        peticion.user = User.objects.get(pk=usuario.pk)
+        datos = rpc.set_feeding_assignment(fecha, self.colonia.id,
+                                           request=peticion)
+        self.assertEqual(datos["user_id"], usuario.id)
+        datos = rpc.set_feeding_assignment(fecha, self.colonia.id,
+                                           request=peticion)
+        self.assertFalse(datos["assigned"])
+
+
+class AsignacionConcurrenteTest(TransactionTestCase):
+    HILOS = 8
+
+    def setUp(self):
+        cache.clear()
+        self.colonia = Colonia.objects.create(slug="mi-colonia",
+                                              nombre="Mi Colonia")
+        self.usuarios = [User.objects.create_user(f"u{i}")
+                         for i in range(self.HILOS)]
+        self.fecha = date.today() + timedelta(days=1)
+
+    def en_paralelo(self, funcion):
+        salida = threading.Barrier(self.HILOS)
+        resultados = [None] * self.HILOS
+        errores = []
+
+        def hilo(i):
+            try:
+                salida.wait()
+                while True:
+                    try:
+                        resultados[i] = funcion(self.usuarios[i])
+                        break
+                    except OperationalError:
+                        # SQLite bloquea la tabla entera durante la escritura
+                        time.sleep(0.001)
+            except Exception as e:
+                errores.append(e)
+            finally:
+                connection.close()
+
+        hilos = [threading.Thread(target=hilo, args=(i,))
+                 for i in range(self.HILOS)]
+        for h in hilos:
+            h.start()
+        for h in hilos:
+            h.join()
+        self.assertEqual(errores, [])
+        return resultados
+
+    def test_reclamar(self):
+        def reclamar(usuario):
+            return AsignacionComida.objects.cambiar(
+                self.colonia, self.fecha,
+                lambda actual: usuario.id if actual is None else actual)
+        resultados = self.en_paralelo(reclamar)
+        asignaciones = AsignacionComida.objects.filter(fecha=self.fecha)
+        self.assertEqual(asignaciones.count(), 1)
+        ganador = asignaciones.get().usuario_id
+        self.assertEqual(resultados, [ganador] * self.HILOS)
+
+    def test_alternar(self):
+        def alternar(usuario):
+            for _ in range(10):
+                self.colonia.toggle_comida(self.fecha, usuario)
+        self.en_paralelo(alternar)
+        self.assertLessEqual(
+            AsignacionComida.objects.filter(fecha=self.fecha).count(), 1)
+
+
+class RotaTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.colonia = Colonia.objects.create(slug="mi-colonia",
+                                              nombre="Mi Colonia")
+        permiso = Permission.objects.get(codename="alimentar_colonia")
+        self.usuarios = []
+        for i in range(3):
+            usuario = User.objects.create_user(f"u{i}")
+            usuario.user_permissions.add(permiso)
+            self.usuarios.append(usuario)
+        self.colonia.usuarios_autorizados.add(*self.usuarios)
+        self.ids = [u.id for u in self.usuarios]
+        self.inicio = date.today() + timedelta(days=1)
+
+    def crear(self, dias, regla, **kwargs):
+        fin = self.inicio + timedelta(days=dias - 1)
+        return rotas.crear(self.colonia, self.inicio, fin, self.ids, regla,
+                           **kwargs)
+
+    def asignadas(self):
+        return dict(self.colonia.comidas.values_list("fecha", "usuario_id"))
+
+    def test_round_robin(self):
+        self.crear(20, "round_robin")
+        with CaptureQueriesContext(connection) as corta:
+            self.crear(10, "round_robin")
+        with CaptureQueriesContext(connection) as larga:
+            self.crear(60, "round_robin")
+        self.assertEqual(len(corta), len(larga))
+        asignadas = self.asignadas()
+        self.assertEqual(len(asignadas), 60)
+        self.assertEqual([asignadas[self.inicio + timedelta(days=n)]
+                          for n in range(4)], self.ids + self.ids[:1])
+
+    def test_huecos(self):
+        ocupada = self.inicio + timedelta(days=2)
+        AsignacionComida.objects.create(colonia=self.colonia, fecha=ocupada,
+                                        usuario=self.usuarios[2])
+        plan = self.crear(7, "huecos")
+        self.assertNotIn(ocupada, plan)
+        asignadas = self.asignadas()
+        self.assertEqual(len(asignadas), 7)
+        self.assertEqual(asignadas[ocupada], self.ids[2])
+
+    def test_huecos_ocupados(self):
+        fin = self.inicio + timedelta(days=6)
+        plan = rotas.generar(self.colonia, self.inicio, fin, self.ids,
+                             "huecos")
+        # Un voluntario se apunta mientras se revisa el plan
+        ocupada = self.inicio + timedelta(days=2)
+        AsignacionComida.objects.create(colonia=self.colonia, fecha=ocupada,
+                                        usuario=self.usuarios[2])
+        antes = Cambio.objects.count()
+        escritos = rotas.aplicar(self.colonia, plan, reemplazar=False)
+        self.assertEqual(set(escritos), set(plan) - {ocupada})
+        self.assertEqual(Cambio.objects.count() - antes, 6)
+        # Solo el de la asignación del voluntario
+        self.assertEqual(Cambio.objects.filter(
+            objeto=ocupada.isoformat()).count(), 1)
+
+    def test_dias_semana(self):
+        semana = {"0": self.ids[0], "3": self.ids[1]}
+        plan = self.crear(14, "dias_semana", semana=semana)
+        self.assertEqual(len(plan), 4)
+        self.assertTrue(all(f.weekday() in (0, 3) for f in plan))
+
+    def test_validacion(self):
+        ajeno = User.objects.create_user("ajeno")
+        self.ids.append(ajeno.id)
+        with self.assertRaises(rotas.RotaInvalida):
+            self.crear(7, "round_robin")
+        with self.assertRaises(rotas.RotaInvalida):
+            self.crear(rotas.MAX_DIAS + 1, "huecos")
+        self.assertEqual(self.asignadas(), {})
+
+    def test_rpc(self):
+        admin = User.objects.create_superuser("admin")
+        self.client.force_login(admin)
+        payload = {"jsonrpc": "2.0", "id": 1,
+                   "method": "generate_feeding_rota",
+                   "params": {"colonia_id": self.colonia.id,
+                              "start_date": f"{self.inicio:%Y-%m-%d}",
+                              "end_date": f"{self.inicio:%Y-%m-%d}",
+                              "user_ids": self.ids[1:2]}}
+        respuesta = self.client.post("/rpc/", json.dumps(payload),
+                                     content_type="application/json").json()
+        self.assertEqual(respuesta["result"]["dates"],
+                         {f"{self.inicio:%Y-%m-%d}": self.ids[1]})
+        self.assertEqual(self.asignadas(), {self.inicio: self.ids[1]})
+
+    def test_admin(self):
+        admin = User.objects.create_superuser("admin")
+        self.client.force_login(admin)
+        url = "/admin/gatos/colonia/"
+        accion = {"action": "generar_rota",
+                  "_selected_action": [self.colonia.id]}
+        respuesta = self.client.post(url, accion)
+        self.assertContains(respuesta, 'name="previsualizar"')
+        self.assertNotContains(respuesta, 'name="guardar"')
+        fin = self.inicio + timedelta(days=3)
+        datos = {**accion, "inicio": f"{self.inicio}", "fin": f"{fin}",
+                 "regla": "round_robin", "alimentadores": self.ids[:2]}
+        respuesta = self.client.post(url, {**datos, "previsualizar": "1"})
+        self.assertEqual(len(respuesta.context["planes"][0][2]), 4)
+        self.assertContains(respuesta, "u1")
+        self.assertNotContains(respuesta, "<td>u2</td>")
+        self.assertEqual(self.asignadas(), {})
+        respuesta = self.client.post(url, {**datos, "guardar": "1"})
+        self.assertRedirects(respuesta, url)
+        self.assertEqual(set(self.asignadas().values()), set(self.ids[:2]))
+        # Los errores de cada colonia salen en la vista previa
+        datos["fin"] = f"{self.inicio + timedelta(days=rotas.MAX_DIAS)}"
+        respuesta = self.client.post(url, {**datos, "previsualizar": "1"})
+        self.assertContains(respuesta, "no puede pasar")
+
+
+class CacheColoniaTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.colonia = Colonia.objects.create(slug="mi-colonia",
+                                              nombre="Mi Colonia")
+        self.gato = Gato.objects.create(nombre="Misi", colonia=self.colonia,
+                                        sexo="H", descripcion="")
+
+    def test_version(self):
+        rpc.get_actividad_gato(self.colonia, "misi")
+        with self.assertNumQueries(0):
+            rpc.get_actividad_gato(self.colonia, "misi")
+        with self.captureOnCommitCallbacks(execute=True):
+            Avistamiento.objects.create(colonia=self.colonia, gato=self.gato,
+                                        fecha=date.today())
+        self.assertEqual(len(rpc.get_actividad_gato(self.colonia,
+                                                    "misi")["dates"]), 2)
+        estadisticas = versiones.estadisticas()["actividad_gato"]
+        self.assertEqual(estadisticas["aciertos"], 1)
+        self.assertEqual(estadisticas["fallos"], 2)
+
+    def test_un_solo_calculo(self):
+        calculos = []
+        salida = threading.Barrier(4)
+
+        def calcular():
+            calculos.append(1)
+            time.sleep(0.2)
+            return "valor"
+
+        def hilo():
+            salida.wait()
+            resultados.append(versiones.obtener("clave", calcular, 60))
+
+        resultados = []
+        hilos = [threading.Thread(target=hilo) for _ in range(4)]
+        for h in hilos:
+            h.start()
+        for h in hilos:
+            h.join()
+        self.assertEqual(len(calculos), 1)
+        self.assertEqual(resultados, ["valor"] * 4)
+        self.assertEqual(versiones.estadisticas().get("clave"), None)
+
+    @override_settings(CACHE_COMPARTIDA=False)
+    def test_no_compartida(self):
+        # Otros procesos no verían las versiones, se lee siempre
+        rpc.get_actividad_gato(self.colonia, "misi")
+        with CaptureQueriesContext(connection) as consultas:
+            rpc.get_actividad_gato(self.colonia, "misi")
+        self.assertTrue(consultas.captured_queries)
+        self.assertEqual(versiones.estadisticas()["actividad_gato"]["fallos"],
+                         0)
+
+
+class VersionCommitTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.colonia = Colonia.objects.create(slug="mi-colonia",
+                                              nombre="Mi Colonia")
+
+    def test_tras_commit(self):
+        filas = ["antigua"]
+
+        @versiones.cacheado("prueba_commit")
+        def leer(colonia):
+            return list(filas)
+
+        def otro_lector():
+            # Lee mientras la escritura no ha terminado
+            resultados.append(leer(self.colonia))
+
+        resultados = []
+        with transaction.atomic():
+            versiones.invalidar("colonia", self.colonia.id)
+            hilo = threading.Thread(target=otro_lector)
+            hilo.start()
+            hilo.join()
+            filas.append("nueva")
+        self.assertEqual(resultados, [["antigua"]])
+        self.assertEqual(leer(self.colonia), ["antigua", "nueva"])
+
+    def test_rollback(self):
+        antes = versiones.version("colonia", self.colonia.id)
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                versiones.invalidar("colonia", self.colonia.id)
+                raise RuntimeError()
+        self.assertEqual(versiones.version("colonia", self.colonia.id), antes)
+
+
+class MetricasTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        metrics.reiniciar()
+        self.colonia = Colonia.objects.create(slug="mi-colonia",
+                                              nombre="Mi Colonia")
+        self.admin = User.objects.create_superuser("admin", password="x")
+
+    def test_metricas(self):
+        rpc.get_colony_activity("mi-colonia")
+        rpc.get_colony_activity("no-existe")
+        self.assertEqual(self.client.get("/rpc/metrics").status_code, 401)
+        credenciales = base64.b64encode(b"admin:x").decode()
+        respuesta = self.client.get("/rpc/metrics",
+                                    HTTP_AUTHORIZATION=f"Basic {credenciales}")
+        texto = respuesta.content.decode()
+        etiqueta = '{method="get_colony_activity"}'
+        self.assertIn(f"gatinos_rpc_calls_total{etiqueta} 2", texto)
+        self.assertIn(f"gatinos_rpc_errors_total{etiqueta} 1", texto)
+        self.assertIn('gatinos_rpc_latency_seconds_bucket{method="get_colony'
+                      '_activity",le="+Inf"} 2', texto)
+        consultas = re.search(rf"gatinos_rpc_queries_total{etiqueta} (\d+)",
+                              texto)
+        self.assertGreater(int(consultas.group(1)), 0)
+
+
+class SincronizacionTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.colonia = Colonia.objects.create(slug="mi-colonia",
+                                              nombre="Mi Colonia")
+        self.misi = Gato.objects.create(colonia=self.colonia, slug="misi",
+                                        nombre="Misi")
+        self.luna = Gato.objects.create(colonia=self.colonia, slug="luna",
+                                        nombre="Luna")
+        self.usuario = User.objects.create_user("voluntario")
+        self.usuario.user_permissions.add(*Permission.objects.filter(
+            codename__in=["avistar_gato", "alimentar_colonia",
+                          "add_informe"]))
+        self.colonia.usuarios_autorizados.add(self.usuario)
+        self.client.force_login(self.usuario)
+        self.ayer = date.today() - timedelta(days=1)
+        self.manana = date.today() + timedelta(days=1)
+        self.operaciones = [
+            {"key": "a", "type": "sighting", "cat": "misi",
+             "timestamp": f"{date.today()}T08:00:00+02:00"},
+            {"key": "b", "type": "sighting", "cat": "luna",
+             "timestamp": f"{self.ayer}T19:00:00+02:00"},
+            {"key": "c", "type": "feeding", "date": f"{self.manana}",
+             "timestamp": f"{self.ayer}T19:05:00+02:00"},
+            {"key": "d", "type": "note", "text": "Luna cojea\nDe la pata",
+             "cats": ["luna"], "timestamp": f"{self.ayer}T19:10:00+02:00"},
+            {"key": "e", "type": "sighting", "cat": "tigre",
+             "timestamp": f"{date.today()}T08:05:00+02:00"},
+        ]
+
+    def sincronizar(self, operaciones, since=None):
+        payload = {"jsonrpc": "2.0", "id": 1, "method": "sync_colony",
+                   "params": {"colonia_id": self.colonia.id,
+                              "operations": operaciones, "since": since}}
+        return self.client.post("/rpc/", json.dumps(payload),
+                                content_type="application/json"
+                                ).json()["result"]
+
+    def test_lote(self):
+        resultado = self.sincronizar(self.operaciones, since=0)
+        self.assertEqual([r["ok"] for r in resultado["results"]],
+                         [True, True, True, True, False])
+        self.assertEqual(resultado["results"][4]["error"],
+                         "Cat not found: tigre")
+        self.assertEqual(self.luna.avistamientos.get().fecha, self.ayer)
+        self.assertEqual(self.misi.avistamientos.get().fecha, date.today())
+        self.assertTrue(self.colonia.comidas.filter(
+            fecha=self.manana, usuario=self.usuario).exists())
+        informe = Informe.objects.get()
+        self.assertEqual(informe.titulo, "Luna cojea")
+        self.assertEqual(list(informe.gatos.all()), [self.luna])
+        cambios = resultado["changes"]
+        self.assertEqual(len(cambios["changed"]["sightings"]), 2)
+        self.assertEqual(cambios["changed"]["feedings"],
+                         [{"date": f"{self.manana}",
+                           "user_id": self.usuario.id}])
+        self.assertEqual(cambios["changed"]["reports"][0]["cats"], ["luna"])
+
+    def test_comida_pasada(self):
+        # Igual que en el calendario, solo los días a partir de mañana
+        resultado = self.sincronizar([
+            {"key": "a", "type": "feeding", "date": f"{date.today()}",
+             "timestamp": f"{self.ayer}T19:05:00+02:00"},
+        ])
+        self.assertEqual(resultado["results"][0]["error"], "Past date")
+        self.assertFalse(self.colonia.comidas.exists())
+
+    def test_orden_utc(self):
+        # Por orden de texto iría primero el de las 9:30
+        resultado = self.sincronizar([
+            {"key": "a", "type": "sighting", "cat": "misi", "seen": False,
+             "timestamp": f"{date.today()}T09:30:00+00:00"},
+            {"key": "b", "type": "sighting", "cat": "misi", "seen": True,
+             "timestamp": f"{date.today()}T10:00:00+02:00"},
+            {"key": "c", "type": "sighting", "cat": "luna",
+             "timestamp": f"{date.today()}T10:00:00"},
+            {"key": "d", "type": "sighting", "cat": "luna",
+             "timestamp": "ayer"},
+        ])
+        self.assertFalse(self.misi.avistamientos.exists())
+        self.assertEqual([r.get("error") for r in resultado["results"]],
+                         [None, None, "Timestamp without timezone",
+                          "Invalid timestamp"])
+        self.assertFalse(self.luna.avistamientos.exists())
+
+    def test_idempotencia(self):
+        primero = self.sincronizar(self.operaciones)
+        # Sesión, usuario, colonia, transacción, claves y versión, el
+        # acceso está en la sesión
+        with self.assertNumQueries(7):
+            segundo = self.sincronizar(self.operaciones)
+        self.assertEqual(primero["results"], segundo["results"])
+        self.assertEqual(Avistamiento.objects.count(), 2)
+        self.assertEqual(Informe.objects.count(), 1)
+
+    def test_cambios_desde(self):
+        version = self.sincronizar(self.operaciones)["version"]
+        avistamiento = self.misi.avistamientos.get()
+        self.sincronizar([
+            {"key": "f", "type": "sighting", "cat": "misi", "seen": False,
+             "timestamp": f"{date.today()}T09:00:00+02:00"},
+            {"key": "g", "type": "feeding", "date": f"{self.manana}",
+             "assigned": False,
+             "timestamp": f"{date.today()}T09:01:00+02:00"},
+        ])
+        cambios = sincronizacion.cambios(self.colonia, version)
+        self.assertEqual(cambios["deleted"]["sightings"], [avistamiento.id])
+        self.assertEqual(cambios["deleted"]["feedings"], [f"{self.manana}"])
+        self.assertEqual(cambios["changed"]["reports"], [])
+        self.assertGreater(cambios["version"], version)
+        vacio = sincronizacion.cambios(self.colonia, cambios["version"])
+        self.assertEqual(vacio["version"], cambios["version"])
+        self.assertEqual(vacio["changed"]["sightings"], [])
+
+
+class CambiosTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.colonia = Colonia.objects.create(slug="mi-colonia",
+                                              nombre="Mi Colonia")
+        self.misi = Gato.objects.create(colonia=self.colonia, slug="misi",
+                                        nombre="Misi")
+        self.luna = Gato.objects.create(colonia=self.colonia, slug="luna",
+                                        nombre="Luna")
+        self.foto = Foto.objects.create(colonia=self.colonia)
+        self.foto.gatos.add(self.misi)
+        self.usuario = User.objects.create_user("voluntario")
+        self.usuario.user_permissions.add(
+            Permission.objects.get(codename="view_colonia"))
+        self.colonia.usuarios_autorizados.add(self.usuario)
+        self.client.force_login(self.usuario)
+        self.url = "/colonia/c/mi-colonia/snapshot.json"
+
+    def cambios(self, since):
+        payload = {"jsonrpc": "2.0", "id": 1, "method": "get_colony_changes",
+                   "params": {"colonia_id": self.colonia.id, "since": since}}
+        return self.client.post("/rpc/", json.dumps(payload),
+                                content_type="application/json"
+                                ).json()["result"]
+
+    def test_snapshot(self):
+        respuesta = self.client.get(self.url, HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(respuesta["Content-Encoding"], "gzip")
+        datos = json.loads(gzip.decompress(respuesta.content))
+        self.assertEqual([g["slug"] for g in datos["cats"]], ["misi", "luna"])
+        self.assertEqual(datos["photos"][0]["cats"], ["misi"])
+        no_modificado = self.client.get(
+            self.url, HTTP_IF_NONE_MATCH=respuesta["ETag"])
+        self.assertEqual(no_modificado.status_code, 304)
+        self.misi.color = "negro"
+        self.misi.save()
+        sin_comprimir = self.client.get(self.url,
+                                        HTTP_IF_NONE_MATCH=respuesta["ETag"])
+        self.assertNotEqual(sin_comprimir["ETag"], respuesta["ETag"])
+        self.assertGreater(sin_comprimir.json()["version"], datos["version"])
+
+    def test_cambios(self):
+        version = sincronizacion.snapshot(self.colonia)["version"]
+        self.misi.color = "negro"
+        self.misi.save()
+        self.misi.color = "blanco"
+        self.misi.save()
+        self.foto.gatos.add(self.luna)
+        luna_id = self.luna.id
+        self.luna.delete()
+        cambios = self.cambios(version)
+        self.assertEqual([g["color"] for g in cambios["changed"]["cats"]],
+                         ["blanco"])
+        self.assertEqual(cambios["deleted"]["cats"], [luna_id])
+        self.assertEqual(cambios["changed"]["photos"][0]["cats"], ["misi"])
+        self.assertEqual(self.cambios(cambios["version"])["changed"]["cats"],
+                         [])
+
+    def test_versiones_por_colonia(self):
+        otra = Colonia.objects.create(slug="otra", nombre="Otra")
+        antes = Cambio.objects.version(self.colonia)
+        Cambio.objects.crear([
+            Cambio(colonia=self.colonia, modelo="gato", objeto="1"),
+            Cambio(colonia=otra, modelo="gato", objeto="2"),
+            Cambio(colonia=self.colonia, modelo="gato", objeto="3"),
+        ])
+        self.assertEqual(Cambio.objects.version(otra), 1)
+        self.assertEqual(list(self.colonia.cambios.filter(version__gt=antes)
+                              .order_by("version")
+                              .values_list("version", "objeto")),
+                         [(antes + 1, "1"), (antes + 2, "3")])
+        self.assertEqual(
+            sincronizacion.cambios(self.colonia, antes)["version"], antes + 2)
+
+    def test_reset(self):
+        for _ in range(3):
+            self.misi.save()
+        self.assertTrue(sincronizacion.cambios(self.colonia, 0,
+                                               limite=2)["reset"])
+
+
+def fallar(sender, **kwargs):
+    raise RuntimeError()
+
+
+class CambioAtomicoTest(TransactionTestCase):
+    def setUp(self):
+        self.colonia = Colonia.objects.create(slug="mi-colonia",
+                                              nombre="Mi Colonia")
+        self.usuario = User.objects.create_user("voluntario")
+
+    def fallando(self, modelo, escribir):
+        post_save.connect(fallar, sender=modelo)
+        try:
+            with self.assertRaises(RuntimeError):
+                escribir()
+        finally:
+            post_save.disconnect(fallar, sender=modelo)
+
+    def test_rollback(self):
+        antes = Cambio.objects.count()
+        self.fallando(Gato, lambda: Gato.objects.create(
+            colonia=self.colonia, nombre="Misi"))
+        self.fallando(AsignacionComida,
+                      lambda: AsignacionComida.objects.create(
+                          colonia=self.colonia, usuario=self.usuario,
+                          fecha=date.today()))
+        self.assertFalse(Gato.objects.exists())
+        self.assertFalse(AsignacionComida.objects.exists())
+        self.assertEqual(Cambio.objects.count(), antes)
+
+
+class AccesosTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.colonia = Colonia.objects.create(slug="mi-colonia",
+                                              nombre="Mi Colonia")
+        self.otra = Colonia.objects.create(slug="otra", nombre="Otra")
+        self.usuario = User.objects.create_user("voluntario")
+        self.usuario.user_permissions.add(
+            Permission.objects.get(codename="view_colonia"))
+        self.colonia.usuarios_autorizados.add(self.usuario)
+        self.client.force_login(self.usuario)
+
+    def snapshots(self, *slugs):
+        with CaptureQueriesContext(connection) as consultas:
+            estados = [self.client.get(f"/colonia/c/{slug}/snapshot.json")
+                       .status_code for slug in slugs]
+        accesos = [q for q in consultas.captured_queries
+                   if "gatos_colonia_usuarios_autorizados" in q["sql"]]
+        return estados, len(accesos)
+
+    def test_una_consulta_por_sesion(self):
+        self.assertEqual(self.snapshots("mi-colonia", "otra"), ([200, 403], 1))
+        self.assertEqual(self.snapshots("mi-colonia", "otra"), ([200, 403], 0))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.otra.usuarios_autorizados.add(self.usuario)
+        self.assertEqual(self.snapshots("otra"), ([200], 1))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.usuario.colonias_autorizadas.remove(self.colonia)
+        self.assertEqual(self.snapshots("mi-colonia"), ([403], 1))
+
+    @override_settings(CACHE_COMPARTIDA=False)
+    def test_no_compartida(self):
+        self.assertEqual(self.snapshots("mi-colonia"), ([200], 1))
+        self.assertEqual(self.snapshots("mi-colonia"), ([200], 1))
+        self.assertNotIn(accesos.SESION_KEY, self.client.session)
+
+    def test_for_user(self):
+        gato = Gato.objects.create(nombre="Tigre", colonia=self.colonia)
+        Gato.objects.create(nombre="Ajeno", colonia=self.otra)
+        captura = Captura.objects.create(gato=gato)
+        vacuna = Vacunacion.objects.create(captura=captura, tipo="DESPARASITADO",
+                                           efecto=timedelta(365))
+        self.assertEqual(list(Colonia.objects.for_user(self.usuario)),
+                         [self.colonia])
+        self.assertEqual(list(Gato.objects.for_user(self.usuario)), [gato])
+        self.assertEqual(list(Vacunacion.objects.for_user(self.usuario)),
+                         [vacuna])
+        self.assertEqual(Gato.objects.for_user(AnonymousUser()).count(), 0)
+        admin = User.objects.create_superuser("admin")
+        self.assertEqual(Gato.objects.for_user(admin).count(), 2)
+
+    def test_rpc(self):
+        payload = [{"jsonrpc": "2.0", "id": i, "method": "get_colony_activity",
+                    "params": {"colonia_slug": slug}}
+                   for i, slug in enumerate(["mi-colonia", "otra"])]
+        with CaptureQueriesContext(connection) as consultas:
+            respuesta = self.client.post("/rpc/", json.dumps(payload),
+                                         content_type="application/json")
+        # La autorización va en la consulta de cada colonia
+        accesos = [q["sql"] for q in consultas.captured_queries
+                   if "gatos_colonia_usuarios_autorizados" in q["sql"]]
+        self.assertEqual(len(accesos), 2)
+        self.assertTrue(all(sql.startswith('SELECT "gatos_colonia"."id"')
+                            for sql in accesos))
+        resultados = [r["result"] for r in respuesta.json()]
+        self.assertEqual(resultados[0]["colony_name"], "Mi Colonia")
+        self.assertEqual(resultados[1], {"error": "Colony not found"})
+
+    def test_lista(self):
+        respuesta = self.client.get("/")
+        self.assertEqual(list(respuesta.context["colonias"]), [self.colonia])
+
+
+class PermisosTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        with redirect_stdout(StringIO()):
+            call_command("syncpermissions")
+        self.usuario = User.objects.create_user("voluntario")
+        self.usuario.groups.add(Group.objects.get(name="cuidador"))
+
+    def usuario_nuevo(self):
+        # Cada petición carga otra vez el usuario
+        return User.objects.get(pk=self.usuario.pk)
+
+    def test_sin_consultas(self):
+        self.assertTrue(self.usuario_nuevo().has_perm("gatos.alimentar_colonia"))
+        usuario = self.usuario_nuevo()
+        with self.assertNumQueries(0):
+            self.assertTrue(usuario.has_perm("gatos.alimentar_colonia"))
+            self.assertFalse(usuario.has_perm("gatos.change_gato"))
+            self.assertIn("gatos.view_gato", usuario.get_all_permissions())
+
+    def test_sesiones_anteriores(self):
+        # Sesiones abiertas antes de cambiar el backend
+        self.client.force_login(
+            self.usuario, backend="django.contrib.auth.backends.ModelBackend")
+        respuesta = self.client.get("/")
+        self.assertTrue(respuesta.wsgi_request.user.is_authenticated)
+        self.usuario_nuevo().has_perm("gatos.view_gato")
+        usuario = self.usuario_nuevo()
+        with self.assertNumQueries(0):
+            self.assertFalse(usuario.has_perm("gatos.change_gato"))
+
+    def test_cambios(self):
+        permiso = Permission.objects.get(codename="change_gato")
+        self.assertFalse(self.usuario_nuevo().has_perm("gatos.change_gato"))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.usuario.user_permissions.add(permiso)
+        self.assertTrue(self.usuario_nuevo().has_perm("gatos.change_gato"))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.usuario.user_permissions.remove(permiso)
+            Group.objects.get(name="cuidador").permissions.add(permiso)
+        self.assertTrue(self.usuario_nuevo().has_perm("gatos.change_gato"))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.usuario.groups.clear()
+        self.assertFalse(self.usuario_nuevo().has_perm("gatos.view_gato"))
+
+    @override_settings(CACHE_COMPARTIDA=False)
+    def test_no_compartida(self):
+        self.assertTrue(self.usuario_nuevo().has_perm("gatos.alimentar_colonia"))
+        usuario = self.usuario_nuevo()
+        with CaptureQueriesContext(connection) as consultas:
+            self.assertTrue(usuario.has_perm("gatos.alimentar_colonia"))
+            self.assertFalse(usuario.has_perm("gatos.change_gato"))
+        # Se cargan una vez por petición
+        self.assertEqual(len(consultas.captured_queries), 4)
+        # syncpermissions u otro proceso no puede dejar permisos viejos
+        Group.objects.get(name="cuidador").permissions.add(
+            Permission.objects.get(codename="change_gato"))
+        self.assertTrue(self.usuario_nuevo().has_perm("gatos.change_gato"))
+
+
+class FichaGatoTest(TestCase):
+    def setUp(self):
+        self.colonia = Colonia.objects.create(slug="mi-colonia",
+                                              nombre="Mi Colonia")
+        self.gato = Gato.objects.create(nombre="Tigre", colonia=self.colonia)
+        self.admin = User.objects.create_superuser("admin")
+        self.client.force_login(self.admin)
+
+    def capturar(self, peso=None, vacunas=1):
+        captura = Captura.objects.create(gato=self.gato, peso=peso)
+        for _ in range(vacunas):
+            Vacunacion.objects.create(captura=captura, tipo="DESPARASITADO",
+                                      efecto=timedelta(90))
+        return captura
+
+    def consultas(self, url):
+        with CaptureQueriesContext(connection) as consultas:
+            respuesta = self.client.get(url)
+        self.assertEqual(respuesta.status_code, 200)
+        return respuesta, len(consultas)
+
+    def test_ficha(self):
+        url = "/colonia/c/mi-colonia/gatos/g/tigre"
+        self.capturar(peso=3)
+        _, una = self.consultas(url)
+        ultima = self.capturar(vacunas=3)
+        respuesta, varias = self.consultas(url)
+        self.assertEqual(una, varias)
+        self.assertEqual(respuesta.context["ultima_captura"], ultima)
+        self.assertEqual(respuesta.context["peso"], 3)
+        self.assertEqual(len(respuesta.context["vacunas"]), 4)
+
+    def test_subpaginas(self):
+        captura = self.capturar()
+        url = f"/colonia/c/mi-colonia/gatos/g/tigre/capturas/c/{captura.id}"
+        _, consultas = self.consultas(url)
+        # Sesión, usuario, colonia, gato, captura y anuncios
+        self.assertEqual(consultas, 6)
+        otra = Colonia.objects.create(slug="otra", nombre="Otra")
+        Gato.objects.create(nombre="Ajeno", colonia=otra)
+        self.assertEqual(self.client.get(
+            "/colonia/c/mi-colonia/gatos/g/ajeno/capturas/c/1").status_code,
+            404)
+        self.assertEqual(self.client.get(
+            f"/colonia/c/otra/gatos/g/tigre/capturas/c/{captura.id}")
+            .status_code, 404)
+
+    def test_confirmacion_sin_acceso(self):
+        usuario = User.objects.create_user("voluntario")
+        usuario.user_permissions.add(
+            Permission.objects.get(codename="capturar_gato"))
+        self.client.force_login(usuario)
+        respuesta = self.client.get("/colonia/c/mi-colonia/gatos/g/tigre/capturar")
+        self.assertEqual(respuesta.status_code, 403)
+
+
+class IdentidadTest(TestCase):
+    def setUp(self):
+        self.colonia = Colonia.objects.create(slug="mi-colonia",
+                                              nombre="Mi Colonia")
+        self.gato = Gato.objects.create(nombre="Tigre", colonia=self.colonia)
+        self.request = RequestFactory().get("/")
+
+    def test_una_vez_por_peticion(self):
+        with self.assertNumQueries(2):
+            colonia = identidad.cargar(self.request, Colonia,
+                                       slug="mi-colonia")
+            self.assertIs(identidad.cargar(self.request, Colonia,
+                                           pk=self.colonia.id), colonia)
+            gato = identidad.cargar(self.request, Gato, slug="tigre")
+            self.assertIs(gato.colonia, colonia)
+            gato.get_absolute_url()
+        with self.assertRaises(Http404):
+            identidad.cargar_o_404(self.request, Gato, slug="nadie")
+
+    def test_ambito(self):
+        usuario = User.objects.create_user("voluntario")
+        identidad.cargar(self.request, Colonia, slug="mi-colonia")
+        with self.assertRaises(Colonia.DoesNotExist):
+            identidad.cargar(self.request, Colonia.objects.for_user(usuario),
+                             ambito="autorizadas", slug="mi-colonia")
+
+
+class GaleriaTest(TestCase):
+    def setUp(self):
+        self.colonia = Colonia.objects.create(slug="mi-colonia",
+                                              nombre="Mi Colonia")
+        self.admin = User.objects.create_superuser("admin")
+        self.client.force_login(self.admin)
+
+    def crear_gatos(self, total):
+        fotos = Foto.objects.bulk_create(
+            Foto(colonia=self.colonia, foto=f"fotos/{i}.jpg",
+                 miniatura=f"miniaturas/{i}.jpg", fea=i % 7 == 0)
+            for i in range(total))
+        gatos = Gato.objects.bulk_create(
+            Gato(nombre=f"Gato {i}", slug=f"gato-{i}", colonia=self.colonia,
+                 retrato=foto, feo=i % 5 == 0)
+            for i, foto in enumerate(fotos))
+        Foto.gatos.through.objects.bulk_create(
+            Foto.gatos.through(foto=foto, gato=gato)
+            for foto, gato in zip(fotos, gatos))
+        return gatos
+
+    def consultas(self, url):
+        with CaptureQueriesContext(connection) as consultas:
+            respuesta = self.client.get(url)
+        self.assertEqual(respuesta.status_code, 200)
+        return respuesta, len(consultas)
+
+    def test_consultas_fijas(self):
+        for total in (10, 500):
+            Gato.objects.all().delete()
+            self.crear_gatos(total)
+            respuesta, consultas = self.consultas("/colonia/c/mi-colonia/gatos/")
+            self.assertEqual(len(respuesta.context["gatos"]), total)
+            self.assertEqual(consultas, 5)
+            _, consultas = self.consultas("/colonia/c/mi-colonia")
+            self.assertEqual(consultas, 9)
+
+    def test_feos(self):
+        self.crear_gatos(8)
+        gatos = {g.nombre: g for g in self.colonia.gatos_activos().galeria()
+                 if g.nombre in {"Gato 0", "Gato 1", "Gato 7"}}
+        self.assertEqual({n: g.retrato_es_fea for n, g in gatos.items()},
+                         {"Gato 0": True, "Gato 1": False, "Gato 7": True})
+        for gato in gatos.values():
+            self.assertEqual(gato.retrato_es_fea, gato.retrato.es_fea())
+
+    def test_activos(self):
+        vivo, muerto, visto = self.crear_gatos(3)
+        Gato.objects.update(fecha_alta=date.today() - timedelta(365))
+        Gato.objects.filter(id=muerto.id).update(muerto=True)
+        Avistamiento.objects.create(gato=visto, colonia=self.colonia)
+        self.assertEqual(self.colonia.get_gatos_activos(), [vivo, visto])
+        Foto.objects.filter(id=vivo.retrato_id).update(
+            fecha=date.today() - timedelta(365))
+        self.assertEqual(self.colonia.get_gatos_activos(), [visto])
+        self.assertEqual(self.colonia.get_gatos_desaparecidos(), [vivo])
+
+
+def rutas(patrones, prefijo=()):
+    """``(name, URL parameters)`` of every named route of ``patrones``"""
+    for patron in patrones:
+        parametros = prefijo + tuple(patron.pattern.converters)
+        if isinstance(patron, URLResolver):
+            yield from rutas(patron.url_patterns, parametros)
+        elif patron.name:
+            yield patron.name, parametros
+
+
+def normalizar(sql):
+    return re.sub(r"'[^']*'|\b\d+\b", "?", sql)
+
+
+class PresupuestoConsultasTest(TestCase):
+    """Queries of every route and RPC method with colonies of several
+    sizes, the count can't grow with the data nor pass the budget"""
+    TAMANOS = (2, 12)
+    # Sin grupo mide como superusuario
+    GRUPO = None
+    # Las comprobaciones de acceso y permisos cuestan lo mismo en todas
+    PRESUPUESTOS = {
+        "colonias": 4,
+        "rpc-metrics": 2,
+        "colonia-add": 3,
+        "colonia": 9,
+        "colonia-update": 4,
+        "comidas": 5,
+        "avistamiento": 6,
+        "snapshot": 11,
+        "eventos": 0,
+        "gatos": 5,
+        "gato-add": 4,
+        "gato": 12,
+        "gato-update": 8,
+        "capturar": 7,
+        "liberar": 7,
+        "morir": 7,
+        "captura": 6,
+        "vacunar": 6,
+        "captura-update": 6,
+        "captura-delete": 7,
+        "enfermedad-create": 5,
+        "enfermedad": 6,
+        "enfermedad-update": 6,
+        "enfermedad-delete": 6,
+        "fotos": 6,
+        "foto-add": 6,
+        "foto": 7,
+        "foto-update": 9,
+        "foto-delete": 6,
+        "informes": 6,
+        "informe-create": 6,
+        "informe": 6,
+        "informe-update": 8,
+        "informe-delete": 5,
+        "user-activity": 13,
+    }
+    EXENTAS = {
+        "RPC": "sus métodos van en PRESUPUESTOS_RPC",
+        "RPC-async": "sus métodos van en PRESUPUESTOS_RPC",
+        "update-miniaturas": "encola el mantenimiento de las fotos",
+        "update-exifs": "encola el mantenimiento de las fotos",
+        "calendario-comidas": "la vista no acepta el código",
+    }
+    # Cada escritura en el registro de cambios bloquea la colonia y lee su
+    # última versión, dos consultas más
+    PRESUPUESTOS_RPC = {
+        "alternar_comida_usuario": 10,
+        "set_feeding_assignment": 11,
+        "toggle_feeding_date": 10,
+        "generate_feeding_rota": 13,
+        "get_colony_feeding_users": 4,
+        "get_feeding_dates": 4,
+        "avistar_gato": 9,
+        "sync_colony": 6,
+        "get_colony_changes": 11,
+        "nuevo_codigo_qr": 6,
+        "borrar_codigo_qr": 5,
+        "get_colony_activity": 7,
+        "get_cat_activity": 12,
+        "system.listMethods": 0,
+        "system.methodHelp": 0,
+        "system.methodSignature": 0,
+    }
+    EXENTOS_RPC = {
+        "gato.capturar": "Gato no tiene get_flow",
+        "gato.liberar": "Gato no tiene get_flow",
+        "gato.desaparecer": "Gato no tiene get_flow",
+        "gato.olvidar": "Gato no tiene get_flow",
+        "gato.morir": "Gato no tiene get_flow",
+        "system.multicall": "solo existe en XML-RPC",
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser("admin", password="clave")
+        cls.usuario = cls.admin
+        if cls.GRUPO is not None:
+            with redirect_stdout(StringIO()):
+                call_command("syncpermissions")
+            cls.usuario = User.objects.create_user(cls.GRUPO,
+                                                   password="clave")
+            cls.usuario.groups.add(Group.objects.get(name=cls.GRUPO))
+        cls.colonias = {total: cls.sembrar(total) for total in cls.TAMANOS}
+
+    def setUp(self):
+        credenciales = base64.b64encode(
+            f"{self.usuario.username}:clave".encode()).decode()
+        self.client.defaults["HTTP_AUTHORIZATION"] = f"Basic {credenciales}"
+        self.client.force_login(self.usuario)
+
+    @classmethod
+    def sembrar(cls, total):
+        """Colony with ``total`` cats and a bit of everything for each"""
+        colonia = Colonia.objects.create(slug=f"colonia-{total}",
+                                         nombre=f"Colonia {total}")
+        colonia.usuarios_autorizados.add(cls.usuario)
+        for i in range(total):
+            gato = Gato.objects.create(nombre=f"Gato {total}-{i}", colonia=colonia)
+            foto = Foto.objects.create(colonia=colonia, usuario=cls.admin,
+                                       foto=f"fotos/{total}-{i}.jpg",
+                                       miniatura=f"miniaturas/{total}-{i}.jpg")
+            foto.gatos.add(gato)
+            gato.retrato = foto
+            gato.save()
+            for peso in (None, 3):
+                captura = Captura.objects.create(gato=gato, peso=peso,
+                                                 usuario=cls.admin)
+                Vacunacion.objects.create(captura=captura,
+                                          tipo="DESPARASITADO",
+                                          efecto=timedelta(90),
+                                          usuario=cls.admin)
+            Enfermedad.objects.create(gato=gato, diagnostico="Catarro",
+                                      usuario=cls.admin)
+            Avistamiento.objects.create(gato=gato, colonia=colonia,
+                                        usuario=cls.admin)
+            informe = Informe.objects.create(colonia=colonia,
+                                             titulo=f"Informe {i}",
+                                             usuario=cls.admin)
+            informe.gatos.add(gato)
+            AsignacionComida.objects.create(
+                colonia=colonia, fecha=date.today() + timedelta(i),
+                usuario=cls.admin)
+        return colonia
+
+    def argumentos(self, nombre, parametros, colonia):
+        gato = colonia.gatos.order_by("id").first()
+        if nombre.startswith("enfermedad"):
+            pk = gato.enfermedades.first().pk
+        elif nombre.startswith("informe"):
+            pk = colonia.informes.first().pk
+        else:
+            pk = gato.capturas.first().pk
+        valores = {"colonia": colonia.slug, "gato": gato.slug, "pk": pk,
+                   "foto": gato.retrato_id,
+                   "username": self.usuario.username}
+        return {p: valores[p] for p in parametros}
+
+    def medir(self, peticion):
+        cache.clear()
+        with CaptureQueriesContext(connection) as consultas:
+            respuesta = peticion()
+        self.assertLess(respuesta.status_code, 400)
+        return [normalizar(c["sql"]) for c in consultas.captured_queries]
+
+    def comprobar(self, nombre, presupuesto, medir):
+        base = None
+        for total in self.TAMANOS:
+            sql = medir(self.colonias[total])
+            if base is None:
+                base = sql
+            diferencias = "\n".join(difflib.unified_diff(
+                base, sql, f"{self.TAMANOS[0]} gatos", f"{total} gatos",
+                lineterm=""))
+            self.assertEqual(len(sql), len(base),
+                             f"{nombre} crece con los datos\n{diferencias}")
+            self.assertLessEqual(len(sql), presupuesto,
+                                 f"{nombre} pasa de {presupuesto} consultas\n"
+                                 + "\n".join(sql))
+
+    def test_todas_las_rutas(self):
+        nombres = {nombre for nombre, _ in rutas(urls.urlpatterns)}
+        self.assertEqual(nombres, set(self.PRESUPUESTOS) | set(self.EXENTAS))
+        metodos = set(registry.get_all_method_names())
+        self.assertEqual(metodos,
+                         set(self.PRESUPUESTOS_RPC) | set(self.EXENTOS_RPC))
+
+    def test_rutas(self):
+        for nombre, parametros in rutas(urls.urlpatterns):
+            if nombre in self.EXENTAS:
+                continue
+
+            def medir(colonia):
+                url = reverse(nombre, kwargs=self.argumentos(
+                    nombre, parametros, colonia))
+                return self.medir(lambda: self.client.get(url))
+            with self.subTest(ruta=nombre):
+                try:
+                    self.comprobar(nombre, self.PRESUPUESTOS[nombre], medir)
+                except locale.Error as e:
+                    self.skipTest(f"{nombre}: {e}")
+
+    def parametros_rpc(self, metodo, colonia):
+        gato = colonia.gatos.order_by("id").first()
+        dia = date.today() + timedelta(40)
+        otro = dia - timedelta(10)
+        parametros = {
+            "alternar_comida_usuario": {"colonia_slug": colonia.slug,
+                                        "ano": otro.year, "mes": otro.month,
+                                        "dia": otro.day},
+            "set_feeding_assignment": {"date_str": str(dia),
+                                       "colonia_id": colonia.id,
+                                       "user_id": self.usuario.id},
+            "toggle_feeding_date": {"date_str": str(dia + timedelta(1)),
+                                    "colonia_id": colonia.id},
+            "generate_feeding_rota": {
+                "colonia_id": colonia.id,
+                "start_date": str(dia + timedelta(10)),
+                "end_date": str(dia + timedelta(16)),
+                "user_ids": [self.usuario.id]},
+            "get_colony_feeding_users": {"colonia_id": colonia.id},
+            "get_feeding_dates": {"colonia_id": colonia.id},
+            "avistar_gato": {"colonia_slug": colonia.slug,
+                             "gato_slug": gato.slug},
+            "sync_colony": {"colonia_id": colonia.id, "operations": []},
+            "get_colony_changes": {"colonia_id": colonia.id, "since": 0},
+            "get_colony_activity": {"colonia_slug": colonia.slug},
+            "get_cat_activity": {"colonia_slug": colonia.slug,
+                                 "gato_slug": gato.slug},
+            "system.methodHelp": {"method_name": "sync_colony"},
+            "system.methodSignature": {"method_name": "sync_colony"},
+        }
+        return parametros.get(metodo, {})
+
+    def test_rpc(self):
+        for url in ("/rpc/", "/rpc/async/"):
+            for metodo, presupuesto in self.PRESUPUESTOS_RPC.items():
+                if url == "/rpc/async/" and metodo not in rpc_async.METODOS:
+                    continue
+
+                def medir(colonia):
+                    llamada = {"jsonrpc": "2.0", "id": 1, "method": metodo,
+                               "params": self.parametros_rpc(metodo, colonia)}
+                    return self.medir(lambda: self.client.post(
+                        url, json.dumps(llamada),
+                        content_type="application/json"))
+                with self.subTest(url=url, metodo=metodo):
+                    self.comprobar(metodo, presupuesto, medir)
+
+
+class PresupuestoCuidadorTest(PresupuestoConsultasTest):
+    """The budgets of a volunteer authorized in the colonies, who pays
+    what the superuser skips: compiling its permissions, checking access
+    and saving the authorized colonies in the session"""
+    GRUPO = "cuidador"
+    PRESUPUESTOS = {
+        "colonias": 8,
+        "colonia": 17,
+        "comidas": 13,
+        "avistamiento": 14,
+        "snapshot": 19,
+        "eventos": 0,
+        "gatos": 13,
+        "gato": 20,
+        "enfermedad": 14,
+        "fotos": 14,
+        "foto-add": 13,
+        "foto": 14,
+        "informes": 13,
+        "informe-create": 13,
+        "informe": 14,
+        "user-activity": 10,
+    }
+    EXENTAS = {
+        **PresupuestoConsultasTest.EXENTAS,
+        **dict.fromkeys(set(PresupuestoConsultasTest.PRESUPUESTOS)
+                        - set(PRESUPUESTOS), "el cuidador no tiene permiso"),
+    }
+    # generate_feeding_rota y los códigos QR solo comprueban el permiso
+    PRESUPUESTOS_RPC = {
+        **PresupuestoConsultasTest.PRESUPUESTOS_RPC,
+        "set_feeding_assignment": 15,
+        "toggle_feeding_date": 14,
+        "generate_feeding_rota": 3,
+        "nuevo_codigo_qr": 4,
+        "borrar_codigo_qr": 3,
+    }
+
+
+class SinteticoTest(TestCase):
+    HASTA = date(2024, 6, 30)
+
+    def sembrar(self, prefijo, **kwargs):
+        opciones = dict(colonias=1, gatos=8, dias=300, voluntarios=3,
+                        hasta=self.HASTA, prefijo=prefijo, con_imagenes=False)
+        return sintetico.sembrar(**{**opciones, **kwargs})
+
+    def historia(self, prefijo):
+        colonia = Colonia.objects.get(slug=f"{prefijo}-0")
+        gatos = colonia.gatos.order_by("id")
+        return {
+            "gatos": list(gatos.values_list("estado", "fecha_alta",
+                                            "retrato__fecha")),
+            "avistamientos": list(colonia.avistamientos.order_by("id")
+                                  .values_list("fecha", flat=True)),
+            "comidas": list(colonia.comidas.order_by("fecha")
+                            .values_list("fecha", "usuario__last_name")),
+        }
+
+    def test_determinista(self):
+        informe = self.sembrar("a")
+        self.assertEqual(self.sembrar("b"), informe)
+        self.assertEqual(self.historia("a"), self.historia("b"))
+        self.assertNotEqual(self.sembrar("c", semilla=2), informe)
+
+    def test_historia(self):
+        self.sembrar("a")
+        self.assertEqual(set(Gato.objects.values_list("estado", flat=True)),
+                         set(EstadoGato))
+        fechas = Avistamiento.objects.values_list("fecha", flat=True)
+        self.assertLess(min(fechas), self.HASTA - timedelta(200))
+        self.assertEqual(max(fechas), self.HASTA)
+        self.assertFalse(Captura.objects.filter(
+            fecha_captura__gt=self.HASTA).exists())
+        self.assertTrue(Vacunacion.objects.exists())
+        # Las fechas automáticas vuelven a funcionar
+        self.assertTrue(Informe._meta.get_field("fecha").auto_now)
+        informe = Informe.objects.create(colonia=Colonia.objects.get(),
+                                         titulo="Hoy")
+        self.assertEqual(informe.fecha, date.today())
+
+    def test_imagenes(self):
+        self.sembrar("a", gatos=2, dias=60, con_imagenes=True)
+        foto = Foto.objects.first()
+        self.assertTrue(default_storage.exists(foto.foto.name))
+        self.assertFalse(foto.procesar())
+        for foto in Foto.objects.all():
+            default_storage.delete(foto.foto.name)
+            default_storage.delete(foto.miniatura.name)
+
+    def test_existente(self):
+        self.sembrar("a", gatos=1, dias=10)
+        with self.assertRaises(ValueError):
+            self.sembrar("a", gatos=1, dias=10)
+
+    def test_no_positivos(self):
+        for opcion in ("voluntarios", "gatos", "dias"):
+            with self.subTest(opcion=opcion):
+                with self.assertRaises(ValueError):
+                    self.sembrar("b", **{opcion: 0})
+                with self.assertRaises(CommandError):
+                    call_command("sembrar", prefijo="b", sin_imagenes=True,
+                                 **{opcion: -1})
+        self.assertFalse(Colonia.objects.filter(slug__startswith="b-")
+                         .exists())
+
+
+@override_settings(MEDIA_ROOT=mkdtemp(), TASK_QUEUES=EAGER)
+class CargaTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        with redirect_stdout(StringIO()):
+            call_command("syncpermissions")
+        sintetico.sembrar(colonias=1, gatos=6, dias=60, voluntarios=2,
+                          prefijo="carga", con_imagenes=False)
+        self.colonia = Colonia.objects.get(slug="carga-0")
+        self.usuario = self.colonia.usuarios_autorizados.first()
+
+    def estado(self):
+        return {
+            "fotos": list(Foto.objects.values_list("id", flat=True)),
+            "avistamientos": list(Avistamiento.objects.order_by("gato", "fecha")
+                                  .values_list("gato", "fecha")),
+            "comidas": list(AsignacionComida.objects.order_by("fecha")
+                            .values_list("fecha", "usuario")),
+            "cambios": Cambio.objects.count(),
+            "sesiones": Session.objects.count(),
+        }
+
+    def test_sesiones(self):
+        antes = self.estado()
+        resultados = carga.cargar(carga.Escenario(self.colonia),
+                                  carga.ClienteLocal(self.usuario),
+                                  sesiones=3)
+        self.assertEqual(resultados["total"]["errores"], 0)
+        self.assertEqual(resultados["avistar_gato"]["peticiones"],
+                         3 * 2 * carga.AVISTADOS)
+        self.assertEqual(resultados["foto_upload"]["peticiones"], 3)
+        for datos in resultados.values():
+            self.assertGreater(datos["consultas"], 0)
+        # Los toggles se deshacen y las fotos se borran
+        self.assertEqual(self.estado(), antes)
+
+    def test_errores_rpc(self):
+        self.assertFalse(carga.fallida(200, b'{"result": {"dates": []}}'))
+        self.assertTrue(carga.fallida(200, b'[{"result": {"error": "No"}}]'))
+        self.assertTrue(carga.fallida(200, b'{"error": {"code": -32601}}'))
+        self.assertTrue(carga.fallida(403, b"<html>"))
+
+    def test_comparar(self):
+        anterior = {"total": {"p50": 0.25, "p95": 0.5, "consultas": None}}
+        actual = {"total": {"p50": 0.5, "p95": 0.25, "consultas": 5},
+                  "nuevo": {"p50": 1}}
+        self.assertEqual(carga.comparar(anterior, actual), {
+            "total": {"p50": 1.0, "p95": -0.5, "consultas": None}})
+
+
+class MicroTest(TestCase):
+    def test_medir(self):
+        resultados = micro.medir(["atleast_galeria"], repeticiones=3,
+                                 minimo=0.001, tamanos=[5])
+        self.assertEqual(set(resultados), {"referencia", "atleast_galeria"})
+        self.assertEqual(set(resultados["referencia"]), {"1000"})
+        medida = resultados["atleast_galeria"]["5"]
+        self.assertEqual(len(medida["muestras"]), 3)
+        self.assertGreater(medida["mediana"], 0)
+        with self.assertRaises(KeyError):
+            micro.medir(["nada"])
+
+    def test_casos(self):
+        # Cada caso prepara su entrada y se puede llamar
+        for caso in micro.CASOS.values():
+            caso.preparar(caso.tamanos[0])()
+
+    def test_mann_whitney(self):
+        antes = [1.0 + i / 100 for i in range(20)]
+        self.assertLess(micro.mann_whitney(antes, [v * 1.5 for v in antes]),
+                        0.001)
+        self.assertGreater(micro.mann_whitney(antes, antes), 0.4)
+        self.assertGreater(micro.mann_whitney(antes, [v / 2 for v in antes]),
+                           0.99)
+        self.assertEqual(micro.mann_whitney([1.0] * 5, [1.0] * 5), 1.0)
+
+    def medida(self, valores):
+        return {"mediana": statistics.median(valores), "muestras": valores}
+
+    def test_comparar(self):
+        valores = [1.0 + i / 100 for i in range(20)]
+        base = {"referencia": {"1000": self.medida(valores)},
+                "caso": {"10": self.medida(valores)}}
+        # Todo el doble de lento, la máquina
+        lenta = {nombre: {"10" if nombre == "caso" else "1000":
+                          self.medida([v * 2 for v in valores])}
+                 for nombre in base}
+        cambio, = micro.comparar(base, lenta)
+        self.assertAlmostEqual(cambio["cambio"], 0)
+        self.assertFalse(cambio["regresion"])
+        cambio, = micro.comparar(base, lenta, normalizar=False)
+        self.assertAlmostEqual(cambio["cambio"], 1)
+        self.assertTrue(cambio["regresion"])
+        # Solo el caso más lento
+        lenta["referencia"] = base["referencia"]
+        cambio, = micro.comparar(base, lenta)
+        self.assertTrue(cambio["regresion"])
+        self.assertFalse(micro.comparar(base, base)[0]["regresion"])
+
+    def test_perfilar(self):
+        self.assertIn("_build_data", micro.perfilar("activity", 10))
+        self.assertIn("Pico", micro.perfilar("agrupador", 100,
+                                              "tracemalloc"))
+        with self.assertRaises(ValueError):
+            micro.perfilar("activity", 10, "otro")
+
+    def test_comando(self):
+        base = Path(mkdtemp()) / "base.json"
+        salida = StringIO()
+        call_command("benchmicro", "atleast_galeria", tamanos=[5],
+                     repeticiones=3, minimo=0.001, salida=base,
+                     stdout=salida)
+        self.assertIn("atleast_galeria[5]", salida.getvalue())
+        call_command("benchmicro", "atleast_galeria", tamanos=[5],
+                     repeticiones=3, minimo=0.001, comparar=base,
+                     stdout=salida)
+        self.assertIn("p=", salida.getvalue())
+        informe = json.loads(base.read_text())
+        self.assertIn("muestras", informe["resultados"]["referencia"]["1000"])
+
+
+class AsyncTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.colonia = Colonia.objects.create(slug="mi-colonia",
+                                              nombre="Mi Colonia")
+        Gato.objects.create(colonia=self.colonia, slug="misi", nombre="Misi")
+        self.usuario = User.objects.create_user("voluntario")
+        self.colonia.usuarios_autorizados.add(self.usuario)
+        self.admin = User.objects.create_superuser("admin")
+        self.async_client.force_login(self.usuario)
+
+    async def test_batch(self):
+        params = {"colonia_id": self.colonia.id}
+        payload = [
+            {"jsonrpc": "2.0", "id": 0, "method": "get_feeding_dates",
+             "params": params},
+            {"jsonrpc": "2.0", "id": 1, "method": "get_colony_feeding_users",
+             "params": params},
+            {"jsonrpc": "2.0", "id": 2, "method": "set_feeding_assignment",
+             "params": params},
+        ]
+        respuesta = await self.async_client.post(
+            "/rpc/async/", json.dumps(payload),
+            content_type="application/json")
+        respuesta = respuesta.json()
+        self.assertEqual([r["id"] for r in respuesta], [0, 1, 2])
+        self.assertIn("dates", respuesta[0]["result"])
+        self.assertEqual(respuesta[1]["result"]["current_user_id"],
+                         self.usuario.id)
+        self.assertEqual(respuesta[2]["error"]["code"], -32601)
+
+    def test_sin_acceso(self):
+        peticion = AsyncRequestFactory().post("/rpc/async/")
+        peticion.user = AnonymousUser()
+        respuesta = rpc_async.ejecutar(peticion, {
+            "id": 1, "method": "get_colony_activity",
+            "params": {"colonia_slug": "mi-colonia"}})
+        self.assertIn("error", respuesta["result"])
+
+    async def test_paginas(self):
+        peticion = AsyncRequestFactory().get("/colonias/mi-colonia/")
+        peticion.user = self.admin
+        peticion.session = {}
+        with override_settings(ASYNC_VIEWS=True):
+            respuesta = await views.colonia_async(peticion,
+                                                  colonia="mi-colonia")
+        self.assertContains(respuesta, "Misi")
+        # Las lecturas del calendario y las gráficas van al asíncrono
+        self.assertContains(respuesta, 'data-rpc-url="/rpc/async/"')
+        respuesta = await views.gato_async(peticion, colonia="mi-colonia",
+                                           gato="misi")
+        self.assertContains(respuesta, "Misi")
+        with self.assertRaises(Http404):
+            await views.gato_async(peticion, colonia="mi-colonia",
+                                   gato="otro")
+
+
+class EventosTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.colonia = Colonia.objects.create(slug="mi-colonia",
+                                              nombre="Mi Colonia")
+        self.usuario = User.objects.create_user("voluntario")
+        self.usuario.user_permissions.add(
+            Permission.objects.get(codename="view_colonia"))
+        self.colonia.usuarios_autorizados.add(self.usuario)
+        self.client.force_login(self.usuario)
+        self.async_client.force_login(self.usuario)
+        self.manana = date.today() + timedelta(days=1)
+        self.url = "/colonia/c/mi-colonia/eventos"
+
+    def alimentar(self):
+        self.colonia.toggle_comida(self.manana, self.usuario)
+
+    async def test_publicacion(self):
+        mensajes = eventos.escuchar(self.colonia.id)
+        siguiente = asyncio.ensure_future(mensajes.__anext__())
+        await asyncio.sleep(0)
+        await sync_to_async(self.alimentar)()
+        datos = json.loads(await asyncio.wait_for(siguiente, 5))
+        self.assertEqual(datos["changed"]["feedings"],
+                         [{"date": f"{self.manana}",
+                           "user_id": self.usuario.id}])
+        self.assertNotIn("cats", datos["changed"])
+        await mensajes.aclose()
+        self.assertEqual(eventos.bus.suscriptores, {})
+
+    async def test_sse(self):
+        respuesta = await self.async_client.get(self.url)
+        self.assertEqual(respuesta["Content-Type"], "text/event-stream")
+        flujo = respuesta.streaming_content
+        self.assertEqual(await flujo.__anext__(), b"retry: 5000\n\n")
+        # La versión de partida, por si se corta antes de que haya cambios
+        mensaje = (await asyncio.wait_for(flujo.__anext__(), 5)).decode()
+        self.assertTrue(mensaje.startswith("id: 0\n"))
+        siguiente = asyncio.ensure_future(flujo.__anext__())
+        await asyncio.sleep(0.1)
+        await sync_to_async(self.alimentar)()
+        mensaje = (await asyncio.wait_for(siguiente, 5)).decode()
+        self.assertTrue(mensaje.startswith("id: "))
+        self.assertIn("event: cambios", mensaje)
+        await flujo.aclose()
+
+    async def test_ponerse_al_dia(self):
+        await sync_to_async(self.alimentar)()
+        respuesta = await self.async_client.get(self.url,
+                                                headers={"Last-Event-ID": "0"})
+        flujo = respuesta.streaming_content
+        await flujo.__anext__()
+        mensaje = (await asyncio.wait_for(flujo.__anext__(), 5)).decode()
+        self.assertIn(f'"date": "{self.manana}"', mensaje)
+        await flujo.aclose()
+
+    async def test_duracion(self):
+        mensajes = eventos.escuchar(self.colonia.id, duracion=0.1)
+        with self.assertRaises(StopAsyncIteration):
+            await asyncio.wait_for(mensajes.__anext__(), 5)
+        self.assertEqual(eventos.bus.suscriptores, {})
+        with override_settings(EVENTOS_DURACION=0.1):
+            respuesta = await self.async_client.get(self.url)
+            contenido = [parte async for parte
+                         in respuesta.streaming_content]
+        self.assertEqual(len(contenido), 2)
+
+    def test_wsgi(self):
+        self.assertEqual(self.client.get(self.url).status_code, 204)
@@ -1,6 +1,16 @@
+from django.conf import settings
 from django.urls import path, include
 from modernrpc.views import RPCEntryPoint
-from . import views
+from . import rpc_async, views
+
+
+# Las páginas de solo lectura tienen versión asíncrona para ASGI
+if settings.ASYNC_VIEWS:
+    colonia_view = views.colonia_async
+    gato_view = views.gato_async
+else:
+    colonia_view = views.ColoniaView.as_view()
+    gato_view = views.GatoView.as_view()
 
 
 gato_urls = [
@@ -31,9 +41,11 @@ colonia_urls = [
     path('comidas', views.CalendarioComidas.as_view(),
          name="comidas"),
     path('avistamientos', views.Avistamientos.as_view(), name="avistamiento"),
+    path('snapshot.json', views.ColoniaSnapshot.as_view(), name="snapshot"),
+    path('eventos', views.eventos_colonia, name="eventos"),
     path('gatos/', views.GatosView.as_view(), name="gatos"),
     path('gato-add', views.GatoCreateView.as_view(), name="gato-add"),
-    path('gatos/g/<slug:gato>', views.GatoView.as_view(), name="gato"),
+    path('gatos/g/<slug:gato>', gato_view, name="gato"),
     path('gatos/g/<slug:gato>/update', views.GatoUpdateView.as_view(),
          name="gato-update"),
     path('gatos/g/<slug:gato>/update', views.GatoUpdateView.as_view(),
@@ -70,9 +82,10 @@ user_urls = [
 urlpatterns = [
     path("", views.ColoniasList.as_view(), name="colonias"),
     path("rpc/", RPCEntryPoint.as_view(enable_doc=True), name="RPC"),
+    path("rpc/async/", rpc_async.entry_point, name="RPC-async"),
+    path("rpc/metrics", views.metricas, name="rpc-metrics"),
     path('colonia-add', views.ColoniaCreateView.as_view(), name="colonia-add"),
-    path('colonia/c/<slug:colonia>', views.ColoniaView.as_view(),
-         name="colonia"),
+    path('colonia/c/<slug:colonia>', colonia_view, name="colonia"),
     path('colonia/c/<slug:colonia>/update', views.ColoniaUpdateView.as_view(),
          name="colonia-update"),
     path('colonia/c/<slug:colonia>/', include(colonia_urls)),
@@ -1,8 +1,11 @@
 from io import BytesIO
+import hashlib
 import string
 from mimetypes import MimeTypes
 import secrets
+from asgiref.sync import sync_to_async
 from django.core.files import File
+from django.db import close_old_connections
 
 alphabet = string.ascii_lowercase + string.digits
 
@@ -19,6 +22,31 @@ def random_choice():
     return ''.join(secrets.choice(alphabet) for _ in range(16))
 
 
+def en_hilo(funcion):
+    """Async version of ``funcion`` that runs in a thread of the pool.
+
+    Sync code called from async views runs by default in a single thread
+    shared by every request, so a slow query would hold all of them. The
+    connection is closed afterwards, as at the end of a request.
+    """
+    def ejecutar(*args, **kwargs):
+        try:
+            return funcion(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return sync_to_async(ejecutar, thread_sensitive=False)
+
+
+def fan_out(nombre, niveles=2, ancho=2):
+    """Return the hashed sub-directory for ``nombre``, e.g. ``"ab/cd"``.
+
+    Spreads media files across ``16 ** (niveles * ancho)`` directories so no
+    single directory grows with the number of photos.
+    """
+    digest = hashlib.md5(str(nombre).encode("utf-8")).hexdigest()
+    return "/".join(digest[i * ancho:(i + 1) * ancho] for i in range(niveles))
+
+
 class Agrupador:
     @staticmethod
     def get_value(item):
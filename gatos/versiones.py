@@ -0,0 +1,146 @@
+"""
+Version counters kept in the cache to invalidate derived data.
+
+Cached values include the version of what they depend on in their key, so
+bumping the version makes every stale entry unreachable without having to
+find and delete it.
+
+    @cacheado("actividad", ambitos=("colonia",))
+    def actividad(colonia):
+        ...
+
+The ``colonia`` version is bumped by every write to a model that belongs
+to the colony, ``comidas`` by the feeding assignments and ``permisos``,
+which is global, by changes to users, groups and permissions. Versions
+are bumped when the transaction commits: bumped before, a concurrent
+reader could cache the old rows under the new version.
+
+Versions only reach other processes through a shared cache, without one
+(``settings.CACHE_COMPARTIDA``) nothing is cached across requests.
+"""
+import hashlib
+import time
+from functools import wraps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+GLOBALES = ("permisos",)
+
+ESPERA = 5
+BLOQUEO_TIMEOUT = 30
+
+ESTADISTICAS_KEY = "cache-stats:{}:{}"
+EVENTOS = ("aciertos", "fallos", "esperas")
+NOMBRES = set()
+
+
+def clave_version(ambito, id=None):
+    if id is None:
+        return f"version:{ambito}"
+    return f"version:{ambito}:{id}"
+
+
+def compartida():
+    """Whether every process sees the versions bumped by the others"""
+    return getattr(settings, "CACHE_COMPARTIDA", False)
+
+
+def version(ambito, id=None):
+    clave = clave_version(ambito, id)
+    valor = cache.get(clave)
+    if valor is None:
+        # Partimos de la hora para no repetir una versión ya usada si la
+        # caché pierde el contador
+        cache.add(clave, time.time_ns(), timeout=None)
+        valor = cache.get(clave)
+    return valor
+
+
+def incrementar(clave):
+    try:
+        cache.incr(clave)
+    except ValueError:
+        cache.add(clave, time.time_ns(), timeout=None)
+
+
+def invalidar(ambito, id=None):
+    """Bump the version once the current transaction commits, right away
+    outside of one"""
+    clave = clave_version(ambito, id)
+    transaction.on_commit(lambda: incrementar(clave))
+
+
+def contar(nombre, evento):
+    clave = ESTADISTICAS_KEY.format(nombre, evento)
+    try:
+        cache.incr(clave)
+    except ValueError:
+        if not cache.add(clave, 1, timeout=None):
+            cache.incr(clave)
+
+
+def estadisticas():
+    """Hits, misses and waits of every cached function"""
+    claves = {(n, e): ESTADISTICAS_KEY.format(n, e)
+              for n in sorted(NOMBRES) for e in EVENTOS}
+    valores = cache.get_many(claves.values())
+    resultado = {}
+    for (nombre, evento), clave in claves.items():
+        resultado.setdefault(nombre, {})[evento] = valores.get(clave, 0)
+    for datos in resultado.values():
+        total = datos["aciertos"] + datos["fallos"]
+        datos["ratio"] = datos["aciertos"] / total if total else 0.0
+    return resultado
+
+
+def obtener(clave, calcular, timeout, nombre=None, espera=ESPERA):
+    """Return the cached value of ``clave`` or compute it.
+
+    Only one caller computes a missing value, the rest wait up to
+    ``espera`` seconds for it instead of all hitting the database.
+    """
+    nombre = nombre or clave
+    valor = cache.get(clave)
+    if valor is not None:
+        contar(nombre, "aciertos")
+        return valor
+    contar(nombre, "fallos")
+    bloqueo = f"{clave}:bloqueo"
+    if not cache.add(bloqueo, True, timeout=BLOQUEO_TIMEOUT):
+        contar(nombre, "esperas")
+        limite = time.monotonic() + espera
+        while time.monotonic() < limite:
+            time.sleep(0.05)
+            valor = cache.get(clave)
+            if valor is not None:
+                return valor
+        # Quien lo calculaba no ha terminado, lo hacemos nosotros
+        return calcular()
+    try:
+        valor = calcular()
+        cache.set(clave, valor, timeout)
+    finally:
+        cache.delete(bloqueo)
+    return valor
+
+
+def cacheado(nombre, ambitos=("colonia",), timeout=60 * 60):
+    """Cache ``funcion(colonia, *args)`` until a version of ``ambitos``
+    changes"""
+    NOMBRES.add(nombre)
+
+    def decorador(funcion):
+        @wraps(funcion)
+        def envoltura(colonia, *args):
+            if not compartida():
+                return funcion(colonia, *args)
+            partes = [version(a) if a in GLOBALES else version(a, colonia.id)
+                      for a in ambitos]
+            if args:
+                partes.append(hashlib.md5(repr(args).encode()).hexdigest())
+            clave = ":".join(map(str, [nombre, colonia.id, *partes]))
+            return obtener(clave, lambda: funcion(colonia, *args), timeout,
+                           nombre=nombre)
+        return envoltura
+    return decorador
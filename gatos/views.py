@@ -1,12 +1,24 @@
+import base64
+import gzip
+import json
 from datetime import date, datetime
+from functools import cached_property
 from htmlcalendar import htmlcalendar
 from icalendar import Calendar, Event as IcalEvent
-from django.core.exceptions import ObjectDoesNotExist
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ObjectDoesNotExist, PermissionDenied
 from django.conf import settings
-from django.http import HttpResponse, HttpResponseRedirect
+from django.core.handlers.asgi import ASGIRequest
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import (Http404, HttpResponse, HttpResponseRedirect,
+                         StreamingHttpResponse)
 from django.shortcuts import get_object_or_404, render
 from django.urls import reverse
+from django.utils.cache import (get_conditional_response, patch_cache_control,
+                                patch_vary_headers)
 from django.utils.text import slugify
+from django.contrib.auth import authenticate
+from django.contrib.auth.views import redirect_to_login
 from django.contrib.auth.mixins import PermissionRequiredMixin as PRMixin
 from django.views import View
 from django.views.generic import (DetailView,
@@ -24,6 +36,7 @@ from .models import (Gato,
                      Informe,
                      Vacunacion,
                      Avistamiento,
+                     Cambio,
                      CodigoCalendarioComidas,
                      )
 from .forms import (FotoCreateForm,
@@ -35,10 +48,13 @@ from .forms import (FotoCreateForm,
                     EnfermedadUpdateForm,
                     VacunarGatoForm
                     )
+from .accesos import tiene_acceso
+from .identidad import acargar, cargar_o_404
 from .plots import get_svg_qrcode
-from .utils import Agrupador
+from .utils import Agrupador, en_hilo
 from .flows import GatoFlow
-from . import tasks
+from gatinos.dispatch import enqueue
+from . import eventos, metrics, sincronizacion, tasks
 
 
 class ConfirmationView(View):
@@ -90,36 +106,16 @@ class CommandView(TemplateView):
         return super().get(request, *args, **kwargs)
 
 
-class GatoConfirmationView(ConfirmationView):
-    template = "gatos/gato_confirmacion.html"
-
-    def setup(self, request, *args, **kwargs):
-        super().setup(request, *args, **kwargs)
-        self.colonia = get_object_or_404(Colonia, slug=self.kwargs['colonia'])
-        self.gato = get_object_or_404(Gato, colonia=self.colonia,
-                                      slug=self.kwargs['gato'])
-
-    def get_context(self):
-        context = super().get_context()
-        context['colonia'] = self.colonia
-        context['gato'] = self.gato
-        capturas = self.gato.capturas.order_by("-fecha_captura")
-        context['captura'] = capturas[0] if capturas else None
-        return context
-
-# TODO Aqui hay un problema con la ultima captura
-
-
 class BaseColoniaMixin:
     """Mixin that loads colony and checks access"""
     
     def setup(self, request, *args, **kwargs):
         super().setup(request, *args, **kwargs)
-        self.colonia = get_object_or_404(Colonia, slug=self.kwargs['colonia'])
+        self.colonia = cargar_o_404(request, Colonia,
+                                    slug=self.kwargs['colonia'])
         
         # Check access right after loading the colony
-        if not request.user.is_superuser and not self.colonia.user_has_access(request.user):
-            from django.core.exceptions import PermissionDenied
+        if not tiene_acceso(request, self.colonia):
             raise PermissionDenied(f"No tiene acceso a la colonia '{self.colonia.nombre}'")
 
 
@@ -138,27 +134,56 @@ class ColoniaMixin(BaseColoniaMixin):
         return self.colonia
 
 
+def ficha_gato(gato):
+    """Captures, weight and vaccines of the cat from one query for the
+    captures and one for their vaccines"""
+    capturas = list(gato.capturas.order_by("-fecha_captura", "-id")
+                    .prefetch_related("vacunas"))
+    pesos = [c.peso for c in capturas if c.peso is not None]
+    return {
+        "ultima_captura": capturas[0] if capturas else None,
+        "peso": pesos[0] if pesos else None,
+        "capturas": capturas[:5],
+        "vacunas": [v for c in capturas for v in c.vacunas.all()],
+    }
+
+
+def galeria_fotos(gato):
+    return gato.fotos.select_related("colonia").prefetch_related("gatos")
+
+
 class BaseGatoMixin:
+    """Mixin that loads the cat of the colony when first used, the
+    captures, vaccines and diseases only when the page shows them"""
     gato_slug = "gato"
 
-    def setup(self, request, *args, **kwargs):
-        super().setup(request, *args, **kwargs)
-        self.gato = get_object_or_404(Gato, slug=self.kwargs[self.gato_slug])
-        self.capturas = self.gato.capturas.order_by('fecha_captura')
-        self.ultima_captura = self.capturas[0] if self.capturas else None
-        self.peso = self.gato.get_peso()
-        self.enfermedades = self.gato.enfermedades.all()
-        capturas = self.gato.capturas.order_by("-fecha_captura")
-        self.capturas = capturas.select_related("gato__colonia").all()[:5]
-        self.vacunas = self.gato.get_vacunas()
+    @cached_property
+    def gato(self):
+        gatos = Gato.objects.select_related("retrato")
+        gato = cargar_o_404(self.request, gatos,
+                            slug=self.kwargs[self.gato_slug])
+        if gato.colonia_id != self.colonia.id:
+            raise Http404
+        return gato
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        context['ultima_captura'] = self.ultima_captura
-        context['enfermedades'] = self.enfermedades
-        context['peso'] = self.peso
-        context['capturas'] = self.capturas
-        context['vacunas'] = self.vacunas
+    @cached_property
+    def ficha(self):
+        return ficha_gato(self.gato)
+
+    @property
+    def ultima_captura(self):
+        return self.ficha["ultima_captura"]
+
+
+class GatoConfirmationView(BaseColoniaMixin, BaseGatoMixin,
+                           ConfirmationView):
+    template = "gatos/gato_confirmacion.html"
+
+    def get_context(self):
+        context = super().get_context()
+        context['colonia'] = self.colonia
+        context['gato'] = self.gato
+        context['captura'] = self.ultima_captura
         return context
 
 
@@ -180,9 +205,10 @@ class GatoMixin(BaseGatoMixin):
 class BaseCapturaMixin:
     captura_pk = "pk"
 
-    def setup(self, request, *args, **kwargs):
-        super().setup(request, *args, **kwargs)
-        self.captura = get_object_or_404(Captura, id=kwargs[self.captura_pk])
+    @cached_property
+    def captura(self):
+        return get_object_or_404(self.gato.capturas.all(),
+                                 id=self.kwargs[self.captura_pk])
 
 
 class SubCapturaMixin(BaseCapturaMixin):
@@ -205,7 +231,7 @@ class FotoMixin:
     def get_context_data(self, **kwargs):
         data = super().get_context_data(**kwargs)
         data['foto'] = self.foto
-        data['gatos'] = self.foto.gatos.all()
+        data['gatos'] = self.foto.gatos.galeria()
         return data
 
     def get_object(self):
@@ -223,7 +249,7 @@ class InformeMixin:
     def get_context_data(self, **kwargs):
         data = super().get_context_data(**kwargs)
         data['informe'] = self.informe
-        data['gatos'] = self.informe.gatos.all()
+        data['gatos'] = self.informe.gatos.galeria()
         return data
 
     def get_object(self):
@@ -248,9 +274,7 @@ class ColoniasList(PRMixin, ListView):
     context_object_name = "colonias"
     
     def get_queryset(self):
-        if self.request.user.is_superuser:
-            return Colonia.objects.all()
-        return self.request.user.colonias_autorizadas.all()
+        return Colonia.objects.for_user(self.request.user)
 
 
 class ColoniaView(PRMixin, ColoniaMixin, DetailView):
@@ -267,7 +291,7 @@ class ColoniaView(PRMixin, ColoniaMixin, DetailView):
         def classes(f):
             if f not in comidas:
                 return ["comidas-none"]
-            elif comidas[f].usuario == self.request.user:
+            elif comidas[f].usuario_id == self.request.user.pk:
                 return ["comidas-usuario"]
             else:
                 return ["comidas-otro"]
@@ -278,7 +302,8 @@ class ColoniaView(PRMixin, ColoniaMixin, DetailView):
     def get_context_data(self, **kwargs):
         data = super().get_context_data(**kwargs)
         data['gatos'] = self.colonia.get_gatos_activos()
-        data['fotos'] = self.colonia.fotos.order_by("fecha").all()[:20]
+        data['fotos'] = (self.colonia.fotos.order_by("fecha")
+                         .prefetch_related("gatos")[:20])
         data['informes'] = self.colonia.informes.order_by("fecha").all()[:20]
         data['calendarios'] = self.get_calendars()
         return data
@@ -317,14 +342,13 @@ class GatosView(PRMixin, SubColoniaMixin, ListView):
         return context
 
     def get_queryset(self):
-        if self.estado == "activos":
-            return self.colonia.get_gatos_activos()
-        elif self.estado == "desaparecidos":
-            return self.colonia.get_gatos_desaparecidos()
+        if self.estado == "desaparecidos":
+            gatos = self.colonia.gatos_desaparecidos()
         elif self.estado == "muertos":
-            return self.colonia.gatos.filter(muerto=True)
+            gatos = self.colonia.gatos.filter(muerto=True)
         else:
-            return self.colonia.get_gatos_activos()
+            gatos = self.colonia.gatos_activos()
+        return gatos.galeria()
 
 
 class GatoView(PRMixin, SubColoniaMixin, GatoMixin, DetailView):
@@ -334,8 +358,11 @@ class GatoView(PRMixin, SubColoniaMixin, GatoMixin, DetailView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
+        context.update(self.ficha)
         context['estado'] = self.gato.estado
+        context['enfermedades'] = self.gato.enfermedades.all()
         context['informes'] = self.gato.informes.all()
+        context['fotos'] = galeria_fotos(self.gato)
         return context
 
 
@@ -389,7 +416,7 @@ class FotoCreateView(PRMixin, UserBoundMixin, SubColoniaMixin, CreateView):
 
     def form_valid(self, form):
         response = super().form_valid(form)
-        tasks.process_image.delay(form.instance.id)
+        tasks.encolar_proceso(form.instance.id)
         return response
 
 
@@ -406,7 +433,7 @@ class FotosView(PRMixin, SubColoniaMixin, ListView):
     context_object_name = "fotos"
 
     def get_queryset(self):
-        return self.colonia.fotos.all()
+        return self.colonia.fotos.prefetch_related("gatos")
 
 
 class FotoUpdateView(PRMixin, UserBoundMixin, SubColoniaMixin, FotoMixin,
@@ -426,7 +453,9 @@ class FotoUpdateView(PRMixin, UserBoundMixin, SubColoniaMixin, FotoMixin,
 
     def form_valid(self, form):
         response = super().form_valid(form)
-        tasks.process_image.delay(form.instance.id)
+        # Cambiar los gatos de la foto no requiere volver a procesarla
+        if "foto" in form.changed_data:
+            tasks.encolar_proceso(form.instance.id)
         return response
 
 
@@ -459,7 +488,8 @@ class InformesView(PRMixin, SubColoniaMixin, TemplateView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        informes = self.colonia.informes.all().order_by("-fecha")
+        informes = (self.colonia.informes.select_related("usuario")
+                    .order_by("-fecha"))
         context['agrupador'] = AgrupadorDeInformes(informes)
         return context
 
@@ -523,12 +553,11 @@ class InformeDeleteView(PRMixin, BaseInformeView, DeleteView):
 # ------------------------------------------------------------------------
 
 
-class CapturaBaseMixin(SubGatoMixin, SubColoniaMixin):
+class CapturaBaseMixin(SubGatoMixin, SubColoniaMixin, BaseCapturaMixin):
     model = Captura
 
-    def setup(self, request, *args, **kwargs):
-        super().setup(request, *args, **kwargs)
-        self.captura = get_object_or_404(Captura, id=kwargs['pk'])
+    def get_object(self):
+        return self.captura
 
     def get_context_data(self, *args, **kwargs):
         context = super().get_context_data(*args, **kwargs)
@@ -590,6 +619,9 @@ class CapturaView(PRMixin, SubColoniaMixin, SubGatoMixin, DetailView):
     template_name = "gatos/captura_view.html"
     context_object_name = "captura"
 
+    def get_queryset(self):
+        return self.gato.capturas.all()
+
 
 class CapturaUpdateView(PRMixin, CapturaBaseMixin, UpdateView):
     permission_required = "gatos.change_captura"
@@ -609,6 +641,9 @@ class EnfermedadBaseView(SubGatoMixin, SubColoniaMixin):
     model = Enfermedad
     context_name = "enfermedad"
 
+    def get_queryset(self):
+        return self.gato.enfermedades.all()
+
 
 class EnfermedadView(PRMixin, EnfermedadBaseView, DetailView):
     permission_required = "gatos.view_enfermedad"
@@ -681,8 +716,7 @@ class Avistamientos(SubColoniaMixin, CommandView):
 
     def run_command(self, request, *args, **kwargs):
         if 'gato' in request.GET:
-            colonia = get_object_or_404(Colonia, slug=kwargs['colonia'])
-            gato = colonia.gatos.get(slug=request.GET["gato"])
+            gato = self.colonia.gatos.get(slug=request.GET["gato"])
             gato.toggle_avistamiento(date.today(), request.user)
 
 
@@ -701,7 +735,7 @@ class CalendarioComidas(SubColoniaMixin, CommandView):
             if f > today:
                 if f not in comidas:
                     return ["comidas-calendario", "comidas-none"]
-                elif comidas[f].usuario == self.request.user:
+                elif comidas[f].usuario_id == self.request.user.pk:
                     return ["comidas-calendario", "comidas-usuario"]
                 else:
                     return ["comidas-calendario", "comidas-otro"]
@@ -726,7 +760,7 @@ class CalendarioComidas(SubColoniaMixin, CommandView):
         return context
 
     def run_command(self, request, *args, **kwargs):
-        colonia = get_object_or_404(Colonia, slug=kwargs['colonia'])
+        colonia = self.colonia
         qs = request.GET
         if "day" in qs and "month" in qs and "year" in qs:
             dia = int(qs["day"])
@@ -735,29 +769,82 @@ class CalendarioComidas(SubColoniaMixin, CommandView):
             fecha = date(ano, mes, dia)
             colonia.toggle_comida(fecha, request.user)
 
+
+class ColoniaSnapshot(PRMixin, BaseColoniaMixin, View):
+    """Everything the clients synchronize of the colony as gzipped JSON,
+    later changes come from the get_colony_changes RPC method"""
+    permission_required = "gatos.view_colonia"
+
+    def get(self, request, *args, **kwargs):
+        version = Cambio.objects.version(self.colonia)
+        etag = f'"{self.colonia.id}-{version}"'
+        no_modificado = get_conditional_response(request, etag=etag)
+        if no_modificado is not None:
+            return no_modificado
+        datos = sincronizacion.snapshot_gzip(self.colonia, version)
+        if "gzip" in request.headers.get("Accept-Encoding", ""):
+            response = HttpResponse(datos, content_type="application/json")
+            response["Content-Encoding"] = "gzip"
+        else:
+            response = HttpResponse(gzip.decompress(datos),
+                                    content_type="application/json")
+        response["ETag"] = etag
+        patch_vary_headers(response, ["Accept-Encoding", "Cookie"])
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
 # ------------------------------------------------------------------------
 #                Acciones Provisionales
 # ------------------------------------------------------------------------
 
 
 def update_miniaturas(request, colonia="ponte"):
-    tasks.update_miniaturas.delay(colonia)
+    enqueue(tasks.update_miniaturas, colonia, queue="imagenes")
     return HttpResponse("Ok, Updating Miniaturas")
 
 
 def update_exifs(request, colonia="ponte"):
     c = get_object_or_404(Colonia, slug=colonia)
-    tasks.update_exifs.delay(c.slug)
+    enqueue(tasks.update_exif, c.slug, queue="imagenes")
     return HttpResponse("Ok, Updating Exifs")
 
 
+def metricas(request):
+    """RPC metrics for Prometheus, only for superusers.
+
+    Scrapers can log in with HTTP basic auth.
+    """
+    usuario = request.user
+    if not usuario.is_authenticated:
+        usuario = usuario_basic_auth(request) or usuario
+    if not usuario.is_superuser:
+        response = HttpResponse("Unauthorized", status=401)
+        response["WWW-Authenticate"] = 'Basic realm="metricas"'
+        return response
+    return HttpResponse(metrics.exportar(),
+                        content_type="text/plain; version=0.0.4")
+
+
+def usuario_basic_auth(request):
+    try:
+        tipo, credenciales = request.META["HTTP_AUTHORIZATION"].split()
+        if tipo.lower() != "basic":
+            return None
+        nombre, clave = (base64.b64decode(credenciales).decode()
+                         .split(":", 1))
+    except (KeyError, ValueError):
+        return None
+    return authenticate(request, username=nombre, password=clave)
+
+
 def get_actividad_usuario(usuario, min_fecha=None, max_fecha=None):
-    fotos = Foto.objects.filter(usuario=usuario)
-    informes = Informe.objects.filter(usuario=usuario)
-    capturas = Captura.objects.filter(usuario=usuario)
-    vacunas = Vacunacion.objects.filter(usuario=usuario)
-    diag = Enfermedad.objects.filter(usuario=usuario)
-    avist = Avistamiento.objects.filter(usuario=usuario)
+    """Activity of the user in the colonies it can still access"""
+    fotos = Foto.objects.for_user(usuario).filter(usuario=usuario)
+    informes = Informe.objects.for_user(usuario).filter(usuario=usuario)
+    capturas = Captura.objects.for_user(usuario).filter(usuario=usuario)
+    vacunas = Vacunacion.objects.for_user(usuario).filter(usuario=usuario)
+    diag = Enfermedad.objects.for_user(usuario).filter(usuario=usuario)
+    avist = Avistamiento.objects.for_user(usuario).filter(usuario=usuario)
     if min_fecha is not None:
         fotos = fotos.filter(fecha__gte=min_fecha)
         informes = informes.filter(fecha__gte=min_fecha)
@@ -772,12 +859,13 @@ def get_actividad_usuario(usuario, min_fecha=None, max_fecha=None):
         vacunas = vacunas.filter(captura__fecha_captura__lte=max_fecha)
         diag = diag.filter(fecha_diagnostico__lte=max_fecha)
         avist = avist.filter(fecha__lte=max_fecha)
-    fotos = list(fotos.all())
-    informes = list(informes.all())
-    capturas = list(capturas.all())
-    vacunas = list(vacunas.all())
-    diag = list(diag.all())
-    avist = list(avist.all())
+    # Lo que usa el __str__ de cada actividad viene en la misma consulta
+    fotos = list(fotos.select_related("usuario").prefetch_related("gatos"))
+    informes = list(informes.select_related("usuario"))
+    capturas = list(capturas.select_related("gato", "usuario"))
+    vacunas = list(vacunas.select_related("captura__gato"))
+    diag = list(diag.select_related("gato"))
+    avist = list(avist.select_related("gato", "usuario"))
     activs = fotos + informes + capturas + vacunas + diag + avist
     return activs
 
@@ -869,3 +957,108 @@ def calendario_comidas(request, codigo):
     response = HttpResponse(cal.to_ical(), content_type='text/calendar')
     response['Content-Disposition'] = 'attachment; filename="comidas.ics"'
     return response
+
+
+# ------------------------------------------------------------------------
+#                Vistas asíncronas
+# ------------------------------------------------------------------------
+#
+# Las páginas de colonia y gato para ASGI son las vistas síncronas, que
+# junto con la plantilla, que hace consultas perezosas, corren en el pool de
+# hilos y no en el hilo que Django comparte entre todo el código síncrono.
+
+
+async def comprobar_acceso(request, permiso, colonia_slug):
+    """Async version of PRMixin plus BaseColoniaMixin, returns the colony"""
+    def comprobar_permiso():
+        if not request.user.has_perm(permiso):
+            if not request.user.is_authenticated:
+                return redirect_to_login(request.get_full_path())
+            raise PermissionDenied
+        return None
+    redireccion = await sync_to_async(comprobar_permiso)()
+    if redireccion is not None:
+        return None, redireccion
+    try:
+        colonia = await acargar(request, Colonia, slug=colonia_slug)
+    except Colonia.DoesNotExist:
+        raise Http404
+    if not await sync_to_async(tiene_acceso)(request, colonia):
+        raise PermissionDenied(
+            f"No tiene acceso a la colonia '{colonia.nombre}'")
+    return colonia, None
+
+
+def asincrona(vista):
+    """Async view that runs the sync ``vista``, rendering included, in a
+    thread of the pool, see ``utils.en_hilo``"""
+    def responder(request, *args, **kwargs):
+        respuesta = vista(request, *args, **kwargs)
+        if hasattr(respuesta, "render"):
+            respuesta.render()
+        return respuesta
+
+    async def envoltura(request, *args, **kwargs):
+        return await en_hilo(responder)(request, *args, **kwargs)
+    return envoltura
+
+
+colonia_async = asincrona(ColoniaView.as_view())
+gato_async = asincrona(GatoView.as_view())
+
+
+def evento(mensaje):
+    version = json.loads(mensaje).get("version", "")
+    return f"id: {version}\nevent: cambios\ndata: {mensaje}\n\n"
+
+
+async def eventos_colonia(request, colonia):
+    """Server-sent events with the feeding and sighting changes of the
+    colony, see gatos.eventos"""
+    if not isinstance(request, ASGIRequest):
+        # Con WSGI, como en la instalación con gunicorn, cada cliente
+        # ocuparía un worker, 204 hace que el EventSource no vuelva a
+        # intentarlo
+        return HttpResponse(status=204)
+    colonia, redireccion = await comprobar_acceso(request,
+                                                  "gatos.view_colonia",
+                                                  colonia)
+    if redireccion is not None:
+        return HttpResponse(status=204)
+    ultimo = request.headers.get("Last-Event-ID", "")
+
+    def desde_ultimo():
+        # Lo que pasó mientras el cliente estaba reconectando. Al conectar
+        # por primera vez va un evento vacío con la versión actual, para
+        # que el navegador tenga un Last-Event-ID si el flujo se corta
+        # antes de que llegue ningún cambio
+        if not ultimo.isdigit():
+            return sincronizacion.cambios(
+                colonia, Cambio.objects.version(colonia),
+                modelos=eventos.MODELOS)
+        datos = sincronizacion.cambios(colonia, int(ultimo),
+                                       modelos=eventos.MODELOS)
+        if datos.get("reset") or datos["version"] > int(ultimo):
+            return datos
+        return None
+
+    async def ponerse_al_dia():
+        datos = await en_hilo(desde_ultimo)()
+        if datos is None:
+            return None
+        return json.dumps(datos, cls=DjangoJSONEncoder)
+
+    async def flujo():
+        yield "retry: 5000\n\n"
+        async for mensaje in eventos.escuchar(colonia.id, ponerse_al_dia):
+            if mensaje is None:
+                yield ": sigo aquí\n\n"
+            else:
+                yield evento(mensaje)
+
+    response = StreamingHttpResponse(flujo(),
+                                     content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # Que nginx no lo guarde en el buffer
+    response["X-Accel-Buffering"] = "no"
+    return response
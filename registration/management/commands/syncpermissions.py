@@ -3,6 +3,7 @@ import logging
 from django.conf import settings
 from django.core.management.base import BaseCommand
 from django.contrib.auth.models import Group, Permission
+from gatos.versiones import invalidar
 
 
 class Command(BaseCommand):
@@ -16,3 +17,5 @@ class Command(BaseCommand):
                 print("Processing: %s" % code_name)
                 p = Permission.objects.get(codename=code_name)
                 group.permissions.add(p)
+        # Los permisos compilados de los usuarios dejan de valer
+        invalidar("permisos")
@@ -1,6 +1,7 @@
 from datetime import date, datetime, timezone
 from zoneinfo import ZoneInfo
 from django.conf import settings
+from django.urls import reverse
 from gatinos import __version__
 from gatos.models import Anuncio
 
@@ -8,7 +9,10 @@ from gatos.models import Anuncio
 def metadata(request):
     return {"app_title": settings.APPLICATION_TITLE,
             "app_version": __version__,
-            "current_year": date.today().year}
+            "current_year": date.today().year,
+            # Con ASGI las lecturas van al punto de entrada asíncrono
+            "rpc_lectura_url": reverse("RPC-async" if settings.ASYNC_VIEWS
+                                       else "RPC")}
 
 
 def check_intervalo(t, h_i=None, h_f=None):